@@ -0,0 +1,240 @@
+"""合并算法基准测试
+
+用python-docx生成合成语料（段落、表格、图片、样式、编号、中文文本），在子进程里
+逐个运行不需要Word的合并算法，从运行报告中读取耗时和内存峰值，输出吞吐量并与
+保存的基线比较，性能退化时以非零状态退出。
+
+    python benchmark_merge.py --files 50 --paragraphs 80
+    python benchmark_merge.py --save-baseline        # 把本次结果保存为基线
+
+仓库中的 benchmark_baseline.json 是默认语料参数的基线；用 --baseline 明确指定的基线文件
+不存在或没有相同语料参数的结果时以状态2退出，不会悄悄跳过比较。
+"""
+import os
+import sys
+import json
+import random
+import struct
+import zlib
+import argparse
+import subprocess
+import tempfile
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.shared import Inches, Pt
+
+from merge_word import ALGORITHMS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, "benchmark_baseline.json")
+
+# 不依赖Word的算法；Windows上simple会走Word COM
+HEADLESS_ALGORITHMS = tuple(a for a in ALGORITHMS if a != "word_api")
+
+# 生成中文文本用的常用字
+CJK_CHARS = (
+    "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+    "十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严"
+)
+LATIN_WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+
+def make_png(width, height, color):
+    """生成纯色PNG图片，不依赖Pillow"""
+    raw = b"".join(b"\x00" + bytes(color) * width for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def random_text(rng, length, cjk=True):
+    """随机文本，cjk为False时生成英文单词"""
+    if cjk:
+        return "".join(rng.choice(CJK_CHARS) for _ in range(length)) + "。"
+    return " ".join(rng.choice(LATIN_WORDS) for _ in range(max(1, length // 5))) + "."
+
+
+def generate_corpus(directory, files=20, paragraphs=50, tables=2, images=1, list_items=5, cjk=True, seed=0):
+    """在directory中生成files个.docx文件，返回文件路径列表；相同参数和seed生成的内容相同"""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    image_paths = []
+    for n, color in enumerate(((200, 0, 0), (0, 120, 200), (30, 160, 60))):
+        image_path = os.path.join(directory, f"_image{n}.png")
+        with open(image_path, "wb") as f:
+            f.write(make_png(120 + 40 * n, 60, color))
+        image_paths.append(image_path)
+
+    paths = []
+    for i in range(files):
+        doc = Document()
+        # 每个文件带一个自己的段落样式，检验样式合并
+        style = doc.styles.add_style(f"基准正文{i % 5}", WD_STYLE_TYPE.PARAGRAPH)
+        style.base_style = doc.styles["Normal"]
+        style.font.size = Pt(10 + i % 5)
+        style.font.name = "宋体"
+        doc.sections[0].header.paragraphs[0].text = f"基准文档 {i + 1}"
+
+        doc.add_heading(f"第{i + 1}章 " + random_text(rng, 8, cjk), level=1)
+        for _ in range(images):
+            doc.add_picture(rng.choice(image_paths), width=Inches(1.5))
+        for _ in range(list_items):
+            doc.add_paragraph(random_text(rng, 20, cjk), style="List Number")
+        table_at = {rng.randrange(max(1, paragraphs)) for _ in range(tables)}
+        for p in range(paragraphs):
+            doc.add_paragraph(random_text(rng, rng.randint(40, 200), cjk), style=style if p % 3 == 0 else None)
+            if p in table_at:
+                table = doc.add_table(rows=4, cols=3, style="Table Grid")
+                for row in table.rows:
+                    for cell in row.cells:
+                        cell.text = random_text(rng, 6, cjk)
+        path = os.path.join(directory, f"{i + 1:04d}_基准.docx")
+        doc.save(path)
+        paths.append(path)
+
+    for image_path in image_paths:
+        os.remove(image_path)
+    return paths
+
+
+def run_algorithm(corpus, algorithm, output_dir, workers=None):
+    """在子进程中运行一次合并，返回运行报告；子进程隔离保证内存峰值互不影响"""
+    output_path = os.path.join(output_dir, f"{algorithm}.docx")
+    command = [
+        sys.executable, os.path.join(HERE, "merge_word.py"), corpus, "-a", algorithm, "-o", output_path,
+        "--quiet", "--cache-size", "0",
+    ]
+    if workers:
+        command += ["--workers", str(workers)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    report_path = os.path.splitext(output_path)[0] + ".report.json"
+    if result.returncode != 0 or not os.path.exists(report_path):
+        raise RuntimeError(f"{algorithm} 合并失败（退出码 {result.returncode}）：{result.stderr.strip()}")
+    with open(report_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def benchmark(corpus, algorithms, output_dir, repeat=1, workers=None):
+    """逐个算法运行repeat次，取最快的一次，返回 {算法: 指标}"""
+    names = [f for f in os.listdir(corpus) if f.endswith(".docx")]
+    input_bytes = sum(os.path.getsize(os.path.join(corpus, f)) for f in names)
+    results = {}
+    for algorithm in algorithms:
+        runs = [run_algorithm(corpus, algorithm, output_dir, workers) for _ in range(repeat)]
+        best = min(runs, key=lambda report: report["wall_seconds"])
+        seconds = best["wall_seconds"]
+        results[algorithm] = {
+            "seconds": seconds,
+            "files_per_s": len(names) / seconds,
+            "mb_per_s": input_bytes / 1024 / 1024 / seconds,
+            "peak_rss_mb": max(report["peak_rss"] for report in runs) / 1024 / 1024,
+            "output_mb": best["output_bytes"] / 1024 / 1024,
+            "stages": {stage: value["seconds"] for stage, value in best["stages"].items()},
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """与基线比较，返回退化说明列表；吞吐量下降或内存、输出大小增长超过tolerance算退化"""
+    regressions = []
+    for algorithm, current in results.items():
+        old = baseline.get(algorithm)
+        if not old:
+            continue
+        if current["files_per_s"] < old["files_per_s"] * (1 - tolerance):
+            regressions.append(f"{algorithm}: 吞吐量 {current['files_per_s']:.2f} 文件/秒，基线 {old['files_per_s']:.2f}")
+        if current["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{algorithm}: 内存峰值 {current['peak_rss_mb']:.1f} MB，基线 {old['peak_rss_mb']:.1f}")
+        if current["output_mb"] > old["output_mb"] * (1 + tolerance):
+            regressions.append(f"{algorithm}: 输出大小 {current['output_mb']:.2f} MB，基线 {old['output_mb']:.2f}")
+    return regressions
+
+
+def print_table(results, file=sys.stdout):
+    print(f"{'算法':<12}{'耗时(s)':>10}{'文件/秒':>10}{'MB/秒':>10}{'内存峰值MB':>12}{'输出MB':>10}", file=file)
+    for algorithm, r in results.items():
+        print(
+            f"{algorithm:<12}{r['seconds']:>10.2f}{r['files_per_s']:>10.2f}{r['mb_per_s']:>10.2f}"
+            f"{r['peak_rss_mb']:>12.1f}{r['output_mb']:>10.2f}",
+            file=file,
+        )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="合并算法基准测试（不需要Word）")
+    parser.add_argument("--files", type=int, default=20, help="生成的文件数")
+    parser.add_argument("--paragraphs", type=int, default=50, help="每个文件的正文段落数")
+    parser.add_argument("--tables", type=int, default=2, help="每个文件的表格数")
+    parser.add_argument("--images", type=int, default=1, help="每个文件的图片数")
+    parser.add_argument("--list-items", type=int, default=5, help="每个文件的编号列表项数")
+    parser.add_argument("--latin", action="store_true", help="生成英文文本而不是中文")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="使用已有的语料目录，不重新生成")
+    parser.add_argument("-a", "--algorithm", action="append", choices=HEADLESS_ALGORITHMS,
+                        help="只测试指定算法，可重复；默认全部")
+    parser.add_argument("--repeat", type=int, default=3, help="每个算法运行次数，取最快的一次（默认3）")
+    parser.add_argument("--workers", type=int, help="并行解析的线程数")
+    parser.add_argument("--baseline", help="基线文件路径（默认：benchmark_baseline.json，没有对应基线时跳过比较）")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的退化比例（默认0.25）")
+    parser.add_argument("--json", help="把结果写入JSON文件")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    algorithms = args.algorithm or list(HEADLESS_ALGORITHMS)
+    corpus_options = {
+        "files": args.files, "paragraphs": args.paragraphs, "tables": args.tables, "images": args.images,
+        "list_items": args.list_items, "cjk": not args.latin, "seed": args.seed,
+    }
+
+    with tempfile.TemporaryDirectory(prefix="merge_bench_") as work:
+        corpus = args.corpus
+        if not corpus:
+            corpus = os.path.join(work, "corpus")
+            print(f"生成语料：{args.files} 个文件...", file=sys.stderr)
+            generate_corpus(corpus, **corpus_options)
+        output_dir = os.path.join(work, "output")
+        os.makedirs(output_dir)
+        results = benchmark(corpus, algorithms, output_dir, args.repeat, args.workers)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"corpus": corpus_options, "results": results}, f, ensure_ascii=False, indent=1)
+
+    # 只有语料参数相同时基线才有可比性
+    key = None if args.corpus else json.dumps(corpus_options, sort_keys=True)
+    baseline_path = args.baseline or DEFAULT_BASELINE
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, encoding="utf-8") as f:
+            baselines = json.load(f)
+    if args.save_baseline:
+        if key is None:
+            print("使用 --corpus 时不保存基线", file=sys.stderr)
+            return 0
+        baselines[key] = dict(baselines.get(key, {}), **results)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=1)
+            f.write("\n")
+        print(f"基线已保存：{baseline_path}", file=sys.stderr)
+        return 0
+    if key not in baselines:
+        if args.baseline:
+            print(f"基线文件 {args.baseline} 中没有相同语料参数的基线，无法比较", file=sys.stderr)
+            return 2
+        print("没有相同语料参数的基线，跳过比较", file=sys.stderr)
+        return 0
+    regressions = compare(results, baselines[key], args.tolerance)
+    for line in regressions:
+        print("性能退化：" + line, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
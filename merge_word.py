@@ -1,45 +1,4639 @@
 import os
+import sys
 import glob
+import fnmatch
+import hashlib
+import ipaddress
+import struct
+import json
+import mmap
+import shutil
+import zipfile
+import zlib
+import unicodedata
+import queue
+import argparse
+import subprocess
+import posixpath
+import tempfile
+import signal
+import socketserver
 import threading
-import customtkinter as ctk
+import multiprocessing
+import time
+from contextlib import contextmanager, nullcontext
+from copy import deepcopy
+from functools import partial
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+from urllib.request import pathname2url
 import re  # 添加re模块用于正则表达式
-from tkinter import filedialog, messagebox
 from docx import Document
 from docxcompose.composer import Composer
-import win32com.client as win32
-from time import sleep
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI
+from docx.opc.part import XmlPart
+from docx.opc.pkgwriter import PackageWriter
+from docx.parts.image import ImagePart
+from lxml import etree
+from xml.sax.saxutils import escape as xml_escape, quoteattr
 
-ctk.set_appearance_mode("System")
-ctk.set_default_color_theme("blue")
+# 可选的合并算法
+ALGORITHMS = ("simple", "format", "fast", "word_api", "docxcompose", "stream")
+# 在内存中组装文档、支持检查点和断点续合并的算法（Windows上simple走Word COM，不支持）
+CHECKPOINT_ALGORITHMS = ("simple", "format", "fast", "docxcompose")
+CHECKPOINT_VERSION = 1  # 检查点格式版本
 
 
-class WordMergerApp(ctk.CTk):
+def parse_docx(file_path, estimator="layout", profiler=None):
+    """解析一个.docx文件并估算页数，返回(文档, 估计页数)"""
+    profiler = profiler or NULL_PROFILER
+    with profiler.span("parse", file_path) as record:
+        record["bytes"] = os.path.getsize(file_path)
+        doc = Document(file_path)
+        record["elements"] = len(doc.element.body)
+        record["revisions"] = accept_document_revisions(doc)
+    with profiler.span("page_estimate", file_path) as record:
+        record["pages"] = estimate_pages(doc, estimator)
+    return doc, record["pages"]
+
+
+def _win32():
+    """按需导入win32com，只有Word API相关路径才会用到"""
+    import win32com.client as win32
+    return win32
+
+
+class WordConverter:
+    """通过Word COM把.doc另存为.docx，一个实例对应一个独立的Word进程"""
+
+    name = "word"
+    version = "word-com-1"
+
+    def start(self):
+        import pythoncom
+        pythoncom.CoInitialize()  # 每个工作线程都要单独初始化COM
+        self.com_initialized = True
+        # DispatchEx 总是启动新的Word进程，多个实例可以并行转换
+        self.word = _win32().DispatchEx("Word.Application")
+        self.word.Visible = False
+        self.word.DisplayAlerts = 0
+
+    def convert(self, src, dst):
+        doc = self.word.Documents.Open(src, ReadOnly=True, AddToRecentFiles=False)
+        try:
+            doc.SaveAs(dst, 16)  # 16 = wdFormatDocumentDefault (.docx)
+        finally:
+            doc.Close(SaveChanges=False)
+
+    def update_fields(self, src, dst):
+        """更新文档中的全部域（目录页码等）后另存为dst"""
+        doc = self.word.Documents.Open(src, ReadOnly=True, AddToRecentFiles=False)
+        try:
+            doc.Repaginate()
+            doc.Fields.Update()
+            doc.SaveAs(dst, 16)
+        finally:
+            doc.Close(SaveChanges=False)
+
+    def close(self):
+        """关闭Word；start()中途失败时也可以调用"""
+        word = getattr(self, "word", None)
+        if word is not None:
+            try:
+                word.Quit()
+            except Exception:
+                pass
+        if getattr(self, "com_initialized", False):
+            import pythoncom
+            pythoncom.CoUninitialize()
+
+
+class LibreOfficeConverter:
+    """通过 soffice --headless 转换，每个实例使用独立的用户配置目录，可以并行运行"""
+
+    name = "libreoffice"
+    version = "soffice-1"
+
+    def __init__(self, executable=None):
+        self.executable = executable or shutil.which("soffice") or shutil.which("libreoffice")
+
+    def start(self):
+        if not self.executable:
+            raise RuntimeError("未找到LibreOffice（soffice）")
+        # 配置目录在实例的整个生命周期内复用，只有第一次转换需要初始化配置
+        self.profile = tempfile.mkdtemp(prefix="merge_word_lo_")
+        self.outdir = tempfile.mkdtemp(prefix="merge_word_out_")
+
+    def convert(self, src, dst):
+        result = subprocess.run(
+            [
+                self.executable, f"-env:UserInstallation=file://{pathname2url(self.profile)}",
+                "--headless", "--norestore", "--convert-to", "docx", "--outdir", self.outdir, src,
+            ],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=600,
+        )
+        produced = os.path.join(self.outdir, os.path.splitext(os.path.basename(src))[0] + ".docx")
+        if result.returncode != 0 or not os.path.exists(produced):
+            raise RuntimeError(result.stderr.decode("utf-8", "replace").strip() or "LibreOffice转换失败")
+        shutil.move(produced, dst)
+
+    def update_fields(self, src, dst):
+        """LibreOffice打开文档时重新排版并计算引用域，再导出一次即得到准确的页码"""
+        self.convert(src, dst)
+
+    def close(self):
+        """删除临时配置目录；start()中途失败时也可以调用"""
+        for path in (getattr(self, "profile", None), getattr(self, "outdir", None)):
+            if path:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class FakeConverter:
+    """测试用转换器：源文件本身是.docx格式时直接复制，否则生成只含文件名的文档"""
+
+    name = "fake"
+    version = "fake-1"
+
+    def start(self):
+        pass
+
+    def convert(self, src, dst):
+        if zipfile.is_zipfile(src):
+            shutil.copyfile(src, dst)
+        else:
+            doc = Document()
+            doc.add_paragraph(os.path.basename(src))
+            doc.save(dst)
+
+    def update_fields(self, src, dst):
+        shutil.copyfile(src, dst)
+
+    def close(self):
+        pass
+
+
+# 可选的.doc转换后端
+CONVERTERS = {"word": WordConverter, "libreoffice": LibreOfficeConverter, "fake": FakeConverter}
+DEFAULT_CONVERTER_WORKERS = 2  # 每次合并的常驻转换器实例数，批量合并时也是全部任务合计的实例上限
+
+
+def default_converter():
+    """Windows上使用Word，其他系统有LibreOffice时使用LibreOffice，否则返回None"""
+    if os.name == 'nt':
+        return "word"
+    if shutil.which("soffice") or shutil.which("libreoffice"):
+        return "libreoffice"
+    return None
+
+
+def file_sha256(file_path):
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def default_cache_dir():
+    """转换缓存的默认位置"""
+    if os.name == 'nt':
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "merge_word", "conversions")
+
+
+class ConversionCache:
+    """按内容寻址的.doc转换结果缓存
+
+    以源文件内容的SHA-256加转换器版本作为键，命中时直接取出缓存的.docx，不启动Word或
+    LibreOffice。缓存总大小超过上限时，按最近使用时间（文件mtime，命中时刷新）淘汰。
+    """
+
+    def __init__(self, root=None, max_bytes=2 * 1024 ** 3):
+        self.root = root or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(src, version):
+        digest = hashlib.sha256(version.encode("utf-8") + b"\0")
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".docx")
+
+    def get(self, key, dst):
+        """命中时把缓存结果放到dst并返回True"""
+        path = self._path(key)
+        try:
+            os.utime(path)  # 刷新最近使用时间
+            try:
+                os.link(path, dst)
+            except OSError:
+                shutil.copyfile(path, dst)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, key, converted):
+        """保存一个转换结果，并在超出上限时淘汰最久未使用的条目"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(converted, temp_path)
+        os.replace(temp_path, path)
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".docx"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # 其他进程刚刚淘汰
+
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class ConverterPool:
+    """常驻的.doc转换服务
+
+    启动 size 个工作线程，每个线程持有一个长期运行的转换器实例（Word进程或LibreOffice
+    配置），从队列中取.doc路径转换。转换满 recycle_after 个文档或转换失败后重启该实例，
+    避免Word内存泄漏或卡死拖累后续文件。转换器实例在第一次缓存未命中时才启动。
+    给出 slots 时，每个实例在启动前取得一个名额，关闭后才归还；队列空闲时关闭实例，
+    把名额让给其他合并任务。
+    """
+
+    def __init__(self, backend, size=2, recycle_after=50, cache=None, profiler=None, slots=None):
+        self.backend = CONVERTERS[backend] if isinstance(backend, str) else backend
+        self.profiler = profiler or NULL_PROFILER
+        self.slots = slots  # 多个合并任务共享的信号量，限制同时存在的转换器实例（Word/LibreOffice进程）数
+        self.size = max(1, size)
+        self.recycle_after = recycle_after
+        self.cache = cache  # ConversionCache，None表示不使用缓存
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.alive = self.size  # 仍在运行的工作线程数
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.size)]
+        for thread in self.threads:
+            thread.start()
+
+    def _start_converter(self):
+        """启动一个转换器实例，失败时清理已创建的部分后抛出异常"""
+        if self.slots:
+            self.slots.acquire()  # 实例存在期间一直占用名额
+        converter = self.backend()
+        try:
+            converter.start()
+        except Exception:
+            self._close_converter(converter)
+            raise
+        return converter
+
+    def _close_converter(self, converter):
+        try:
+            converter.close()
+        except Exception:
+            pass
+        finally:
+            if self.slots:
+                self.slots.release()
+
+    def _run_task(self, converter, src, dst, operation, profiler):
+        """执行一个任务，返回(转换器实例, 本次是否启动或使用了实例)；实例不可用时抛出异常"""
+        if operation == "start":
+            # 预热：只启动转换器实例
+            return converter or self._start_converter(), False
+        used = False
+        with (profiler or self.profiler).span("conversion", src, bytes=os.path.getsize(src)) as record:
+            # 只缓存格式转换，更新域的结果取决于整个合并输出，不缓存
+            key = self.cache.key(src, self.backend.version) if self.cache and operation == "convert" else None
+            record["cache_hit"] = bool(key and self.cache.get(key, dst))
+            if not record["cache_hit"]:
+                converter = converter or self._start_converter()
+                getattr(converter, operation)(src, dst)
+                used = True
+                if key:
+                    self.cache.put(key, dst)
+        return converter, used
+
+    def _worker(self):
+        converter = None
+        converted = 0
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+                src, dst, operation, profiler, future = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    started = converter is None
+                    converter, used = self._run_task(converter, src, dst, operation, profiler)
+                    if started:
+                        converted = 0
+                    converted += used
+                    future.set_result(dst)
+                except Exception as e:
+                    future.set_exception(e)
+                    converted = self.recycle_after  # 失败后重启实例
+                # 共享名额时空闲的实例不占着名额
+                if converter is not None and (converted >= self.recycle_after or self.slots and self.tasks.empty()):
+                    self._close_converter(converter)
+                    converter = None
+        finally:
+            if converter is not None:
+                self._close_converter(converter)
+            self._worker_exited()
+
+    def _worker_exited(self):
+        """最后一个工作线程退出时，让队列中剩下的任务失败，等待结果的调用方不会一直阻塞"""
+        with self.lock:
+            self.alive -= 1
+            if self.alive:
+                return
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None and task[-1].set_running_or_notify_cancel():
+                task[-1].set_exception(RuntimeError("转换池已关闭"))
+
+    def submit(self, src, dst, operation="convert", profiler=None):
+        """提交一个转换任务，返回Future，结果为转换后的.docx路径
+
+        operation 为转换器的方法名：convert 转换为.docx，update_fields 更新域。
+        profiler 为提交任务的合并所用的RunProfiler，多个合并共用一个转换池时各自记录耗时。
+        """
+        future = Future()
+        with self.lock:
+            if not self.alive:
+                future.set_exception(RuntimeError("转换池已关闭"))
+                return future
+            self.tasks.put((src, dst, operation, profiler, future))
+        return future
+
+    def warm(self):
+        """提前启动全部转换器实例，第一次转换不用等Word或LibreOffice启动，返回各实例的Future"""
+        return [self.submit(None, None, "start") for _ in self.threads]
+
+    def close(self):
+        """等待队列中的任务完成并关闭全部转换器实例"""
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def resolved_future(value):
+    """已经完成的Future，用于不需要转换的文件"""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def chain_future(future, executor, fn):
+    """future完成后把fn(结果)交给executor执行，返回最终结果的Future
+
+    用完成回调衔接，不占用任何线程等待前一步；前一步失败或被取消时直接传递过去，
+    前一步的结果为None（不需要处理的文件）或fn为None时结果就是前一步的结果。
+    """
+    chained = Future()
+
+    def settle(done):
+        if chained.done():
+            return  # 调用方已取消
+        if done.cancelled():
+            chained.cancel()
+        elif done.exception() is not None:
+            chained.set_exception(done.exception())
+        else:
+            chained.set_result(done.result())
+
+    def start(done):
+        if done.cancelled() or done.exception() is not None or fn is None or done.result() is None:
+            settle(done)
+            return
+        try:
+            executor.submit(fn, done.result()).add_done_callback(settle)
+        except RuntimeError:
+            chained.cancel()  # 线程池已关闭：合并被取消
+
+    future.add_done_callback(start)
+    return chained
+
+
+def _windows_peak_rss():
+    import ctypes
+    from ctypes import wintypes
+
+    class Counters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage",
+            )
+        ]
+
+    counters = Counters()
+    counters.cb = ctypes.sizeof(counters)
+    try:
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        pass
+    return 0
+
+
+def peak_rss():
+    """本进程的内存峰值（字节），无法获取时返回0；Word和LibreOffice是独立进程，不计算在内"""
+    try:
+        import resource
+    except ImportError:
+        return _windows_peak_rss()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class _NullProfiler:
+    """不记录任何数据的占位实现"""
+
+    def span(self, stage, file_path=None, **counters):
+        return nullcontext(dict(counters))
+
+
+class RunProfiler:
+    """记录一次合并各阶段的耗时、读取字节数、元素数和内存峰值
+
+    span() 返回的字典可以在阶段内补充计数（bytes、elements、pages等），数值按文件累加。
+    可以在多个线程里同时使用；结束后用 report() 生成JSON报告，trace_events() 生成
+    Chrome trace（chrome://tracing 或 Perfetto 打开）。
+    """
+
+    STAGES = ("discovery", "conversion", "parse", "page_estimate", "append", "save", "toc")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.events = []
+        self.files = {}  # 文件路径 -> 统计
+        self.aliases = {}  # 转换出的临时.docx -> 原.doc路径
+
+    def alias(self, file_path, source_path):
+        """把临时文件上的统计记到原文件名下"""
+        self.aliases[file_path] = source_path
+
+    @contextmanager
+    def span(self, stage, file_path=None, **counters):
+        record = dict(counters)
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            duration = time.perf_counter() - start
+            rss = peak_rss()
+            file_path = self.aliases.get(file_path, file_path)
+            with self.lock:
+                self.events.append({
+                    "stage": stage, "file": file_path, "start": start - self.origin, "duration": duration,
+                    "thread": threading.get_ident(), "peak_rss": rss, "counters": record,
+                })
+                if file_path is not None:
+                    self._add_file(file_path, stage, duration, rss, rss - rss_before, record)
+
+    def _add_file(self, file_path, stage, duration, rss, rss_growth, record):
+        stats = self.files.setdefault(file_path, {"stages": {}, "peak_rss": 0, "rss_growth": 0})
+        stats["stages"][stage] = stats["stages"].get(stage, 0) + duration
+        stats["peak_rss"] = max(stats["peak_rss"], rss)
+        stats["rss_growth"] += rss_growth
+        for name, value in record.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stats[name] = stats.get(name, 0) + value
+            else:
+                stats[name] = value
+
+    def report(self, order=(), **summary):
+        """生成报告字典：总体信息、各阶段合计、逐文件统计（按order中的输入顺序）和最慢的文件"""
+        with self.lock:
+            events = list(self.events)
+            files = {path: dict(stats, stages=dict(stats["stages"])) for path, stats in self.files.items()}
+        stages = {}
+        for event in events:
+            total = stages.setdefault(event["stage"], {"seconds": 0.0, "count": 0})
+            total["seconds"] += event["duration"]
+            total["count"] += 1
+        file_list = []
+        for path, stats in files.items():
+            stats["path"] = path
+            stats["seconds"] = sum(stats["stages"].values())
+            file_list.append(stats)
+        position = {path: n for n, path in enumerate(order)}
+        file_list.sort(key=lambda stats: position.get(stats["path"], len(position)))
+        slowest = sorted(file_list, key=lambda stats: stats["seconds"], reverse=True)[:10]
+        return dict(
+            summary,
+            started=self.started,
+            wall_seconds=time.perf_counter() - self.origin,
+            peak_rss=peak_rss(),
+            stages=stages,
+            files=file_list,
+            slowest=[{"path": stats["path"], "seconds": stats["seconds"]} for stats in slowest],
+        )
+
+    def trace_events(self):
+        """Chrome trace-event格式，每个阶段一个完整事件（ph=X），时间单位为微秒"""
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for event in events:
+            name = event["stage"]
+            if event["file"]:
+                name += " " + os.path.basename(event["file"])
+            args = dict(event["counters"], peak_rss=event["peak_rss"])
+            if event["file"]:
+                args["file"] = event["file"]
+            trace.append({
+                "name": name, "cat": event["stage"], "ph": "X", "pid": pid, "tid": event["thread"],
+                "ts": round(event["start"] * 1e6), "dur": round(event["duration"] * 1e6), "args": args,
+            })
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+class MergeError(Exception):
+    """合并前置检查失败（目录不存在、没有文档等）"""
+
+    def __init__(self, title, message):
+        super().__init__(message)
+        self.title = title
+        self.message = message
+
+
+class MergeCancelled(MergeError):
+    """合并被取消"""
+
+    def __init__(self):
+        super().__init__("已取消", "合并已取消")
+
+
+class MergeJob:
+    """一次合并任务的控制对象，可以在任意线程中取消或暂停
+
+    合并算法在每个文件之间调用 check()：暂停时在此等待，取消时抛出 MergeCancelled。
+    """
+
+    def __init__(self, cancelled=None, running=None):
+        # 批量合并时传入 multiprocessing.Event，控制全部工作进程
+        self.cancelled = threading.Event() if cancelled is None else cancelled
+        if running is None:
+            running = threading.Event()
+            running.set()
+        self.running = running
+
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()  # 唤醒暂停中的合并线程
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def check(self):
+        self.running.wait()
+        if self.cancelled.is_set():
+            raise MergeCancelled()
+
+
+# OOXML命名空间和关系类型
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+WP_NS = "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing"
+MC_NS = "http://schemas.openxmlformats.org/markup-compatibility/2006"
+PKG_RELS_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+CT_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+RT_OFFICE_DOCUMENT = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+RT_PREFIX = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/"
+CT_PREFIX = "application/vnd.openxmlformats-officedocument.wordprocessingml."
+
+
+def w(tag):
+    """返回w命名空间下的完整标签名"""
+    return f"{{{W_NS}}}{tag}"
+
+
+# 目录样式：宋体三号、单倍行距，右对齐点线制表位位于450磅处
+TOC_FONT = "宋体"
+TOC_FONT_SIZE = 32  # 半磅单位，三号字体约为16磅
+TOC_TAB_POS = 9000  # 缇单位，450磅
+BOOKMARK_ID_BASE = 1000000  # 合并时添加的书签ID，避开输入文档自带的书签
+MANIFEST_VERSION = 1  # 增量合并清单格式版本
+
+
+def _toc_run(text, bold=False):
+    bold_xml = "<w:b/><w:bCs/>" if bold else ""
+    return (
+        f'<w:r><w:rPr><w:rFonts w:ascii="{TOC_FONT}" w:eastAsia="{TOC_FONT}" w:hAnsi="{TOC_FONT}"/>{bold_xml}'
+        f'<w:sz w:val="{TOC_FONT_SIZE}"/><w:szCs w:val="{TOC_FONT_SIZE}"/></w:rPr>{text}</w:r>'
+    )
+
+
+def _page_field(bookmark, page_number):
+    """PAGEREF域，page_number作为更新前显示的缓存结果"""
+    return (
+        _toc_run('<w:fldChar w:fldCharType="begin"/>')
+        + _toc_run(f'<w:instrText xml:space="preserve"> PAGEREF {bookmark} \\h </w:instrText>')
+        + _toc_run('<w:fldChar w:fldCharType="separate"/>')
+        + _toc_run(f"<w:t>{page_number}</w:t>")
+        + _toc_run('<w:fldChar w:fldCharType="end"/>')
+    )
+
+
+def build_toc_xml(entries, page_fields=False):
+    """生成目录的正文XML片段（w前缀，不含命名空间声明）
+
+    entries 为 (显示名称, 页码, 书签名) 列表。每个目录项是一个带点线前导符的右对齐
+    制表位段落，整行是指向书签的内部超链接；目录后跟一个分页符。
+    page_fields 为True时页码写成 PAGEREF 域，由Word或LibreOffice排版后计算准确值。
+    """
+    spacing = '<w:spacing w:line="240" w:lineRule="auto"/>'  # 单倍行距
+    parts = [
+        f'<w:p><w:pPr>{spacing}<w:jc w:val="center"/></w:pPr>{_toc_run("<w:t>目录</w:t>", bold=True)}</w:p>',
+        "<w:p/>",
+    ]
+    for display_name, page_number, bookmark in entries:
+        if page_fields:
+            runs = _toc_run(f'<w:t xml:space="preserve">{xml_escape(display_name)}</w:t><w:tab/>') + _page_field(bookmark, page_number)
+        else:
+            runs = _toc_run(f'<w:t xml:space="preserve">{xml_escape(display_name)}</w:t><w:tab/><w:t>{page_number}</w:t>')
+        parts.append(
+            f'<w:p><w:pPr><w:tabs><w:tab w:val="right" w:leader="dot" w:pos="{TOC_TAB_POS}"/></w:tabs>{spacing}</w:pPr>'
+            f'<w:hyperlink w:anchor={quoteattr(bookmark)} w:history="1">{runs}</w:hyperlink></w:p>'
+        )
+    # 添加单个分页符，将目录与正文分开
+    parts.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+    return "".join(parts)
+
+
+# settings.xml中排在updateFields之后的元素（CT_Settings的元素顺序）
+_SETTINGS_AFTER_UPDATE_FIELDS = {
+    w(tag) for tag in (
+        "hdrShapeDefaults", "footnotePr", "endnotePr", "compat", "docVars", "rsids", "attachedSchema", "themeFontLang",
+        "clrSchemeMapping", "doNotIncludeSubdocsInStats", "doNotAutoCompressPictures", "forceUpgrade", "captions",
+        "readModeInkLockDown", "smartTagType", "schemaLibrary", "shapeDefaults", "doNotEmbedSmartTags",
+        "decimalSymbol", "listSeparator",
+    )
+} | {"{http://schemas.openxmlformats.org/officeDocument/2006/math}mathPr"}
+
+
+def set_update_fields(settings):
+    """在settings根元素上设置updateFields，Word打开文档时提示更新全部域"""
+    flag = settings.find(w("updateFields"))
+    if flag is None:
+        flag = etree.Element(w("updateFields"))
+        following = next((child for child in settings if child.tag in _SETTINGS_AFTER_UPDATE_FIELDS), None)
+        if following is not None:
+            following.addprevious(flag)
+        else:
+            settings.append(flag)
+    flag.set(w("val"), "true")
+
+
+def build_index_xml(volumes):
+    """生成分卷总目录的正文XML片段
+
+    volumes 为 (卷名, 指向分卷文件的关系ID, 目录项列表) 列表，目录项与build_toc_xml相同，
+    页码为该文件在分卷中的页码。
+    """
+    spacing = '<w:spacing w:line="240" w:lineRule="auto"/>'
+    tabs = f'<w:tabs><w:tab w:val="right" w:leader="dot" w:pos="{TOC_TAB_POS}"/></w:tabs>'
+    parts = [f'<w:p><w:pPr>{spacing}<w:jc w:val="center"/></w:pPr>{_toc_run("<w:t>总目录</w:t>", bold=True)}</w:p>']
+    for volume_name, rid, entries in volumes:
+        parts.append(
+            f'<w:p><w:pPr>{spacing}</w:pPr><w:hyperlink r:id={quoteattr(rid)} w:history="1">'
+            f'{_toc_run(f"<w:t>{xml_escape(volume_name)}</w:t>", bold=True)}</w:hyperlink></w:p>'
+        )
+        for display_name, page_number, bookmark in entries:
+            text = (
+                f'<w:t xml:space="preserve">{xml_escape(display_name)}</w:t><w:tab/>'
+                f'<w:t>{xml_escape(volume_name)} {page_number}</w:t>'
+            )
+            parts.append(
+                f'<w:p><w:pPr>{tabs}{spacing}</w:pPr>'
+                f'<w:hyperlink r:id={quoteattr(rid)} w:anchor={quoteattr(bookmark)} w:history="1">{_toc_run(text)}</w:hyperlink></w:p>'
+            )
+    return "".join(parts)
+
+
+def parse_block_xml(xml):
+    """把w前缀（可含r前缀）的正文XML片段解析为元素列表"""
+    return list(etree.fromstring(f'<w:body xmlns:w="{W_NS}" xmlns:r="{R_NS}">{xml}</w:body>'))
+
+
+def add_bookmark(body, name, bookmark_id, index=0):
+    """在正文第index个元素处添加书签：段落则放在段落开头，否则作为正文级书签插入"""
+    start = etree.Element(w("bookmarkStart"))
+    start.set(w("id"), str(bookmark_id))
+    start.set(w("name"), name)
+    end = etree.Element(w("bookmarkEnd"))
+    end.set(w("id"), str(bookmark_id))
+    target = body[index] if index < len(body) else None
+    if target is not None and target.tag == w("p"):
+        pos = 1 if len(target) and target[0].tag == w("pPr") else 0
+        target.insert(pos, end)
+        target.insert(pos, start)
+    else:
+        body.insert(index, end)
+        body.insert(index, start)
+
+
+# 默认页面：A4纸，上下2.54厘米、左右3.17厘米页边距（缇单位）
+DEFAULT_PAGE = (11906, 16838, 1440, 1440, 1800, 1800)
+DEFAULT_FONT_SIZE = 10.5  # 五号字体，单位磅
+EMU_PER_TWIP = 635
+
+
+class CharCountEstimator:
+    """按字符数估算页数（每页约2000个字符）"""
+
+    def __init__(self, default_size=DEFAULT_FONT_SIZE):
+        self.text_length = 0
+
+    def feed(self, elem):
+        for t in elem.iter(w("t")):
+            self.text_length += len(t.text or "")
+
+    def finish(self, sect_pr=None):
+        return max(1, self.text_length // 2000)
+
+
+class LayoutEstimator:
+    """按版面估算页数
+
+    读取节的纸张大小和页边距，按字号估算每段的行数，计入表格行、内嵌图片高度、
+    分页符和分节符。如果文档带有Word上次排版留下的lastRenderedPageBreak标记，
+    直接以标记数为准。正文元素可以逐个喂入，适合流式解析。
+    """
+
+    def __init__(self, default_size=DEFAULT_FONT_SIZE):
+        self.default_size = default_size or DEFAULT_FONT_SIZE
+        self.blocks = []  # 当前节的版面块：(需要的文字宽度, 行高, 固定高度) 或 None 表示分页
+        self.pages = 0
+        self.rendered_breaks = 0
+
+    # ---- 收集 ----
+
+    def feed(self, elem):
+        """喂入一个正文级元素（段落、表格、内容控件等）"""
+        if elem.tag == w("p"):
+            self._paragraph(elem)
+        elif elem.tag == w("tbl"):
+            self._table(elem)
+        else:
+            for child in elem:
+                self.feed(child)
+
+    def _measure_runs(self, p, on_break=None):
+        """统计段落中文字宽度、最大字号和图片高度"""
+        width = 0
+        max_size = 0
+        fixed = 0
+        for r in p.iter(w("r")):
+            size = self.default_size
+            sz = r.find(f"{w('rPr')}/{w('sz')}")
+            if sz is not None:
+                size = int(sz.get(w("val"))) / 2
+            for child in r:
+                if child.tag == w("t") and child.text:
+                    text = child.text
+                    # UTF-8下中文等全角字符占3字节，按一个字宽计，其他按半个字宽计
+                    wide = (len(text.encode("utf-8")) - len(text)) // 2
+                    width += (wide + (len(text) - wide) * 0.5) * size * 20
+                    max_size = max(max_size, size)
+                elif child.tag == w("lastRenderedPageBreak"):
+                    self.rendered_breaks += 1
+                elif child.tag == w("br") and child.get(w("type")) == "page" and on_break:
+                    on_break(width, max_size or self.default_size, fixed)
+                    width = fixed = 0
+                elif child.tag in (w("drawing"), w("pict"), w("object")):
+                    for extent in child.iter(f"{{{WP_NS}}}extent"):
+                        fixed += int(extent.get("cy", 0)) / EMU_PER_TWIP
+                        break
+        return width, max_size or self.default_size, fixed
+
+    def _line_height(self, ppr, size):
+        spacing = ppr.find(w("spacing")) if ppr is not None else None
+        height = size * 20 * 1.2
+        extra = 0
+        if spacing is not None:
+            line = spacing.get(w("line"))
+            if line:
+                if spacing.get(w("lineRule"), "auto") == "auto":
+                    height *= int(line) / 240
+                else:
+                    height = max(height, int(line)) if spacing.get(w("lineRule")) == "atLeast" else int(line)
+            extra = int(spacing.get(w("before"), 0) or 0) + int(spacing.get(w("after"), 0) or 0)
+        return height, extra
+
+    def _paragraph(self, p):
+        ppr = p.find(w("pPr"))
+        if ppr is not None and ppr.find(w("pageBreakBefore")) is not None:
+            self.blocks.append(None)
+
+        def page_break(width, size, fixed):
+            height, _ = self._line_height(ppr, size)
+            self.blocks.append((width, height, fixed))
+            self.blocks.append(None)
+
+        width, size, fixed = self._measure_runs(p, page_break)
+        height, extra = self._line_height(ppr, size)
+        self.blocks.append((width, height, fixed + extra))
+        sect_pr = ppr.find(w("sectPr")) if ppr is not None else None
+        if sect_pr is not None:
+            self._close_section(sect_pr)
+
+    def _table(self, tbl):
+        for row in self._table_rows(tbl):
+            self.blocks.append(row)
+
+    def _table_rows(self, tbl):
+        """估算表格每一行的(宽度, 高度, 0)；只看本表的行和单元格，嵌套表格递归估算后计入所在单元格"""
+        rows = []
+        for tr in tbl.findall(w("tr")):
+            cells = tr.findall(w("tc"))
+            if not cells:
+                continue
+            # 每个单元格按等宽列估算，行高取最高的单元格
+            row_width = 0
+            row_height = 0
+            for tc in cells:
+                width, size, fixed = 0, self.default_size, 0
+                for child in tc:
+                    if child.tag == w("p"):
+                        p_width, p_size, p_fixed = self._measure_runs(child)
+                        width = max(width, p_width)
+                        size = max(size, p_size)
+                        fixed += p_fixed
+                    elif child.tag == w("tbl"):
+                        for n_width, n_height, _ in self._table_rows(child):
+                            width = max(width, n_width / len(cells))
+                            fixed += n_height
+                row_width = max(row_width, width * len(cells))
+                row_height = max(row_height, size * 20 * 1.2 + fixed)
+            tr_height = tr.find(f"{w('trPr')}/{w('trHeight')}")
+            if tr_height is not None:
+                row_height = max(row_height, int(tr_height.get(w("val"), 0)))
+            rows.append((row_width, row_height, 0))
+        return rows
+
+    # ---- 排版 ----
+
+    @staticmethod
+    def _page_geometry(sect_pr):
+        """返回(内容区宽度, 内容区高度)，单位缇"""
+        width, height, top, bottom, left, right = DEFAULT_PAGE
+        if sect_pr is not None:
+            pg_sz = sect_pr.find(w("pgSz"))
+            if pg_sz is not None:
+                width = int(pg_sz.get(w("w"), width))
+                height = int(pg_sz.get(w("h"), height))
+            pg_mar = sect_pr.find(w("pgMar"))
+            if pg_mar is not None:
+                top = abs(int(pg_mar.get(w("top"), top)))
+                bottom = abs(int(pg_mar.get(w("bottom"), bottom)))
+                left = int(pg_mar.get(w("left"), left))
+                right = int(pg_mar.get(w("right"), right))
+        return max(width - left - right, 1440), max(height - top - bottom, 1440)
+
+    def _close_section(self, sect_pr):
+        """一个节结束，按该节的页面设置把累计的版面块排成页"""
+        content_width, content_height = self._page_geometry(sect_pr)
+        pages = 1
+        used = 0
+        for block in self.blocks:
+            if block is None:
+                pages += 1
+                used = 0
+                continue
+            width, line_height, fixed = block
+            lines = max(1, -(-int(width) // content_width))
+            used += lines * line_height + fixed
+            while used > content_height:
+                pages += 1
+                used -= content_height
+        sect_type = sect_pr.find(w("type")) if sect_pr is not None else None
+        continuous = sect_type is not None and sect_type.get(w("val")) == "continuous"
+        if continuous and self.pages:
+            pages -= 1
+        self.pages += pages
+        self.blocks = []
+
+    def finish(self, sect_pr=None):
+        """文档结束，返回估计页数"""
+        if self.blocks or not self.pages:
+            self._close_section(sect_pr)
+        if self.rendered_breaks:
+            return self.rendered_breaks + 1
+        return max(1, self.pages)
+
+
+# 可选的页数估算模型
+PAGE_ESTIMATORS = {"layout": LayoutEstimator, "chars": CharCountEstimator}
+
+
+def default_font_size(styles_root):
+    """从styles.xml的docDefaults读取默认字号（磅）"""
+    if styles_root is None:
+        return DEFAULT_FONT_SIZE
+    sz = styles_root.find(f"{w('docDefaults')}/{w('rPrDefault')}/{w('rPr')}/{w('sz')}")
+    if sz is None:
+        return DEFAULT_FONT_SIZE
+    return int(sz.get(w("val"))) / 2
+
+
+def estimate_pages(doc, estimator="layout"):
+    """在已解析的python-docx文档上估算页数"""
+    try:
+        styles_root = doc.styles.element
+    except Exception:
+        styles_root = None
+    model = PAGE_ESTIMATORS[estimator](default_font_size(styles_root))
+    body = doc.element.body
+    sect_pr = None
+    for elem in body:
+        if elem.tag == w("sectPr"):
+            sect_pr = elem
+        else:
+            model.feed(elem)
+    return model.finish(sect_pr)
+
+
+class _Rels:
+    """输出包中某个部件的关系列表"""
+
+    def __init__(self, part_name):
+        self.part_name = part_name
+        self.items = []  # (rId, 类型, 目标, 是否外部)
+
+    def add(self, reltype, target, external=False, prefix=""):
+        rid = f"rId{prefix}{len(self.items) + 1}"
+        if not external:
+            target = posixpath.relpath(target, posixpath.dirname(self.part_name))
+        self.items.append((rid, reltype, target, external))
+        return rid
+
+    def rels_name(self):
+        return _rels_name(self.part_name)
+
+    def xml(self):
+        lines = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{PKG_RELS_NS}">']
+        for rid, reltype, target, external in self.items:
+            mode = ' TargetMode="External"' if external else ""
+            lines.append(f'<Relationship Id="{rid}" Type="{reltype}" Target={quoteattr(target)}{mode}/>')
+        lines.append("</Relationships>")
+        return "".join(lines).encode("utf-8")
+
+
+def _rels_name(part_name):
+    """部件对应的.rels文件名"""
+    return posixpath.join(posixpath.dirname(part_name), "_rels", posixpath.basename(part_name) + ".rels")
+
+
+def read_rels(zin, part_name):
+    """读取部件的关系，返回 {rId: (类型, 目标部件名或URL, 是否外部)}"""
+    try:
+        root = etree.fromstring(zin.read(_rels_name(part_name)))
+    except KeyError:
+        return {}
+    rels = {}
+    for rel in root.iter(f"{{{PKG_RELS_NS}}}Relationship"):
+        target = rel.get("Target")
+        external = rel.get("TargetMode") == "External"
+        if not external:
+            if target.startswith("/"):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(part_name), target))
+        rels[rel.get("Id")] = (rel.get("Type"), target, external)
+    return rels
+
+
+class _MappedFile:
+    """把mmap包装成zipfile需要的只读文件对象（Python 3.13之前mmap没有seekable）"""
+
+    def __init__(self, mm):
+        self.mm = mm
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.mm.seek(offset, whence)
+
+    def tell(self):
+        return self.mm.tell()
+
+    def read(self, size=-1):
+        return self.mm.read(None if size is None or size < 0 else size)
+
+
+class DocxPackage:
+    """轻量的.docx读取器：内存映射文件，只解析zip中央目录，部件在用到时才解压和解析
+
+    python-docx的Document会读取并解析包里的全部部件（页眉页脚、批注、自定义XML、图片），
+    只需要正文时用这个读取器，只接触正文、样式和关系这几个部件的字节。
+    """
+
+    def __init__(self, file_path):
+        self.path = file_path
+        with open(file_path, "rb") as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise zipfile.BadZipFile(f"空文件：{file_path}")
+        try:
+            self.zip = zipfile.ZipFile(_MappedFile(self.mm))
+        except Exception:
+            self.mm.close()
+            raise
+        self._rels = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+        self.mm.close()
+
+    def __contains__(self, part_name):
+        return part_name in self.zip.NameToInfo
+
+    def read(self, part_name):
+        return self.zip.read(part_name)
+
+    def xml(self, part_name):
+        """解压并解析一个部件，部件不存在时返回None"""
+        if part_name not in self:
+            return None
+        return etree.fromstring(self.read(part_name))
+
+    def rels(self, part_name):
+        """部件的关系 {rId: (类型, 目标部件名或URL, 是否外部)}，读取后缓存"""
+        if part_name not in self._rels:
+            self._rels[part_name] = read_rels(self.zip, part_name)
+        return self._rels[part_name]
+
+    def related(self, part_name, short_type):
+        """部件按关系类型（如 styles、numbering）引用的第一个包内部件名"""
+        for reltype, target, external in self.rels(part_name).values():
+            if not external and reltype == RT_PREFIX + short_type:
+                return target
+        return None
+
+    @property
+    def main_part(self):
+        for reltype, target, _ in self.rels("").values():
+            if reltype == RT_OFFICE_DOCUMENT:
+                return target
+        return "word/document.xml"
+
+    def iter_body(self):
+        """流式产出正文的顶层元素（最后一个通常是sectPr），产出后即释放，不在内存中保留整棵树"""
+        with self.zip.open(self.main_part) as f:
+            for _, elem in etree.iterparse(f, events=("end",), huge_tree=True):
+                parent = elem.getparent()
+                if parent is None or parent.tag != w("body"):
+                    continue
+                yield elem
+                parent.remove(elem)
+
+
+def paragraph_text(p):
+    """段落文字，与python-docx的Paragraph.text一致：文字、制表符和换行，包括超链接中的文字"""
+    parts = []
+    for child in p.iterchildren(w("r"), w("hyperlink")):
+        for run in (child,) if child.tag == w("r") else child.iterchildren(w("r")):
+            for el in run:
+                if el.tag == w("t"):
+                    parts.append(el.text or "")
+                elif el.tag == w("tab"):
+                    parts.append("\t")
+                elif el.tag in (w("br"), w("cr")) and el.get(w("type")) in (None, "textWrapping"):
+                    parts.append("\n")
+    return "".join(parts)
+
+
+def scan_docx(file_path, estimator="layout", profiler=None):
+    """不构建python-docx文档，流式读取正文：返回(正文顶层段落的文字列表, 估计页数)
+
+    同时起到验证文件的作用，文件损坏时抛出异常。
+    """
+    profiler = profiler or NULL_PROFILER
+    with profiler.span("parse", file_path) as record, DocxPackage(file_path) as package:
+        record["bytes"] = os.path.getsize(file_path)
+        styles = package.related(package.main_part, "styles")
+        model = PAGE_ESTIMATORS[estimator](default_font_size(package.xml(styles) if styles else None))
+        texts = []
+        sect_pr = None
+        pending = None  # 段落标记被删除、等读到下一段再合并的段落
+        elements = revisions = 0
+
+        def feed(elem):
+            model.feed(elem)
+            if elem.tag == w("p"):
+                texts.append(paragraph_text(elem))
+
+        for elem in package.iter_body():
+            if elem.tag == w("sectPr"):
+                sect_pr = elem
+                continue
+            if elem.tag in _REVISION_REMOVED:
+                revisions += 1
+                continue
+            mark_deleted = paragraph_mark_deleted(elem)
+            revisions += accept_revisions(elem, merge_paragraphs=False)
+            if pending is not None:
+                if elem.tag == w("p"):
+                    join_paragraphs(pending, elem)
+                else:
+                    feed(pending)
+                pending = None
+            if mark_deleted:
+                pending = elem
+                continue
+            elements += 1
+            feed(elem)
+        if pending is not None:
+            elements += 1
+            feed(pending)
+        record["elements"] = elements
+        record["revisions"] = revisions
+        record["pages"] = model.finish(sect_pr)
+    return texts, record["pages"]
+
+
+# ---- 去重 ----
+
+DEDUP_DIRS = ("word/media/", "word/embeddings/")  # 按内容去重的二进制部件目录
+# 本身已经压缩过的格式，保存时不再用zlib压缩
+PRECOMPRESSED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "emz", "wmz", "wdp", "jxr", "webp", "mp3", "mp4", "m4a", "wma", "wmv",
+    "zip", "docx", "xlsx", "pptx", "odt", "ods",
+}
+
+
+def is_precompressed(part_name):
+    return posixpath.splitext(part_name)[1][1:].lower() in PRECOMPRESSED_EXTENSIONS
+
+
+def save_document(document, path, compresslevel=None):
+    """保存python-docx文档：已压缩的图片等部件直接存储，XML部件按compresslevel压缩
+
+    python-docx默认对每个部件都重新deflate，图片多的文档保存时大部分时间耗在zlib上。
+    先写到 path.partial，完整写出后才替换path，保存失败时原有的文件不受影响。
+    """
+    package = document.part.package
+    for part in package.parts:
+        part.before_marshal()
+    partial_path = path + ".partial"
+    try:
+        with zipfile.ZipFile(partial_path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zout:
+            writer = _PartWriter(zout)
+            PackageWriter._write_content_types_stream(writer, package.parts)
+            PackageWriter._write_pkg_rels(writer, package.rels)
+            PackageWriter._write_parts(writer, package.parts)
+        os.replace(partial_path, path)
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+        raise
+
+
+class _PartWriter:
+    """供python-docx的PackageWriter使用的zip写入器"""
+
+    def __init__(self, zout):
+        self.zout = zout
+
+    def write(self, pack_uri, blob):
+        name = pack_uri.membername
+        compress_type = zipfile.ZIP_STORED if is_precompressed(name) else zipfile.ZIP_DEFLATED
+        self.zout.writestr(name, blob, compress_type=compress_type)
+
+
+def _abstract_num_key(abstract_num):
+    """编号定义的规范形式：去掉每份拷贝都不同的ID、nsid和tmpl"""
+    copy = deepcopy(abstract_num)
+    copy.attrib.pop(w("abstractNumId"), None)
+    for tag in ("nsid", "tmpl"):
+        for el in copy.findall(w(tag)):
+            copy.remove(el)
+    return etree.tostring(copy, method="c14n")
+
+
+def dedupe_abstract_nums(abstract_nums, nums):
+    """合并内容相同的abstractNum并去掉没有被引用的，返回保留的列表；nums中的引用就地改写
+
+    引用同一个abstractNum的num在Word中共用一个计数，所以被改指向的num加上startOverride，
+    保证各输入的列表仍然从头编号。被多个num引用的定义不合并：这些num在原文档中本来就
+    互相接续编号，只给其中一个加startOverride会让其余的接着别的输入的列表编号，全部加上
+    又会打断原有的接续。
+    """
+    references = {}  # abstractNumId -> 引用它的num数
+    for num in nums:
+        ref = num.find(w("abstractNumId"))
+        if ref is not None:
+            references[ref.get(w("val"))] = references.get(ref.get(w("val")), 0) + 1
+    canonical = {}  # 规范形式 -> 保留的abstractNumId
+    remap = {}  # 被合并的abstractNumId -> (保留的abstractNumId, 原定义)
+    linked = set()  # 通过样式链接的定义，不参与合并
+    for abstract_num in abstract_nums:
+        abstract_id = abstract_num.get(w("abstractNumId"))
+        if abstract_num.find(w("numStyleLink")) is not None or abstract_num.find(w("styleLink")) is not None:
+            linked.add(abstract_id)
+            continue
+        key = _abstract_num_key(abstract_num)
+        if key not in canonical:
+            canonical[key] = abstract_id
+        elif references.get(abstract_id, 0) <= 1:
+            remap[abstract_id] = (canonical[key], abstract_num)
+
+    used = set(linked)
+    for num in nums:
+        ref = num.find(w("abstractNumId"))
+        if ref is None:
+            continue
+        old = ref.get(w("val"))
+        if old in remap:
+            new, abstract_num = remap[old]
+            ref.set(w("val"), new)
+            overridden = {o.get(w("ilvl")) for o in num.findall(w("lvlOverride"))}
+            for lvl in abstract_num.findall(w("lvl")):
+                if lvl.get(w("ilvl")) in overridden:
+                    continue
+                start = lvl.find(w("start"))
+                override = etree.SubElement(num, w("lvlOverride"))
+                override.set(w("ilvl"), lvl.get(w("ilvl")))
+                etree.SubElement(override, w("startOverride")).set(
+                    w("val"), start.get(w("val")) if start is not None else "0"
+                )
+        used.add(ref.get(w("val")))
+    return [a for a in abstract_nums if a.get(w("abstractNumId")) in used]
+
+
+def dedupe_numbering_part(root):
+    """对numbering.xml根元素去重，返回去掉的abstractNum数"""
+    abstract_nums = root.findall(w("abstractNum"))
+    kept = dedupe_abstract_nums(abstract_nums, root.findall(w("num")))
+    kept_set = set(kept)
+    for abstract_num in abstract_nums:
+        if abstract_num not in kept_set:
+            root.remove(abstract_num)
+    return len(abstract_nums) - len(kept)
+
+
+def dedupe_document(document):
+    """python-docx文档保存前去重：内容相同的图片等二进制部件只保留一份，编号定义合并
+
+    返回 (去掉的部件数, 节省的字节数, 去掉的编号定义数)。
+    """
+    package = document.part.package
+    canonical = {}
+    duplicates = {}
+    for part in package.iter_parts():
+        if not str(part.partname).lstrip("/").startswith(DEDUP_DIRS):
+            continue
+        digest = hashlib.sha256(part.blob).digest()
+        if digest in canonical:
+            duplicates[part] = canonical[digest]
+        else:
+            canonical[digest] = part
+    if duplicates:
+        for part in list(package.iter_parts()):
+            for rel in part.rels.values():
+                if not rel.is_external and rel.target_part in duplicates:
+                    rel._target = duplicates[rel.target_part]  # 保存时只写出仍被引用的部件
+    removed_nums = 0
+    try:
+        numbering = document.part.numbering_part
+    except (KeyError, NotImplementedError):
+        numbering = None
+    if numbering is not None:
+        removed_nums = dedupe_numbering_part(numbering.element)
+    return len(duplicates), sum(len(p.blob) for p in duplicates), removed_nums
+
+
+def force_new_page(sect):
+    """保证该节从新的一页开始"""
+    sect_type = sect.find(w("type"))
+    if sect_type is None:
+        sect_type = etree.Element(w("type"))
+        index = 0
+        for i, child in enumerate(sect):
+            if child.tag in (w("headerReference"), w("footerReference"), w("footnotePr"), w("endnotePr")):
+                index = i + 1
+        sect.insert(index, sect_type)
+    elif sect_type.get(w("val")) not in (None, "continuous"):
+        return
+    sect_type.set(w("val"), "nextPage")
+
+
+# 接受修订时整个去掉的元素：删除和移出的内容、格式修订前的旧属性、批注锚点
+_REVISION_REMOVED = {
+    w(tag) for tag in (
+        "del", "moveFrom", "rPrChange", "pPrChange", "sectPrChange", "tblPrChange", "tblPrExChange", "trPrChange",
+        "tcPrChange", "tblGridChange", "numberingChange", "moveFromRangeStart", "moveFromRangeEnd",
+        "moveToRangeStart", "moveToRangeEnd", "customXmlInsRangeStart", "customXmlInsRangeEnd",
+        "customXmlDelRangeStart", "customXmlDelRangeEnd", "customXmlMoveFromRangeStart", "customXmlMoveFromRangeEnd",
+        "customXmlMoveToRangeStart", "customXmlMoveToRangeEnd", "cellIns", "cellDel", "cellMerge",
+        "commentRangeStart", "commentRangeEnd", "commentReference",
+    )
+}
+# 接受修订时换成其子元素的插入和移入标记
+_REVISION_UNWRAPPED = {w("ins"), w("moveTo")}
+_REVISION_TAGS = tuple(_REVISION_REMOVED | _REVISION_UNWRAPPED)
+# 批注及其扩展部件的关系类型，接受修订时一起去掉
+COMMENT_RELATIONSHIPS = {
+    RT.COMMENTS,
+    "http://schemas.microsoft.com/office/2011/relationships/commentsExtended",
+    "http://schemas.microsoft.com/office/2016/09/relationships/commentsIds",
+    "http://schemas.microsoft.com/office/2018/08/relationships/commentsExtensible",
+    "http://schemas.microsoft.com/office/2011/relationships/people",
+}
+
+
+def accept_revisions(root, merge_paragraphs=True):
+    """在元素树上接受全部修订并去掉批注锚点，与Word的“接受所有修订”结果相同，返回处理的修订数
+
+    插入和移入的内容保留，删除和移出的内容去掉，格式修订保留新格式；段落标记被删除的段落
+    并入下一段，被删除的表格行和单元格整个去掉。只遍历一次树，不需要Word。
+    流式解析时下一段可能还没有读到，merge_paragraphs为False时不合并，由调用方先用
+    paragraph_mark_deleted判断、缓冲这一段，读到下一段后用join_paragraphs合并。
+    """
+    merged = []  # 段落标记被删除、需要并入下一段的段落
+    count = 0
+    for el in list(root.iter(_REVISION_TAGS)):
+        parent = el.getparent()
+        if el is root or parent is None:
+            continue  # 顶层的修订元素由调用方处理
+        count += 1
+        tag = el.tag
+        if tag in (w("del"), w("moveFrom")) and parent.tag == w("rPr") and parent.getparent() is not None \
+                and parent.getparent().tag == w("pPr"):
+            if merge_paragraphs:
+                merged.append(parent.getparent().getparent())
+        elif tag in (w("del"), w("moveFrom")) and parent.tag == w("trPr"):
+            row = parent.getparent()
+            if row.getparent() is not None:
+                row.getparent().remove(row)
+            continue
+        elif tag == w("cellDel") and parent.getparent() is not None:
+            cell = parent.getparent()
+            if cell.getparent() is not None:
+                cell.getparent().remove(cell)
+            continue
+        elif tag in _REVISION_UNWRAPPED:
+            for child in list(el):
+                el.addprevious(child)
+        parent.remove(el)
+    for paragraph in merged:
+        following = paragraph.getnext()
+        if paragraph.getparent() is None or following is None or following.tag != w("p"):
+            continue
+        join_paragraphs(paragraph, following)
+    return count
+
+
+def paragraph_mark_deleted(elem):
+    """段落标记是否被修订删除（接受修订后这一段并入下一段），需在accept_revisions之前判断"""
+    rpr = elem.find(f"{w('pPr')}/{w('rPr')}") if elem.tag == w("p") else None
+    return rpr is not None and (rpr.find(w("del")) is not None or rpr.find(w("moveFrom")) is not None)
+
+
+def join_paragraphs(paragraph, following):
+    """把段落的内容移到下一段开头，段落属性用下一段的，并去掉这一段"""
+    anchor = following.find(w("pPr"))
+    for child in list(paragraph):
+        if child.tag == w("pPr"):
+            continue
+        if anchor is None:
+            following.insert(0, child)
+        else:
+            anchor.addnext(child)
+        anchor = child
+    if paragraph.getparent() is not None:
+        paragraph.getparent().remove(paragraph)
+
+
+def disable_track_revisions(settings):
+    """关闭settings中的修订跟踪，合并结果打开后不会继续记录修订"""
+    for flag in settings.findall(w("trackRevisions")):
+        settings.remove(flag)
+
+
+def accept_document_revisions(doc):
+    """在python-docx文档上接受修订：正文、页眉页脚，去掉批注部件的引用并关闭修订跟踪，返回修订数"""
+    count = accept_revisions(doc.element)
+    for rel in list(doc.part.rels.values()):
+        if rel.is_external:
+            continue
+        if rel.reltype in COMMENT_RELATIONSHIPS:
+            doc.part.drop_rel(rel.rId)
+        elif isinstance(rel.target_part, XmlPart) and rel.reltype in (RT.HEADER, RT.FOOTER):
+            count += accept_revisions(rel.target_part.element)
+    disable_track_revisions(doc.settings.element)
+    return count
+
+
+_R_ATTR_XPATH = etree.XPath("descendant-or-self::*[@*[namespace-uri()=$ns]]")
+
+
+class FastComposer:
+    """轻量的保留格式合并，接口与docxcompose的Composer相同（doc属性和append方法）
+
+    正文元素连同段落、字符格式直接移入目标文档，图片按sha1只保留一份，页眉页脚、
+    图表等引用的部件连同其关系整体接过来；编号定义按偏移合并，样式只按styleId补充
+    缺失的，不做docxcompose那样按样式名映射和保留默认格式的处理。每个文件保留自己的
+    节属性（页面设置、页眉页脚），并从新的一页开始。
+    追加后源文档的内容被移走，不能再使用。
+    """
+
+    NOTE_TYPES = ((RT.FOOTNOTES, "footnoteReference"), (RT.ENDNOTES, "endnoteReference"))
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.part = doc.part
+        self.body = doc.element.body
+        parts = list(self.part.package.iter_parts())
+        self.partnames = {str(part.partname) for part in parts}
+        self.partname_counters = {}
+        self.images = {part.sha1: part for part in parts if isinstance(part, ImagePart)}
+        self.adopted = set()
+        self.style_ids = {s.get(w("styleId")) for s in doc.styles.element.iterfind(w("style"))}
+        self.notes = {}  # 关系类型 -> (目标部件, 下一个可用ID)
+        # 书签和图形ID在整个文档内唯一，追加的文件在当前最大ID之后编号
+        ids = (int(el.get("id") or el.get(w("id")) or 0) for el in self.body.iter(w("bookmarkStart"), f"{{{WP_NS}}}docPr"))
+        self.max_id = max((i for i in ids if i < BOOKMARK_ID_BASE), default=0)
+
+    # ---- 部件 ----
+
+    def _free_partname(self, partname):
+        """部件名与目标包冲突时换一个序号"""
+        name = str(partname)
+        if name in self.partnames:
+            base, ext = re.match(r"(.*?)\d*((?:\.[^./]*)?)$", name).groups()
+            n = self.partname_counters.get(base, 1)
+            while f"{base}{n}{ext}" in self.partnames:
+                n += 1
+            self.partname_counters[base] = n + 1
+            name = f"{base}{n}{ext}"
+        self.partnames.add(name)
+        return PackURI(name)
+
+    def _adopt(self, part):
+        """把源文档的部件（及其引用的部件）接入目标包，返回目标包中对应的部件"""
+        if part in self.adopted:
+            return part
+        if isinstance(part, ImagePart):
+            existing = self.images.get(part.sha1)
+            if existing is not None:
+                return existing
+            self.images[part.sha1] = part
+        self.adopted.add(part)
+        part.partname = self._free_partname(part.partname)
+        for rel in part.rels.values():
+            if not rel.is_external:
+                rel._target = self._adopt(rel.target_part)
+        return part
+
+    def _rewrite_rids(self, elem, src_part, dst_part):
+        for el in _R_ATTR_XPATH(elem, ns=R_NS):  # python-docx的元素重写了xpath方法，不支持变量
+            for name, value in el.attrib.items():
+                if not name.startswith(f"{{{R_NS}}}"):
+                    continue
+                rel = src_part.rels.get(value)
+                if rel is None:
+                    continue
+                if rel.is_external:
+                    el.set(name, dst_part.relate_to(rel.target_ref, rel.reltype, is_external=True))
+                else:
+                    el.set(name, dst_part.relate_to(self._adopt(rel.target_part), rel.reltype))
+
+    # ---- 编号、样式、脚注 ----
+
+    def _merge_numbering(self, doc):
+        """把源文档的编号定义按偏移加入目标，返回numId的映射函数"""
+        try:
+            src_part = doc.part.part_related_by(RT.NUMBERING)
+        except KeyError:
+            return lambda num_id: num_id
+        try:
+            numbering = self.part.part_related_by(RT.NUMBERING).element
+        except KeyError:
+            self.part.relate_to(self._adopt(src_part), RT.NUMBERING)
+            return lambda num_id: num_id
+        abstract_offset = 1 + max((int(a.get(w("abstractNumId"))) for a in numbering.iterfind(w("abstractNum"))), default=-1)
+        num_offset = 1 + max((int(n.get(w("numId"))) for n in numbering.iterfind(w("num"))), default=0)
+        first_num = numbering.find(w("num"))
+        cleanup = numbering.find(w("numIdMacAtCleanup"))
+        for el in list(src_part.element):
+            if el.tag == w("abstractNum"):
+                el.set(w("abstractNumId"), str(int(el.get(w("abstractNumId"))) + abstract_offset))
+                # abstractNum必须排在所有num之前
+                if first_num is not None:
+                    first_num.addprevious(el)
+                elif cleanup is not None:
+                    cleanup.addprevious(el)
+                else:
+                    numbering.append(el)
+            elif el.tag == w("num"):
+                el.set(w("numId"), str(int(el.get(w("numId"))) + num_offset))
+                for ref in el.iter(w("abstractNumId")):
+                    ref.set(w("val"), str(int(ref.get(w("val"))) + abstract_offset))
+                if cleanup is not None:
+                    cleanup.addprevious(el)
+                else:
+                    numbering.append(el)
+        # numId为0表示取消编号，不能偏移
+        return lambda num_id: num_id if num_id == 0 else num_id + num_offset
+
+    def _merge_styles(self, doc, map_num):
+        """只补充目标中没有的样式，同名样式以先合并的文件为准"""
+        styles = self.doc.styles.element
+        for style in doc.styles.element.findall(w("style")):
+            style_id = style.get(w("styleId"))
+            if style_id in self.style_ids:
+                continue
+            self.style_ids.add(style_id)
+            for num_id in style.iter(w("numId")):
+                num_id.set(w("val"), str(map_num(int(num_id.get(w("val"))))))
+            styles.append(style)
+
+    def _notes_part(self, reltype, src_part, src_root):
+        """目标文档的脚注/尾注部件，必要时新建或换成可直接修改的XmlPart"""
+        if reltype in self.notes:
+            return self.notes[reltype]
+        try:
+            part = self.part.part_related_by(reltype)
+        except KeyError:
+            part = None
+        if part is None:
+            root = etree.Element(src_root.tag, nsmap=src_root.nsmap)
+            for note in src_root:
+                if note.get(w("type")) in ("separator", "continuationSeparator", "continuationNotice"):
+                    root.append(deepcopy(note))
+            part = XmlPart(self._free_partname(src_part.partname), src_part.content_type, root, self.part.package)
+            self.part.relate_to(part, reltype)
+        elif not isinstance(part, XmlPart):
+            # python-docx把脚注当作普通二进制部件，换成XmlPart以便多次追加后一次序列化
+            xml_part = XmlPart(part.partname, part.content_type, etree.fromstring(part.blob), part.package)
+            for rel in part.rels.values():
+                xml_part.load_rel(rel.reltype, rel.target_ref if rel.is_external else rel.target_part, rel.rId, rel.is_external)
+            for rel in self.part.rels.values():
+                if not rel.is_external and rel.target_part is part:
+                    rel._target = xml_part
+            part = xml_part
+        next_id = 1 + max((int(n.get(w("id"))) for n in part.element), default=0)
+        self.notes[reltype] = [part, max(next_id, 1)]
+        return self.notes[reltype]
+
+    def _merge_notes(self, doc, elements, map_num):
+        """把被引用的脚注和尾注移入目标部件，并改写引用ID"""
+        for reltype, ref_name in self.NOTE_TYPES:
+            refs = [el for elem in elements for el in elem.iter(w(ref_name))]
+            if not refs:
+                continue
+            try:
+                src_part = doc.part.part_related_by(reltype)
+            except KeyError:
+                continue
+            src_root = etree.fromstring(src_part.blob)
+            accept_revisions(src_root)
+            src_notes = {note.get(w("id")): note for note in src_root}
+            entry = self._notes_part(reltype, src_part, src_root)
+            part = entry[0]
+            new_ids = {}
+            for ref in refs:
+                old_id = ref.get(w("id"))
+                if old_id not in new_ids:
+                    note = src_notes.get(old_id)
+                    if note is None:
+                        continue
+                    new_ids[old_id] = str(entry[1])
+                    entry[1] += 1
+                    note.set(w("id"), new_ids[old_id])
+                    self._rewrite_rids(note, src_part, part)
+                    for num_id in note.iter(w("numId")):
+                        num_id.set(w("val"), str(map_num(int(num_id.get(w("val"))))))
+                    part.element.append(note)
+                ref.set(w("id"), new_ids[old_id])
+
+    # ---- 追加 ----
+
+    def append(self, doc):
+        """追加一个文档"""
+        src_body = doc.element.body
+        src_sect = src_body.find(w("sectPr"))
+        elements = [el for el in src_body if el.tag != w("sectPr")]
+        map_num = self._merge_numbering(doc)
+        self._merge_styles(doc, map_num)
+        self._merge_notes(doc, elements, map_num)
+
+        id_base = self.max_id + 1
+        if src_sect is not None:
+            elements.append(src_sect)
+        for elem in elements:
+            self._rewrite_rids(elem, doc.part, self.part)
+            for el in elem.iter(w("numId")):
+                el.set(w("val"), str(map_num(int(el.get(w("val"))))))
+            for el in elem.iter(w("bookmarkStart"), w("bookmarkEnd"), f"{{{WP_NS}}}docPr"):
+                attr = "id" if el.tag == f"{{{WP_NS}}}docPr" else w("id")
+                old_id = int(el.get(attr) or 0)
+                if old_id < BOOKMARK_ID_BASE:
+                    el.set(attr, str(old_id + id_base))
+                    self.max_id = max(self.max_id, old_id + id_base)
+            # 批注部件不合并，去掉批注锚点以免引用悬空
+            for el in list(elem.iter(w("commentRangeStart"), w("commentRangeEnd"), w("commentReference"))):
+                el.getparent().remove(el)
+
+        sect = self.body.find(w("sectPr"))
+        if src_sect is None:
+            src_sect = deepcopy(sect) if sect is not None else None
+        else:
+            elements.pop()
+        if sect is not None and len(self.body) > 1:
+            # 上一个文件的节属性变成分节符段落，保留各自的页面设置和页眉页脚
+            paragraph = etree.SubElement(self.body, w("p"))
+            etree.SubElement(paragraph, w("pPr")).append(sect)
+            first = next((s for el in elements for s in el.iter(w("sectPr"))), src_sect)
+            if first is not None:
+                force_new_page(first)
+        elif sect is not None:
+            self.body.remove(sect)
+        for el in elements:
+            self.body.append(el)
+        if src_sect is not None:
+            self.body.append(src_sect)
+
+
+class StreamMerger:
+    """在zip部件层面流式合并.docx：正文逐个元素写出，不构建完整的文档树
+
+    每个输入的 word/document.xml 用iterparse增量解析，正文子元素改写关系ID、编号ID、
+    书签ID后直接写入临时文件，写完即丢弃；图片等部件在用到时原样拷贝到输出zip。
+    样式、编号、脚注这些体积很小的部件在内存中合并，最后一次性写出。
+    输出先写到 output_path.partial，close() 成功后才替换 output_path，合并失败或中断时
+    上一次的输出保持不变（增量合并也从中读取未变化的段）。
+    """
+
+    # 由输出包统一提供、不随正文逐个拷贝的部件类型
+    SHARED_TYPES = {
+        "styles", "stylesWithEffects", "numbering", "settings", "fontTable", "theme",
+        "webSettings", "footnotes", "endnotes", "comments", "customXml", "glossaryDocument",
+        "people", "commentsExtended", "commentsIds", "commentsExtensible",
+    }
+    # 从第一个输入原样继承的包级部件
+    INHERITED_TYPES = ("settings", "fontTable", "theme", "webSettings")
+
+    def __init__(self, output_path, dedupe=True, compresslevel=None, update_fields=False):
+        self.output_path = output_path
+        self.dedupe = dedupe  # 图片等部件按内容只写一份，编号定义合并
+        self.update_fields = update_fields  # 在settings中设置打开时更新域
+        self.partial_path = output_path + ".partial"
+        self.zout = zipfile.ZipFile(self.partial_path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.body = tempfile.TemporaryFile()
+        self.root_ns = {"w": W_NS, "r": R_NS}
+        self.ignorable = []
+        self.doc_rels = _Rels("word/document.xml")
+        self.defaults = {"rels": "application/vnd.openxmlformats-package.relationships+xml", "xml": "application/xml"}
+        self.overrides = {"/word/document.xml": CT_PREFIX + "document.main+xml"}
+        self.styles = None
+        self.style_ids = set()
+        self.numbering_ns = None
+        self.abstract_nums = []
+        self.nums = []
+        self.num_offset = 0
+        self.abstract_offset = 0
+        self.notes = {"footnotes": None, "endnotes": None}  # 类型 -> (根元素, 关系列表)
+        self.note_offset = {"footnotes": 0, "endnotes": 0}
+        self.id_offset = 0  # 书签和图形docPr的ID基数
+        self.pending_sectpr = None
+        self.file_count = 0  # 成功追加的文件数
+        self.attempts = 0  # 尝试追加的文件数，用于生成不重复的部件名
+        self.inherited = False  # 包级部件是否已经就位
+        self.used_keys = set()
+        self.segment_key = None  # 当前输入的段标识，用作部件名和关系ID的前缀
+        self.segment = None  # 当前输入写出的部件和关系，供增量合并的清单使用
+        self.segments = []
+        self.old_zip = None  # 增量合并时上一次的输出
+        self.media = {}  # "CRC-大小" -> (输出包中的部件名, (来源zip路径, 来源部件名))
+        self.segment_media = {}  # 当前输入新写出的可去重部件，整个输入追加成功后才并入media
+        self.written = set()  # 增量合并时已从上一次输出拷贝的部件
+
+    # ---- 输入包读取 ----
+
+    @staticmethod
+    def _content_types(zin):
+        root = etree.fromstring(zin.read("[Content_Types].xml"))
+        defaults = {e.get("Extension").lower(): e.get("ContentType") for e in root.iter(f"{{{CT_NS}}}Default")}
+        overrides = {e.get("PartName"): e.get("ContentType") for e in root.iter(f"{{{CT_NS}}}Override")}
+        return defaults, overrides
+
+    @staticmethod
+    def _main_part(zin):
+        for reltype, target, _ in read_rels(zin, "").values():
+            if reltype == RT_OFFICE_DOCUMENT:
+                return target
+        return "word/document.xml"
+
+    @staticmethod
+    def _short_type(reltype):
+        return reltype.rsplit("/", 1)[-1]
+
+    # ---- 部件拷贝 ----
+
+    def _copy_part(self, src, part_name, new_name):
+        """把输入包中的部件（连同它自己的关系和被引用部件）拷贝到输出包"""
+        zin, content_types, copied = src
+        if part_name in copied:
+            return copied[part_name]
+        info = zin.getinfo(part_name)
+        digest = None
+        if self.dedupe and new_name.startswith(DEDUP_DIRS) and _rels_name(part_name) not in zin.NameToInfo:
+            # 先用zip目录里的CRC和大小找候选，只有找到候选时才解压比较内容
+            digest = f"{info.CRC:08x}-{info.file_size}"
+            existing = self.media.get(digest) or self.segment_media.get(digest)
+            if existing is not None and self._same_content(zin, part_name, existing[1]):
+                # 同样的图片已经写过，直接引用那一份
+                copied[part_name] = existing[0]
+                if self.segment is not None:
+                    self.segment["parts"].append(existing[0])
+                    self.segment["media"][existing[0]] = digest
+                return existing[0]
+        copied[part_name] = new_name
+        self._write_member(zin, info, new_name)
+        if digest is not None:
+            media = self.segment_media if self.segment is not None else self.media
+            media.setdefault(digest, (new_name, (zin.filename, part_name)))
+        if self.segment is not None:
+            self.segment["parts"].append(new_name)
+            if digest is not None:
+                self.segment["media"][new_name] = digest
+        defaults, overrides = content_types
+        ext = posixpath.splitext(part_name)[1][1:].lower()
+        if "/" + part_name in overrides:
+            self.overrides["/" + new_name] = overrides["/" + part_name]
+        elif ext not in self.defaults and ext in defaults:
+            self.defaults[ext] = defaults[ext]
+
+        sub_rels = read_rels(zin, part_name)
+        if sub_rels:
+            rels = _Rels(new_name)
+            # 保持原有rId不变，部件内容里的引用就不需要改写
+            for rid, (reltype, target, external) in sub_rels.items():
+                if not external:
+                    if target not in zin.NameToInfo:
+                        continue
+                    target = self._copy_part(src, target, self._new_part_name(target))
+                    target = posixpath.relpath(target, posixpath.dirname(new_name))
+                rels.items.append((rid, reltype, target, external))
+            self.zout.writestr(rels.rels_name(), rels.xml())
+            if self.segment is not None:
+                self.segment["parts"].append(rels.rels_name())
+        return new_name
+
+    @staticmethod
+    def _same_content(zin, part_name, source):
+        source_path, source_name = source
+        with zipfile.ZipFile(source_path) as other:
+            return other.read(source_name) == zin.read(part_name)
+
+    def _write_member(self, zin, info, name):
+        """把输入包的一个成员写到输出包：压缩数据原样搬运，不解压也不重新压缩"""
+        if info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) and not info.flag_bits & 0x1 and zin.filename:
+            raw = self._read_raw(zin.filename, info)
+            if raw is not None:
+                self._write_raw(info, name, raw)
+                return
+        compress_type = zipfile.ZIP_STORED if is_precompressed(name) else zipfile.ZIP_DEFLATED
+        self.zout.writestr(name, zin.read(info), compress_type=compress_type)
+
+    @staticmethod
+    def _read_raw(source_path, info):
+        """读取成员的原始压缩数据，本地文件头异常时返回None"""
+        with open(source_path, "rb") as f:
+            f.seek(info.header_offset)
+            header = f.read(30)
+            if len(header) < 30 or header[:4] != b"PK\x03\x04":
+                return None
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            raw = f.read(info.compress_size)
+        return raw if len(raw) == info.compress_size else None
+
+    def _write_raw(self, info, name, raw):
+        """按zipfile写入成员的方式追加一条已经压缩好的记录"""
+        out = zipfile.ZipInfo(name, info.date_time)
+        out.compress_type = info.compress_type
+        out.CRC = info.CRC
+        out.file_size = info.file_size
+        out.compress_size = len(raw)
+        out.external_attr = info.external_attr
+        zout = self.zout
+        with zout._lock:
+            zout.fp.seek(zout.start_dir)
+            out.header_offset = zout.fp.tell()
+            zout.fp.write(out.FileHeader())
+            zout.fp.write(raw)
+            zout.start_dir = zout.fp.tell()
+            zout.filelist.append(out)
+            zout.NameToInfo[name] = out
+            zout._didModify = True
+
+    def _new_part_name(self, part_name):
+        """输出包中的部件名，加上段标识前缀避免重名"""
+        return posixpath.join(posixpath.dirname(part_name), f"{self.segment_key}_{posixpath.basename(part_name)}")
+
+    def _reserve_key(self, key):
+        """段标识在输出包内必须唯一，同一内容出现多次时加序号"""
+        candidate = key
+        n = 1
+        while candidate in self.used_keys:
+            n += 1
+            candidate = f"{key}x{n}"
+        self.used_keys.add(candidate)
+        return candidate
+
+    def _map_rid(self, rid, src_rels, rid_map, out_rels, src):
+        if rid in rid_map:
+            return rid_map[rid]
+        rel = src_rels.get(rid)
+        if rel is None:
+            return rid
+        reltype, target, external = rel
+        prefix = self.segment_key + "_"
+        if external:
+            new_rid = out_rels.add(reltype, target, external=True, prefix=prefix)
+        elif self._short_type(reltype) in self.SHARED_TYPES or target not in src[0].NameToInfo:
+            return rid
+        else:
+            new_rid = out_rels.add(reltype, self._copy_part(src, target, self._new_part_name(target)), prefix=prefix)
+        rid_map[rid] = new_rid
+        return new_rid
+
+    # ---- 共享部件合并 ----
+
+    def _init_package(self, src, rels):
+        """从第一个输入继承settings、字体表和主题等包级部件"""
+        self.inherited = True
+        for reltype, target, external in rels.values():
+            if not external and self._short_type(reltype) in self.INHERITED_TYPES and target in src[0].NameToInfo:
+                if self._short_type(reltype) == "settings":
+                    self._write_settings(src[0].read(target), target)
+                    self.doc_rels.add(reltype, target)
+                else:
+                    self.doc_rels.add(reltype, self._copy_part(src, target, target))
+
+    def _write_settings(self, data, name):
+        settings = etree.fromstring(data)
+        disable_track_revisions(settings)
+        if self.update_fields:
+            set_update_fields(settings)
+        self.written.add(name)
+        self.zout.writestr(name, etree.tostring(settings, xml_declaration=True, encoding="UTF-8", standalone=True))
+
+    def _merge_numbering(self, zin, rels):
+        """合并编号定义，返回本文件numId的偏移函数"""
+        part = self._find_shared(rels, "numbering")
+        offset = self.num_offset
+        if part is None or part not in zin.NameToInfo:
+            return lambda num_id: num_id
+        root = etree.fromstring(zin.read(part))
+        if self.numbering_ns is None:
+            self.numbering_ns = root.nsmap
+        max_abstract = max_num = -1
+        for el in list(root):
+            if el.tag == w("abstractNum"):
+                old = int(el.get(w("abstractNumId")))
+                max_abstract = max(max_abstract, old)
+                el.set(w("abstractNumId"), str(old + self.abstract_offset))
+                self.abstract_nums.append(el)
+            elif el.tag == w("num"):
+                old = int(el.get(w("numId")))
+                max_num = max(max_num, old)
+                el.set(w("numId"), str(old + offset))
+                for ref in el.iter(w("abstractNumId")):
+                    ref.set(w("val"), str(int(ref.get(w("val"))) + self.abstract_offset))
+                self.nums.append(el)
+        self.abstract_offset += max_abstract + 1
+        self.num_offset += max_num + 1
+        # numId为0表示取消编号，不能偏移
+        return lambda num_id: num_id if num_id == 0 else num_id + offset
+
+    def _merge_styles(self, zin, rels, map_num):
+        """第一个输入的样式作为基础，后续输入只补充缺失的样式，返回该输入的默认字号"""
+        part = self._find_shared(rels, "styles")
+        if part is None or part not in zin.NameToInfo:
+            return DEFAULT_FONT_SIZE
+        root = etree.fromstring(zin.read(part))
+        font_size = default_font_size(root)
+        if self.styles is None:
+            self.styles = root
+            self.style_ids = {s.get(w("styleId")) for s in root.iter(w("style"))}
+            return font_size
+        for style in list(root.iter(w("style"))):
+            style_id = style.get(w("styleId"))
+            if style_id in self.style_ids:
+                continue
+            self.style_ids.add(style_id)
+            for num_id in style.iter(w("numId")):
+                num_id.set(w("val"), str(map_num(int(num_id.get(w("val"))))))
+            self.styles.append(style)
+        return font_size
+
+    def _merge_notes(self, src, rels, map_num):
+        """合并脚注和尾注，返回 {类型: 旧ID到新ID的映射}"""
+        zin = src[0]
+        maps = {}
+        for kind in ("footnotes", "endnotes"):
+            part = self._find_shared(rels, kind)
+            maps[kind] = {}
+            if part is None or part not in zin.NameToInfo:
+                continue
+            root = etree.fromstring(zin.read(part))
+            accept_revisions(root)
+            note_rels = read_rels(zin, part)
+            if self.notes[kind] is None:
+                self.notes[kind] = (etree.Element(root.tag, nsmap=root.nsmap), _Rels(f"word/{kind}.xml"))
+                separators = True
+            else:
+                separators = False
+            out_root, out_rels = self.notes[kind]
+            rid_map = {}
+            max_id = self.note_offset[kind]
+            for note in list(root):
+                note_id = int(note.get(w("id")))
+                if note.get(w("type")) in ("separator", "continuationSeparator", "continuationNotice"):
+                    if not separators:
+                        continue
+                    new_id = note_id
+                else:
+                    new_id = note_id + self.note_offset[kind] + 1
+                    maps[kind][str(note_id)] = str(new_id)
+                max_id = max(max_id, new_id)
+                note.set(w("id"), str(new_id))
+                self._rewrite_rids(note, note_rels, rid_map, out_rels, src)
+                for num_id in note.iter(w("numId")):
+                    num_id.set(w("val"), str(map_num(int(num_id.get(w("val"))))))
+                out_root.append(note)
+            self.note_offset[kind] = max_id
+        return maps
+
+    @classmethod
+    def _find_shared(cls, rels, short_type):
+        for reltype, target, external in rels.values():
+            if not external and cls._short_type(reltype) == short_type:
+                return target
+        return None
+
+    # ---- 正文改写 ----
+
+    def _rewrite_rids(self, elem, src_rels, rid_map, out_rels, src):
+        for el in elem.xpath("descendant-or-self::*[@*[namespace-uri()=$ns]]", ns=R_NS):
+            for name, value in el.attrib.items():
+                if name.startswith(f"{{{R_NS}}}"):
+                    el.set(name, self._map_rid(value, src_rels, rid_map, out_rels, src))
+
+    def _rewrite(self, elem, ctx):
+        """改写一个正文元素中的关系ID、编号ID、书签ID和脚注引用"""
+        self._rewrite_rids(elem, ctx["rels"], ctx["rid_map"], self.doc_rels, ctx["src"])
+        for el in elem.iter(w("numId")):
+            el.set(w("val"), str(ctx["map_num"](int(el.get(w("val"))))))
+        for tag, kind in ((w("footnoteReference"), "footnotes"), (w("endnoteReference"), "endnotes")):
+            for el in elem.iter(tag):
+                el.set(w("id"), ctx["notes"][kind].get(el.get(w("id")), el.get(w("id"))))
+        for el in elem.iter(w("bookmarkStart"), w("bookmarkEnd"), f"{{{WP_NS}}}docPr"):
+            attr = "id" if el.tag == f"{{{WP_NS}}}docPr" else w("id")
+            new_id = int(el.get(attr)) + ctx["id_base"]
+            ctx["max_id"] = max(ctx["max_id"], new_id)
+            el.set(attr, str(new_id))
+        # 接受修订；批注部件不合并，同时去掉批注锚点以免引用悬空
+        ctx["revisions"] += accept_revisions(elem, merge_paragraphs=False)
+        if ctx["new_page"]:
+            for sect in elem.iter(w("sectPr")):
+                force_new_page(sect)
+                ctx["new_page"] = False
+                break
+
+    def _serialize(self, elem):
+        """序列化元素，去掉根元素上已经声明过的命名空间"""
+        text = etree.tostring(elem, encoding="unicode")
+        head_end = text.index(">")
+
+        def strip(match):
+            prefix, uri = match.group(1), match.group(2)
+            if self.root_ns.setdefault(prefix, uri) == uri:
+                return ""
+            return match.group(0)
+
+        head = re.sub(r'\sxmlns:([\w.-]+)="([^"]*)"', strip, text[:head_end])
+        return (head + text[head_end:]).encode("utf-8")
+
+    # ---- 对外接口 ----
+
+    def append(self, file_path, bookmark_name, estimator="layout", key=None):
+        """追加一个.docx文件，返回估计页数
+
+        key 为段标识（通常取自文件内容哈希），用作该输入的部件名和关系ID前缀。
+        """
+        self.attempts += 1
+        self.segment_key = self._reserve_key(key or f"f{self.attempts}")
+        with zipfile.ZipFile(file_path) as zin:
+            src = (zin, self._content_types(zin), {})
+            doc_part = self._main_part(zin)
+            rels = read_rels(zin, doc_part)
+            if not self.inherited:
+                self._init_package(src, rels)
+            self.segment = {
+                "key": self.segment_key, "parts": [], "media": {}, "first": self.file_count == 0,
+                "num": [self.num_offset], "abstract": [self.abstract_offset],
+            }
+            doc_rels_start = len(self.doc_rels.items)
+            note_rels_start = {kind: len(v[1].items) if v else 0 for kind, v in self.notes.items()}
+            note_start = dict(self.note_offset)
+            map_num = self._merge_numbering(zin, rels)
+            model = PAGE_ESTIMATORS[estimator](self._merge_styles(zin, rels, map_num))
+            notes = self._merge_notes(src, rels, map_num)
+
+            body_start = self.body.tell()
+            ctx = {
+                "src": src, "rels": rels, "rid_map": {}, "map_num": map_num, "notes": notes,
+                "id_base": self.id_offset + 1, "max_id": self.id_offset + 1, "new_page": self.file_count > 0,
+                "model": model, "elements": 0, "revisions": 0,
+            }
+            try:
+                self._begin_file(ctx["id_base"], bookmark_name)
+                ctx["id_base"] += 1
+                ctx["max_id"] = ctx["id_base"]
+                segment_start = self.body.tell()
+                final_sectpr = self._stream_body(zin, doc_part, ctx)
+            except Exception:
+                # 回滚本文件已写出的正文；本文件的部件不登记为去重目标
+                self.body.seek(body_start)
+                self.body.truncate()
+                self.segment = None
+                self.segment_media.clear()
+                raise
+        self.pending_sectpr = self._serialize(final_sectpr) if final_sectpr is not None else None
+        pages = model.finish(final_sectpr)
+        segment = self.segment
+        segment.update({
+            "body": [segment_start, self.body.tell()],
+            "pages": pages,
+            "elements": ctx["elements"],
+            "revisions": ctx["revisions"],
+            "doc_rels": self.doc_rels.items[doc_rels_start:],
+            "note_rels": {kind: v[1].items[note_rels_start[kind]:] for kind, v in self.notes.items() if v},
+            "notes": {kind: [note_start[kind], self.note_offset[kind]] for kind in self.notes},
+            "ids": [self.id_offset + 1, ctx["max_id"]],
+            "sectpr": self.pending_sectpr.decode("utf-8") if self.pending_sectpr is not None else None,
+        })
+        segment["num"].append(self.num_offset)
+        segment["abstract"].append(self.abstract_offset)
+        self.segments.append(segment)
+        self.segment = None
+        for digest, entry in self.segment_media.items():
+            self.media.setdefault(digest, entry)
+        self.segment_media.clear()
+        self.id_offset = ctx["max_id"]
+        self.file_count += 1
+        return pages
+
+    def _begin_file(self, bookmark_id, bookmark_name):
+        """写出上一个文件的分节符和本文件的书签"""
+        # 上一个文件的节属性变成分节符段落，保留各自的页面设置和页眉页脚
+        if self.pending_sectpr is not None:
+            self.body.write(b"<w:p><w:pPr>" + self.pending_sectpr + b"</w:pPr></w:p>")
+        self.body.write(
+            f'<w:bookmarkStart w:id="{bookmark_id}" w:name="{bookmark_name}"/><w:bookmarkEnd w:id="{bookmark_id}"/>'.encode("utf-8")
+        )
+
+    def _write_element(self, elem, ctx):
+        ctx["model"].feed(elem)
+        ctx["elements"] += 1
+        self.body.write(self._serialize(elem))
+
+    def _stream_body(self, zin, doc_part, ctx):
+        final_sectpr = None
+        body = None
+        pending = None  # 段落标记被删除、等读到下一段再合并的段落
+        with zin.open(doc_part) as f:
+            for _, elem in etree.iterparse(f, events=("end",), huge_tree=True):
+                parent = elem.getparent()
+                if parent is None or parent.tag != w("body"):
+                    continue
+                if body is None:
+                    body = parent
+                    root = body.getparent()
+                    for prefix, uri in root.nsmap.items():
+                        if prefix:
+                            self.root_ns.setdefault(prefix, uri)
+                    for prefix in (root.get(f"{{{MC_NS}}}Ignorable") or "").split():
+                        if prefix not in self.ignorable:
+                            self.ignorable.append(prefix)
+                if elem.tag == w("sectPr"):
+                    final_sectpr = elem
+                    continue
+                if elem.tag in _REVISION_REMOVED:
+                    ctx["revisions"] += 1  # 正文顶层的删除内容或批注锚点
+                    body.remove(elem)
+                    continue
+                # 段落标记被删除的段落先缓冲，读到下一段后并入，与“接受所有修订”的结果相同
+                mark_deleted = paragraph_mark_deleted(elem)
+                self._rewrite(elem, ctx)
+                body.remove(elem)
+                if pending is not None:
+                    if elem.tag == w("p"):
+                        join_paragraphs(pending, elem)
+                    else:
+                        self._write_element(pending, ctx)
+                    pending = None
+                if mark_deleted:
+                    pending = elem
+                    continue
+                self._write_element(elem, ctx)
+        if pending is not None:
+            self._write_element(pending, ctx)
+        if final_sectpr is not None:
+            self._rewrite(final_sectpr, ctx)
+        return final_sectpr
+
+    # ---- 增量合并 ----
+
+    # 每次都会重新生成的部件
+    REGENERATED_PARTS = {
+        "word/document.xml", "word/_rels/document.xml.rels", "word/styles.xml", "word/numbering.xml",
+        "word/footnotes.xml", "word/endnotes.xml", "word/_rels/footnotes.xml.rels",
+        "word/_rels/endnotes.xml.rels", "[Content_Types].xml", "_rels/.rels",
+    }
+
+    def reuse(self, old_path, manifest, kept):
+        """以上一次的输出为基础：继承包级部件、样式、编号和未变化段的脚注，供append_segment复用"""
+        self.old_zip = zipfile.ZipFile(old_path)
+        self.old_doc = tempfile.TemporaryFile()
+        with self.old_zip.open("word/document.xml") as f:
+            shutil.copyfileobj(f, self.old_doc, 1024 * 1024)
+        self.old_body_offset = manifest["body_offset"]
+        self.old_defaults, self.old_overrides = self._content_types(self.old_zip)
+        self.inherited = True
+        self.root_ns.update(manifest["root_ns"])
+        self.ignorable = list(manifest["ignorable"])
+        self.num_offset = manifest["num_offset"]
+        self.abstract_offset = manifest["abstract_offset"]
+        self.note_offset = dict(manifest["note_offset"])
+        self.id_offset = manifest["id_offset"]
+        self.used_keys.update(f["key"] for f in manifest["files"])
+
+        # 包级部件（settings、主题等）原样拷贝，旧的段部件只拷贝仍然保留的
+        segment_parts = {name for f in manifest["files"] for name in f["parts"]}
+        for name in self.old_zip.namelist():
+            if name not in segment_parts and name not in self.REGENERATED_PARTS:
+                self._copy_old_part(name)
+        rels_root = etree.fromstring(self.old_zip.read("word/_rels/document.xml.rels"))
+        for rel in rels_root.iter(f"{{{PKG_RELS_NS}}}Relationship"):
+            if "_" not in rel.get("Id") and self._short_type(rel.get("Type")) in self.INHERITED_TYPES:
+                self.doc_rels.items.append((rel.get("Id"), rel.get("Type"), rel.get("Target"), rel.get("TargetMode") == "External"))
+
+        if "word/styles.xml" in self.old_zip.NameToInfo:
+            self.styles = etree.fromstring(self.old_zip.read("word/styles.xml"))
+            self.style_ids = {s.get(w("styleId")) for s in self.styles.iter(w("style"))}
+        if "word/numbering.xml" in self.old_zip.NameToInfo:
+            # 编号定义体积很小，全部保留，保证样式里引用的编号仍然有效
+            root = etree.fromstring(self.old_zip.read("word/numbering.xml"))
+            self.numbering_ns = root.nsmap
+            self.abstract_nums = root.findall(w("abstractNum"))
+            self.nums = root.findall(w("num"))
+        for kind in self.notes:
+            if f"word/{kind}.xml" not in self.old_zip.NameToInfo:
+                continue
+            root = etree.fromstring(self.old_zip.read(f"word/{kind}.xml"))
+            ranges = [f["notes"][kind] for f in kept]
+            out_root = etree.Element(root.tag, nsmap=root.nsmap)
+            for note in list(root):
+                note_id = int(note.get(w("id")))
+                if note.get(w("type")) or any(lo < note_id <= hi for lo, hi in ranges):
+                    out_root.append(note)
+            self.notes[kind] = (out_root, _Rels(f"word/{kind}.xml"))
+
+    def _copy_old_part(self, name):
+        if name in self.written:
+            return  # 去重后多个段共用的部件
+        if self.update_fields and name == "word/settings.xml":
+            self._write_settings(self.old_zip.read(name), name)
+            return
+        self.written.add(name)
+        self._write_member(self.old_zip, self.old_zip.getinfo(name), name)
+        if "/" + name in self.old_overrides:
+            self.overrides["/" + name] = self.old_overrides["/" + name]
+        ext = posixpath.splitext(name)[1][1:].lower()
+        if ext not in self.defaults and ext in self.old_defaults:
+            self.defaults[ext] = self.old_defaults[ext]
+
+    def append_segment(self, segment, bookmark_name):
+        """把上一次输出中未变化的段按字节原样拷贝过来，返回估计页数
+
+        段的图片等部件全部拷贝完成后才登记为去重目标，失败的段不会被后面的输入引用。
+        """
+        body_start = self.body.tell()
+        try:
+            self._begin_file(self.id_offset + 1, bookmark_name)
+            start = self.body.tell()
+            old_start, old_end = segment["body"]
+            self.old_doc.seek(self.old_body_offset + old_start)
+            remaining = old_end - old_start
+            while remaining:
+                chunk = self.old_doc.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise ValueError("上一次的输出不完整")
+                self.body.write(chunk)
+                remaining -= len(chunk)
+            for name in segment["parts"]:
+                self._copy_old_part(name)
+        except Exception:
+            self.body.seek(body_start)
+            self.body.truncate()
+            raise
+        self.id_offset += 1
+        for name, digest in segment.get("media", {}).items():
+            self.media.setdefault(digest, (name, (self.old_zip.filename, name)))
+        self.doc_rels.items.extend(tuple(item) for item in segment["doc_rels"])
+        for kind, items in segment["note_rels"].items():
+            if self.notes.get(kind):
+                self.notes[kind][1].items.extend(tuple(item) for item in items)
+        self.pending_sectpr = segment["sectpr"].encode("utf-8") if segment["sectpr"] is not None else None
+        self.segments.append(dict(segment, body=[start, self.body.tell()], first=self.file_count == 0))
+        self.file_count += 1
+        return segment["pages"]
+
+    def state(self):
+        """写入增量合并清单的全局状态"""
+        return {
+            "body_offset": self.body_offset,
+            "root_ns": self.root_ns,
+            "ignorable": self.ignorable,
+            "num_offset": self.num_offset,
+            "abstract_offset": self.abstract_offset,
+            "note_offset": self.note_offset,
+            "id_offset": self.id_offset,
+        }
+
+    def close(self, toc_xml=None):
+        """写出document.xml和全部共享部件，toc_xml为插在正文最前面的目录"""
+        zout = self.zout
+        ns_decl = "".join(f' xmlns:{p}="{xml_escape(u)}"' for p, u in self.root_ns.items())
+        ignorable = " ".join(p for p in self.ignorable if p in self.root_ns)
+        if ignorable:
+            ns_decl += f' mc:Ignorable="{ignorable}"' if self.root_ns.get("mc") == MC_NS else ""
+        head = f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document{ns_decl}><w:body>'.encode("utf-8")
+        head += toc_xml.encode("utf-8") if toc_xml else b""
+        self.body_offset = len(head)  # 正文在document.xml中的起始字节位置
+        with zout.open("word/document.xml", "w", force_zip64=True) as out:
+            out.write(head)
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, out, 1024 * 1024)
+            if self.pending_sectpr is not None:
+                out.write(self.pending_sectpr)
+            out.write(b"</w:body></w:document>")
+        self.body.close()
+
+        if self.styles is not None:
+            zout.writestr("word/styles.xml", etree.tostring(self.styles, xml_declaration=True, encoding="UTF-8", standalone=True))
+            self.doc_rels.add(RT_PREFIX + "styles", "word/styles.xml")
+            self.overrides["/word/styles.xml"] = CT_PREFIX + "styles+xml"
+        if self.nums:
+            if self.dedupe:
+                self.abstract_nums = dedupe_abstract_nums(self.abstract_nums, self.nums)
+            root = etree.Element(w("numbering"), nsmap=self.numbering_ns)
+            root.extend(self.abstract_nums + self.nums)
+            zout.writestr("word/numbering.xml", etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True))
+            self.doc_rels.add(RT_PREFIX + "numbering", "word/numbering.xml")
+            self.overrides["/word/numbering.xml"] = CT_PREFIX + "numbering+xml"
+        for kind, value in self.notes.items():
+            if value is None:
+                continue
+            root, rels = value
+            zout.writestr(f"word/{kind}.xml", etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True))
+            if rels.items:
+                zout.writestr(rels.rels_name(), rels.xml())
+            self.doc_rels.add(RT_PREFIX + kind, f"word/{kind}.xml")
+            self.overrides[f"/word/{kind}.xml"] = CT_PREFIX + f"{kind}+xml"
+
+        zout.writestr("word/_rels/document.xml.rels", self.doc_rels.xml())
+        package_rels = _Rels("")
+        package_rels.items.append(("rId1", RT_OFFICE_DOCUMENT, "word/document.xml", False))
+        zout.writestr("_rels/.rels", package_rels.xml())
+
+        types = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Types xmlns="{CT_NS}">']
+        types += [f'<Default Extension="{e}" ContentType="{t}"/>' for e, t in self.defaults.items()]
+        types += [f'<Override PartName="{xml_escape(p)}" ContentType="{t}"/>' for p, t in self.overrides.items()]
+        types.append("</Types>")
+        zout.writestr("[Content_Types].xml", "".join(types).encode("utf-8"))
+        zout.close()
+        self._close_old()
+        os.replace(self.partial_path, self.output_path)
+
+    def _close_old(self):
+        if self.old_zip is not None:
+            self.old_zip.close()
+            self.old_doc.close()
+            self.old_zip = None
+
+    def abort(self):
+        """放弃输出并删除不完整的文件，上一次的输出保持不变"""
+        self.body.close()
+        self.zout.close()
+        self._close_old()
+        try:
+            os.remove(self.partial_path)
+        except OSError:
+            pass
+
+
+# ---- Word COM ----
+
+WD_PAGE_BREAK = 7  # wdPageBreak
+WD_ACTIVE_END_PAGE_NUMBER = 3  # wdActiveEndPageNumber
+WD_FORMAT_DOCUMENT_DEFAULT = 16  # wdFormatDocumentDefault (.docx)
+# 出现这些标记说明.docx里有修订或批注，插入前要先接受修订、去掉批注
+REVISION_MARKERS = (
+    b"<w:ins ", b"<w:del ", b"<w:moveFrom ", b"<w:moveTo ", b"<w:rPrChange", b"<w:pPrChange", b"<w:commentReference ",
+)
+# 接受修订时要改写的部件类型
+REVISION_PART_TYPES = ("header", "footer", "footnotes", "endnotes")
+
+
+def docx_has_revisions(file_path):
+    """不启动Word，直接在document.xml里查找修订标记；无法判断时返回None"""
+    try:
+        with zipfile.ZipFile(file_path) as z:
+            data = z.read("word/document.xml")
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+    return any(marker in data for marker in REVISION_MARKERS)
+
+
+def accept_package_revisions(src, dst):
+    """不启动Word，把src接受全部修订、去掉批注后写入dst，返回处理的修订数
+
+    只解析正文、页眉页脚和脚注尾注部件，其余部件原样拷贝。
+    """
+    count = 0
+    with DocxPackage(src) as package, zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED) as zout:
+        main = package.main_part
+        rewritten = {main}
+        settings = None
+        for reltype, target, external in package.rels(main).values():
+            if external:
+                continue
+            if reltype.startswith(RT_PREFIX) and reltype[len(RT_PREFIX):] in REVISION_PART_TYPES:
+                rewritten.add(target)
+            elif reltype == RT.SETTINGS:
+                settings = target
+        comment_rels = _rels_name(main)
+        for info in package.zip.infolist():
+            name = info.filename
+            if name in rewritten or name == settings:
+                root = package.xml(name)
+                if name == settings:
+                    disable_track_revisions(root)
+                else:
+                    count += accept_revisions(root)
+                data = etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+            elif name == comment_rels:
+                # 去掉指向批注部件的关系，批注部件成为孤立部件，Word和python-docx都不会读取
+                root = package.xml(name)
+                for rel in list(root):
+                    if rel.get("Type") in COMMENT_RELATIONSHIPS:
+                        root.remove(rel)
+                data = etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+            else:
+                data = package.read(name)
+            zout.writestr(info, data, compress_type=info.compress_type)
+    return count
+
+
+def word_application(name="word"):
+    """创建Word应用对象：word为真实的Word COM，fake为测试用的替身"""
+    if name == "fake":
+        return FakeWordApplication()
+    return _win32().gencache.EnsureDispatch("Word.Application")
+
+
+class WordComMerger:
+    """通过Word COM合并：Range.InsertFile直接插入文件，不经过剪贴板
+
+    有修订的文件先在临时副本里接受修订再插入；书签在全部插入后一次性添加，
+    页码在最后从书签位置读取一次，合并过程中不反复分页。
+    word 为Word应用对象（真实COM或FakeWordApplication），便于在没有Word的系统上测试。
+    """
+
+    def __init__(self, word, log, profiler=None):
+        self.word = word
+        self.log = log
+        self.profiler = profiler or NULL_PROFILER
+        self.temp_dir = None
+
+    def prepare(self, file_path):
+        """返回可以直接插入的文件路径；有修订时生成接受修订后的临时副本"""
+        has_revisions = docx_has_revisions(file_path) if file_path.lower().endswith(".docx") else None
+        if has_revisions is False:
+            return file_path
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.mkdtemp(prefix="merge_word_com_")
+        temp_path = os.path.join(self.temp_dir, f"{len(os.listdir(self.temp_dir))}.docx")
+        if has_revisions:
+            # .docx直接改写XML接受修订，不需要在Word里打开
+            try:
+                count = accept_package_revisions(file_path, temp_path)
+                self.log(f"已接受修订：{os.path.basename(file_path)}（{count} 处）")
+                return temp_path
+            except Exception as e:
+                self.log(f"改写修订失败，改用Word接受修订：{str(e)}")
+        doc = self.word.Documents.Open(file_path, ReadOnly=True, AddToRecentFiles=False, Visible=False)
+        try:
+            if not doc.Revisions.Count:
+                return file_path
+            doc.TrackRevisions = False
+            doc.Revisions.AcceptAll()
+            doc.SaveAs(temp_path, WD_FORMAT_DOCUMENT_DEFAULT)
+            self.log(f"已接受修订：{os.path.basename(file_path)}")
+            return temp_path
+        finally:
+            doc.Close(SaveChanges=False)
+
+    def merge(self, files, output_path, job, progress, exact_pages=True):
+        """按顺序插入files，保存到output_path，返回 {文件路径: (书签名, 页码)}"""
+        self.word.Visible = False
+        self.word.ScreenUpdating = False
+        merged = self.word.Documents.Add()
+        try:
+            merged.TrackRevisions = False
+            # 添加一个空白页用于目录
+            merged.Content.InsertAfter("\n")
+            starts = []
+            for i, file_path in enumerate(files):
+                job.check()
+                self.log(f"正在合并文件：{os.path.basename(file_path)}")
+                try:
+                    with self.profiler.span("append", file_path, bytes=os.path.getsize(file_path)):
+                        source = self.prepare(file_path)
+                        start = merged.Content.End - 1
+                        merged.Range(start, start).InsertFile(source)
+                        # 添加分页符（除了最后一个文档）
+                        if i < len(files) - 1:
+                            end = merged.Content.End - 1
+                            merged.Range(end, end).InsertBreak(WD_PAGE_BREAK)
+                    # 后面的文件都插在这个位置之后，记录的位置在合并结束前一直有效
+                    starts.append((file_path, f"bookmark_{i+1}", start))
+                    self.log(f"成功合并：{os.path.basename(file_path)}")
+                except MergeCancelled:
+                    raise
+                except Exception as e:
+                    self.log(f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}")
+                progress(i + 1, len(files), file_path)
+
+            for _, bookmark_name, start in starts:
+                merged.Bookmarks.Add(bookmark_name, merged.Range(start, start))
+            with self.profiler.span("page_estimate"):
+                if exact_pages:
+                    merged.Repaginate()
+                pages = {
+                    file_path: (bookmark_name, merged.Bookmarks(bookmark_name).Range.Information(WD_ACTIVE_END_PAGE_NUMBER))
+                    for file_path, bookmark_name, _ in starts
+                }
+
+            self.log("保存合并后的文档...")
+            with self.profiler.span("save"):
+                merged.SaveAs(output_path)
+            return pages
+        finally:
+            merged.Close(SaveChanges=False)
+            if self.temp_dir is not None:
+                shutil.rmtree(self.temp_dir, ignore_errors=True)
+                self.temp_dir = None
+
+
+class _FakeRange:
+    def __init__(self, document, start, end):
+        self.document = document
+        self.Start = start
+        self.End = end
+
+    def InsertAfter(self, text):
+        self.document._insert(self.End - 1, ("text", text, len(text)))
+
+    def InsertFile(self, file_path):
+        self.document._insert(self.Start, ("file", file_path, None))
+
+    def InsertBreak(self, kind):
+        self.document._insert(self.Start, ("break", kind, 1))
+
+    def Information(self, kind):
+        if kind != WD_ACTIVE_END_PAGE_NUMBER:
+            raise NotImplementedError(kind)
+        return self.document._page_at(self.Start)
+
+
+class _FakeBookmarks:
+    def __init__(self):
+        self.items = {}
+
+    def Add(self, name, rng):
+        self.items[name] = rng
+
+    def __call__(self, name):
+        return _FakeBookmark(self.items[name])
+
+
+class _FakeBookmark:
+    def __init__(self, rng):
+        self.Range = rng
+
+
+class _FakeRevisions:
+    def __init__(self, count):
+        self.Count = count
+
+    def AcceptAll(self):
+        self.Count = 0
+
+
+class _FakeDocument:
+    """测试用的Word文档：只记录插入的内容，保存时用FastComposer生成.docx"""
+
+    def __init__(self, file_path=None):
+        self.path = file_path
+        self.segments = []  # (类型, 内容, 长度, 页数)
+        self.Bookmarks = _FakeBookmarks()
+        self.Revisions = _FakeRevisions(int(bool(file_path and docx_has_revisions(file_path))))
+        self.TrackRevisions = False
+
+    @property
+    def Content(self):
+        return _FakeRange(self, 0, self._length() + 1)
+
+    def Range(self, start, end):
+        return _FakeRange(self, start, end)
+
+    def _length(self):
+        return sum(segment[2] for segment in self.segments)
+
+    def _insert(self, position, segment):
+        if position != self._length():
+            raise NotImplementedError("FakeWordApplication只支持在文档末尾插入")
+        kind, value, length = segment
+        pages = 0
+        if kind == "file":
+            texts, pages = scan_docx(value)
+            length = max(1, len(texts))
+        self.segments.append((kind, value, length, pages))
+
+    def _page_at(self, position):
+        page, offset = 1, 0
+        for kind, _, length, pages in self.segments:
+            if offset >= position:
+                break
+            page += max(pages - 1, 0) if kind == "file" else int(kind == "break")
+            offset += length
+        return page
+
+    def Repaginate(self):
+        pass
+
+    def SaveAs(self, file_path, file_format=None):
+        if self.path is not None:
+            shutil.copyfile(self.path, file_path)
+            return
+        composer = FastComposer(Document())
+        bookmark_id = BOOKMARK_ID_BASE
+        bookmarks = {}
+        for name, rng in self.Bookmarks.items.items():
+            bookmarks.setdefault(rng.Start, []).append(name)
+        offset = 0
+        for kind, value, length, _ in self.segments:
+            if kind == "file":
+                doc = Document(value)
+                for name in bookmarks.get(offset, ()):
+                    add_bookmark(doc.element.body, name, bookmark_id)
+                    bookmark_id += 1
+                composer.append(doc)
+            offset += length
+        save_document(composer.doc, file_path)
+
+    def Close(self, SaveChanges=False):
+        pass
+
+
+class _FakeDocuments:
+    def Add(self):
+        return _FakeDocument()
+
+    def Open(self, file_path, **kwargs):
+        return _FakeDocument(file_path)
+
+
+class FakeWordApplication:
+    """测试用的Word COM替身，实现WordComMerger用到的接口，页码按估算的页数计算"""
+
+    def __init__(self):
+        self.Visible = True
+        self.ScreenUpdating = True
+        self.Documents = _FakeDocuments()
+
+    def Quit(self):
+        pass
+
+
+# ---- 文件发现 ----
+
+DOC_EXTENSIONS = (".doc", ".docx")
+OUTPUT_DIR_NAME = "合并结果"  # 默认输出目录，发现文件时跳过
+ORDER_FILE_NAME = "合并顺序.txt"  # 目录中存在时作为默认的顺序文件
+SORT_ORDERS = ("natural", "name", "mtime")
+
+# 一个输入文件及发现时取得的stat信息，字段名与os.stat_result一致，后续阶段直接复用
+FileEntry = namedtuple("FileEntry", "path rel st_size st_mtime_ns")
+
+CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+CN_UNITS = {"十": 10, "百": 100, "千": 1000, "万": 10000}
+# 阿拉伯数字（含全角），以及“第十章”“十二、”这类位于开头或“第”之后的中文数字
+_NUMBER_RE = re.compile(
+    r"(\d+)|(?:(?<=第)|^)([零〇一二两三四五六七八九十百千万]+)(?=[章节篇卷部册回课讲集期条、.．\s_\-]|$)"
+)
+
+
+def chinese_to_int(text):
+    """中文数字转整数，如 十二 -> 12，一百零五 -> 105，二〇二四 -> 2024"""
+    if all(c in CN_DIGITS for c in text):
+        # 逐位书写的数字（二〇二四）
+        value = 0
+        for c in text:
+            value = value * 10 + CN_DIGITS[c]
+        return value
+    total, section, digit = 0, 0, 0
+    for c in text:
+        if c in CN_DIGITS:
+            digit = CN_DIGITS[c]
+        elif c == "万":
+            total += (section + digit) * 10000
+            section, digit = 0, 0
+        else:
+            section += (digit or 1) * CN_UNITS[c]  # “十二”省略了前面的“一”
+            digit = 0
+    return total + section + digit
+
+
+def natural_key(name):
+    """自然排序键：数字按数值比较，“第十章”排在“第九章”之后，其余部分忽略大小写
+
+    先比较去掉扩展名的部分，扩展名只在最后用来区分，这样“报告.docx”排在“报告(1).docx”之前。
+    """
+    stem, ext = os.path.splitext(name)
+    return _natural_parts(stem), _natural_parts(ext)
+
+
+def _natural_parts(name):
+    key = []
+    pos = 0
+    for match in _NUMBER_RE.finditer(name):
+        if match.start() > pos:
+            key.append((1, 0, name[pos:match.start()].casefold()))
+        number = int(match.group(1)) if match.group(1) else chinese_to_int(match.group(2))
+        key.append((0, number, ""))
+        pos = match.end()
+    if pos < len(name):
+        key.append((1, 0, name[pos:].casefold()))
+    return key
+
+
+def _matches(rel, patterns):
+    name = posixpath.basename(rel)
+    return any(fnmatch.fnmatch(rel, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def read_order_file(order_file):
+    """读取顺序文件：每行一个文件名或相对路径，空行和 # 开头的行忽略"""
+    with open(order_file, encoding="utf-8-sig") as f:
+        lines = [line.strip() for line in f]
+    return [line.replace("\\", "/") for line in lines if line and not line.startswith("#")]
+
+
+def discover_files(directory, recursive=False, include=(), exclude=(), sort="natural", order_file=None):
+    """用os.scandir列出目录中的Word文档，返回FileEntry列表
+
+    recursive 为True时包含子目录（跳过“合并结果”输出目录）；include/exclude 是匹配相对路径
+    或文件名的通配符；sort 为 natural（自然排序，默认）、name（按字符）或 mtime（按修改时间）。
+    order_file 中列出的文件按列出的顺序排在最前，其余文件按 sort 排在后面；没有指定时使用
+    目录中的“合并顺序.txt”（如果存在）。
+    """
+    entries = []
+    stack = [(directory, "")]
+    while stack:
+        path, prefix = stack.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = prefix + entry.name
+                # 与os.walk一样不进入指向目录的符号链接，避免链接成环时无限递归、同一目录被列出多次
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and entry.name != OUTPUT_DIR_NAME:
+                        stack.append((entry.path, rel + "/"))
+                    continue
+                if not entry.name.lower().endswith(DOC_EXTENSIONS) or entry.name.startswith("~$"):
+                    continue
+                if not entry.is_file():
+                    continue  # 指向目录的链接或失效的链接
+                if include and not _matches(rel, include):
+                    continue
+                if exclude and _matches(rel, exclude):
+                    continue
+                # Windows上scandir的stat来自目录列表本身，不需要再访问文件
+                stat = entry.stat()
+                entries.append(FileEntry(os.path.abspath(entry.path), rel, stat.st_size, stat.st_mtime_ns))
+
+    if sort == "mtime":
+        entries.sort(key=lambda e: (e.st_mtime_ns, natural_key(e.rel)))
+    elif sort == "name":
+        entries.sort(key=lambda e: e.rel)
+    else:
+        entries.sort(key=lambda e: [natural_key(part) for part in e.rel.split("/")])
+
+    if order_file is None and os.path.isfile(os.path.join(directory, ORDER_FILE_NAME)):
+        order_file = os.path.join(directory, ORDER_FILE_NAME)
+    if order_file:
+        by_name = {}
+        for e in entries:
+            by_name.setdefault(e.rel.casefold(), e)
+            by_name.setdefault(posixpath.basename(e.rel).casefold(), e)
+        ordered = []
+        for line in read_order_file(order_file):
+            e = by_name.get(line.casefold())
+            if e is not None and e not in ordered:
+                ordered.append(e)
+        listed = set(ordered)
+        entries = ordered + [e for e in entries if e not in listed]
+    return entries
+
+
+def file_entries(paths):
+    """按给定顺序为明确列出的文件生成FileEntry，跳过不存在的、重复的和不是Word文档的文件"""
+    entries = []
+    seen = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if path in seen or not path.lower().endswith(DOC_EXTENSIONS) or not os.path.isfile(path):
+            continue
+        seen.add(path)
+        stat = os.stat(path)
+        entries.append(FileEntry(path, os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return entries
+
+
+# ---- 重复输入检测 ----
+
+SHINGLE_SIZE = 5  # 按字符切分的片段长度，中文没有空格分词，按字符比按词稳定
+MINHASH_SIZE = 128  # MinHash 签名的桶数：片段哈希按高位分桶，每桶保留最小值
+LSH_BANDS = 32  # LSH 把签名分成的段数，任一段完全相同的文件才比较相似度
+MIN_SHINGLES = 20  # 片段太少的短文档不做近似比较，避免封面之类的短文档互相误判
+_EMPTY_BUCKET = 1 << 32  # 没有片段落入的桶
+
+
+def package_key(file_path):
+    """不解压的包指纹：word/下各部件在zip目录中记录的CRC和大小；不是zip时用文件哈希"""
+    try:
+        with zipfile.ZipFile(file_path) as z:
+            entries = sorted(
+                (info.filename, info.CRC, info.file_size) for info in z.infolist() if info.filename.startswith("word/")
+            )
+    except (OSError, zipfile.BadZipFile):
+        return "sha256:" + file_sha256(file_path)
+    if not any(name == "word/document.xml" for name, _, _ in entries):
+        return "sha256:" + file_sha256(file_path)
+    return "zip:" + hashlib.sha1(repr(entries).encode("utf-8")).hexdigest()
+
+
+def normalized_text(file_path):
+    """提取正文各段文字并规范化（全半角、大小写、空白），无法读取或没有正文部件时返回None"""
+    paragraphs = []
+    try:
+        with zipfile.ZipFile(file_path) as z, z.open("word/document.xml") as f:
+            for _, p in etree.iterparse(f, events=("end",), tag=w("p"), huge_tree=True):
+                text = "".join(t.text or "" for t in p.iter(w("t")))
+                text = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip().lower()
+                if text:
+                    paragraphs.append(text)
+                p.clear()
+    except (OSError, KeyError, zipfile.BadZipFile, etree.XMLSyntaxError):
+        return None
+    return "\n".join(paragraphs)
+
+
+def minhash(text):
+    """文本的MinHash签名（单次哈希分桶）：每个桶中最小的片段哈希，片段太少时返回None"""
+    hashes = {zlib.crc32(text[i:i + SHINGLE_SIZE].encode("utf-8")) for i in range(len(text) - SHINGLE_SIZE + 1)}
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    shift = 32 - (MINHASH_SIZE - 1).bit_length()
+    mask = (1 << shift) - 1
+    signature = [_EMPTY_BUCKET] * MINHASH_SIZE
+    for h in hashes:
+        bucket = h >> shift
+        if h & mask < signature[bucket]:
+            signature[bucket] = h & mask
+    return tuple(signature)
+
+
+def minhash_similarity(a, b):
+    """由两个签名估计Jaccard相似度：至少一边非空的桶中最小值相同的比例"""
+    used = [(x, y) for x, y in zip(a, b) if x != _EMPTY_BUCKET or y != _EMPTY_BUCKET]
+    return sum(1 for x, y in used if x == y) / len(used) if used else 0.0
+
+
+def minhash_bands(signature):
+    """签名的LSH分段键，全空的段不参与分桶"""
+    rows = MINHASH_SIZE // LSH_BANDS
+    for band in range(LSH_BANDS):
+        values = signature[band * rows:(band + 1) * rows]
+        if any(v != _EMPTY_BUCKET for v in values):
+            yield band, values
+
+
+def _keep_order(file_paths, stat=os.stat):
+    """决定重复文件中保留哪一个：文件名最短的优先，其次修改时间最早的，再按输入顺序"""
+    def key(item):
+        index, file_path = item
+        try:
+            mtime = stat(file_path).st_mtime_ns
+        except OSError:
+            mtime = float("inf")
+        return len(os.path.basename(file_path)), mtime, index
+
+    return sorted(enumerate(file_paths), key=key)
+
+
+def find_duplicates(file_paths, similarity=0.9, profiler=None, stat=os.stat):
+    """找出重复的输入，返回 [(文件, 与之重复的文件, 类型, 相似度)]，按输入顺序排列
+
+    一组重复文件中保留文件名最短的（同样长时保留修改时间最早的），其余的报告为重复，
+    所以“报告.docx”和“报告(1).docx”中保留前者，与它们的排序无关。
+    先比较不解压的包指纹（identical），再比较规范化后的正文哈希（text），最后用MinHash
+    找正文高度相似的文件（near，相似度不低于similarity；similarity为1时不检测）。
+    近似比较只在LSH分段相同的候选之间进行，不必两两比较所有文件。
+    stat 用来取修改时间，合并引擎传入使用发现阶段缓存的版本。
+    """
+    profiler = profiler or NULL_PROFILER
+    by_package = {}
+    by_text = {}
+    sketches = {}
+    bands = defaultdict(list)
+    duplicates = []
+    for index, file_path in _keep_order(file_paths, stat):
+        with profiler.span("fingerprint", file_path) as record:
+            key = package_key(file_path)
+            if key in by_package:
+                duplicates.append((index, (file_path, by_package[key], "identical", 1.0)))
+                record["duplicate"] = True
+                continue
+            by_package[key] = file_path
+            text = normalized_text(file_path)
+            if not text:
+                continue
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            if digest in by_text:
+                duplicates.append((index, (file_path, by_text[digest], "text", 1.0)))
+                record["duplicate"] = True
+                continue
+            by_text[digest] = file_path
+            sketch = minhash(text) if similarity < 1 else None
+            if sketch is None:
+                continue
+            keys = list(minhash_bands(sketch))
+            candidates = {path for band in keys for path in bands[band]}
+            best = max(((minhash_similarity(sketch, sketches[path]), path) for path in candidates), default=(0, None))
+            if best[0] >= similarity:
+                duplicates.append((index, (file_path, best[1], "near", round(best[0], 3))))
+                record["duplicate"] = True
+                continue
+            sketches[file_path] = sketch
+            for band in keys:
+                bands[band].append(file_path)
+    duplicates.sort(key=lambda item: item[0])
+    return [found for _, found in duplicates]
+
+
+class MergeEngine:
+    """合并引擎，包含全部合并算法，不依赖任何图形界面"""
+
+    def __init__(self, log=None, progress=None, workers=None, page_estimator="layout", word_pages="exact",
+                 converter="auto", converter_workers=DEFAULT_CONVERTER_WORKERS, recycle_after=50, cache_dir=None, cache_size=2 * 1024 ** 3,
+                 incremental=False, report=True, trace=False, resume=True, checkpoint_interval=60,
+                 converter_slots=None, subdirs=False, include=(), exclude=(), sort="natural", order_file=None,
+                 dedupe=True, compresslevel=None, word_app="word", toc_pages="static",
+                 split_bytes=None, split_pages=None, split_files=None, split_index=False, duplicates="off", similarity=0.9,
+                 converter_pool=None):
+        self.log_sink = log  # 日志回调，接收一行文本
+        self.progress_sink = progress  # 进度回调，接收(已完成数, 总数, 文件路径)
+        self.workers = workers or os.cpu_count() or 1  # 并行解析的线程数
+        self.page_estimator = page_estimator  # 页数估算模型，见PAGE_ESTIMATORS
+        self.word_pages = word_pages  # Word COM路径的页码：exact读取前完整重新分页一次，fast直接读取书签页码
+        self.converter = converter  # .doc转换后端：auto、word、libreoffice、fake
+        self.converter_workers = converter_workers  # 常驻转换器实例数
+        self.converter_slots = converter_slots  # 批量合并时全局限制同时转换数的信号量
+        self.subdirs = subdirs  # 是否包含子目录中的文档
+        self.include = include or ()  # 只合并匹配这些通配符的文件
+        self.exclude = exclude or ()  # 跳过匹配这些通配符的文件
+        self.sort = sort  # 文件排序方式，见SORT_ORDERS
+        self.order_file = order_file  # 显式的顺序文件
+        self.file_stats = {}  # 绝对路径 -> 发现时的FileEntry
+        self.dedupe = dedupe  # 保存前合并重复的图片和编号定义
+        self.word_app = word_app  # Word应用：word为真实的Word COM，fake为测试替身
+        # 目录页码：static写入数字，field写成PAGEREF域、打开时更新，update写成域后用转换后端更新一次
+        self.toc_pages = toc_pages
+        self.compresslevel = compresslevel  # XML部件的zlib压缩级别（0-9），None为默认值
+        # 分卷上限：每卷的输入字节数、估算页数、文件数，None表示不限；split_index为True时另写总目录
+        self.split_bytes = split_bytes
+        self.split_pages = split_pages
+        self.split_files = split_files
+        self.split_index = split_index
+        self.volumes = []  # 分卷输出时各卷的路径
+        self.duplicates = duplicates  # 重复输入：off不检测，report只在日志和报告中列出，skip不合并
+        self.similarity = similarity  # 近似重复的相似度阈值，1表示只检测内容完全相同的文件
+        self.duplicate_files = []  # 本次检测到的重复输入
+        self.recycle_after = recycle_after  # 每个实例转换多少个文档后重启
+        self.cache_dir = cache_dir  # 转换缓存目录，默认见default_cache_dir
+        self.cache_size = cache_size  # 转换缓存上限（字节），0表示不使用缓存
+        self.converter_pool = None
+        self.shared_converter_pool = converter_pool  # 合并服务中多个任务共用的常驻转换池，不随本次合并关闭
+        self.incremental = incremental  # 流式合并时根据清单只重新合并变化的文件
+        self.report = report  # 在输出旁写入JSON运行报告
+        self.trace = trace  # 同时写入Chrome trace-event文件
+        self.profiler = NULL_PROFILER  # 每次run时重新创建RunProfiler
+        self.doc_files = []  # 本次合并的输入文件
+        self.resume = resume  # 存在有效的检查点时从中断处继续
+        self.checkpoint_interval = checkpoint_interval  # 写检查点的最短间隔（秒），0表示不写
+        self.job = MergeJob()
+        self.algorithm = None
+        self.resume_state = None  # 本次继续使用的检查点
+        self.converted = {}  # 原.doc路径 -> 转换出的临时.docx，写入检查点
+        self.last_checkpoint = 0
+        self.file_page_map = {}  # 文件页码映射字典
+        self.toc_inserted = False  # 目录是否已在保存前写入
+
+    def log(self, message):
+        """输出日志消息"""
+        if self.log_sink:
+            self.log_sink(message)
+
+    def progress(self, done, total, file_path=""):
+        """报告处理进度"""
+        if self.progress_sink:
+            self.progress_sink(done, total, file_path)
+
+    def collect_files(self, directory, files=None):
+        """获取目录中所有Word文档（过滤掉以~$开头的缓存文件），按设置的方式排序
+
+        给出 files 时不扫描目录，按 files 的顺序合并这些文件。
+        """
+        if files is None:
+            entries = discover_files(directory, self.subdirs, self.include, self.exclude, self.sort, self.order_file)
+        else:
+            entries = file_entries(files)
+            if len(entries) < len(files):
+                self.log(f"跳过 {len(files) - len(entries)} 个不存在、重复或不是Word文档的文件")
+        self.file_stats = {e.path: e for e in entries}
+        return [e.path for e in entries]
+
+    def check_duplicates(self, doc_files):
+        """合并前检测重复输入，skip模式下返回去掉重复文件后的列表"""
+        found = find_duplicates(doc_files, self.similarity, self.profiler, self.stat)
+        labels = {"identical": "完全相同", "text": "正文相同", "near": "正文相似"}
+        for file_path, original, kind, similarity in found:
+            detail = f"，相似度 {similarity:.0%}" if kind == "near" else ""
+            action = "，跳过" if self.duplicates == "skip" else ""
+            self.log(f"重复文件：{os.path.basename(file_path)} 与 {os.path.basename(original)} {labels[kind]}{detail}{action}")
+            self.duplicate_files.append({
+                "path": os.path.abspath(file_path), "duplicate_of": os.path.abspath(original),
+                "kind": kind, "similarity": similarity,
+            })
+        if not found:
+            self.log("没有发现重复文件")
+        if self.duplicates != "skip":
+            return doc_files
+        skipped = {file_path for file_path, _, _, _ in found}
+        return [f for f in doc_files if f not in skipped]
+
+    def stat(self, file_path):
+        """取文件大小和修改时间，优先使用发现阶段缓存的结果"""
+        entry = self.file_stats.get(os.path.abspath(file_path))
+        return entry if entry is not None else os.stat(file_path)
+
+    def pipeline(self, inputs, work=None):
+        """转换、解析和追加重叠进行，按原顺序逐个产出(序号, 原文件路径, 可用的.docx路径, 结果, 错误)
+
+        inputs 来自 submit_inputs，转换已经在转换池中进行；每个文件转换完成后立即在线程池里
+        执行 work(.docx路径)，不等待排在前面的文件，调用方按顺序追加第k个文件时，后面的文件
+        正在转换和解析。用线程池而不是进程池：解析结果是python-docx的文档树，不能pickle
+        传回主进程，在主进程重新加载又占解析时间的九成以上；解析时间中约一半花在lxml解析
+        和zlib解压上，这两步会释放GIL，多核时线程仍能并行这一部分。进入解析的文件最多比
+        调用方取走的多线程数的两倍（背压），避免几百个文档树同时驻留内存。
+        转换失败的文件记录日志后跳过，解析失败的错误交给调用方。
+        """
+        window = self.workers * 2
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        queued = deque(inputs)
+        in_flight = deque()
+        try:
+            while queued or in_flight:
+                while queued and len(in_flight) < window:
+                    i, source_path, converted = queued.popleft()
+                    in_flight.append((i, source_path, converted, chain_future(converted, executor, work)))
+                i, source_path, converted, parsed = in_flight.popleft()
+                self.log(f"正在处理文件：{os.path.basename(source_path)}")
+                try:
+                    file_path = converted.result()
+                except Exception as e:
+                    self.log(f"转换文件失败: {str(e)}")
+                    continue
+                if file_path and file_path != source_path:
+                    self.log(f"成功转换文件：{os.path.basename(source_path)}")
+                try:
+                    result, error = parsed.result(), None
+                except Exception as e:
+                    result, error = None, e
+                yield i, source_path, file_path, result, error
+        finally:
+            # 取消或出错时停止还没有开始的转换和解析，等正在进行的转换结束，调用方才能清理临时文件
+            running = []
+            for item in list(queued) + list(in_flight):
+                if not item[2].cancel():
+                    running.append(item[2])
+                if len(item) > 3:
+                    item[3].cancel()
+            wait(running)
+            executor.shutdown(cancel_futures=True)
+
+    def compose_parsed(self, composer_class, pending, output_path=None, merged_doc=None):
+        """把并行解析的文档按顺序合并，同时记录页码和书签，返回composer，没有有效文件时返回None
+
+        第一个有效的文档本身作为主文档，后面的文档追加到它上面，这样Normal、标题等样式沿用
+        输入的定义，而不是python-docx默认模板的；merged_doc 为从检查点读出的部分结果。
+        pending 为 submit_inputs 返回的 (序号, 原文件路径, 转换的Future) 列表。给出 output_path 时
+        定期写检查点；从检查点继续时页码接着 self.resume_state 往下算。
+        """
+        resume = self.resume_state or {}
+        current_page = resume.get("current_page", 0)
+        done = set(resume.get("done", ()))
+        composer = composer_class(merged_doc) if merged_doc is not None else None
+        checkpoint = None
+        if output_path:
+            def checkpoint():
+                if composer is not None:
+                    self.save_checkpoint(output_path, composer.doc, done, current_page)
+        work = partial(parse_docx, estimator=self.page_estimator, profiler=self.profiler)
+        for n, (i, file_path, _, parsed, error) in enumerate(self.pipeline(pending, work)):
+            self.between_files(checkpoint)
+            bookmark_name = f"bookmark_{i+1}"
+            done.add(i)
+            if error is not None:
+                self.log(f"无法打开文件 {os.path.basename(file_path)}: {str(error)}")
+                continue
+            doc, page_count = parsed
+            self.log(f"成功验证文件：{os.path.basename(file_path)}, 估计页数: {page_count}")
+            try:
+                self.log(f"合并文件：{os.path.basename(file_path)}")
+                with self.profiler.span("append", file_path):
+                    add_bookmark(doc.element.body, bookmark_name, BOOKMARK_ID_BASE + i)
+                    if composer is None:
+                        composer = composer_class(doc)
+                    else:
+                        composer.append(doc)
+                # 记录当前页码和书签
+                self.file_page_map[file_path] = {
+                    'page': current_page,
+                    'bookmark': bookmark_name
+                }
+                current_page += page_count
+                self.log(f"成功合并：{os.path.basename(file_path)}")
+            except Exception as e:
+                self.log(f"合并文件 {os.path.basename(file_path)} 时出错：{str(e)}")
+            self.progress(n + 1, len(pending), file_path)
+        return composer if self.file_page_map else None
+
+    @staticmethod
+    def default_output_path(directory):
+        """默认输出路径：所选目录下的 合并结果/合并完成文档.docx"""
+        return os.path.join(directory, "合并结果", "合并完成文档.docx")
+
+    def run(self, directory, algorithm="simple", output_path=None, job=None, files=None):
+        """合并文档主逻辑，成功返回输出路径，失败返回None；job为MergeJob，用于取消和暂停
+
+        files 为明确列出的输入文件，按给出的顺序合并，此时directory只用于默认输出路径。
+        """
+        self.job = job or MergeJob()
+        # 检查目录有效性
+        if not os.path.isdir(directory):
+            self.log("错误：目录不存在")
+            raise MergeError("目录错误", "选择的目录不存在或已被删除")
+
+        self.profiler = RunProfiler()
+        with self.profiler.span("discovery") as record:
+            doc_files = self.collect_files(directory, files)
+            record["files"] = len(doc_files)
+        self.duplicate_files = []
+        if self.duplicates != "off" and doc_files:
+            doc_files = self.check_duplicates(doc_files)
+        self.doc_files = doc_files
+        if not doc_files:
+            self.log("错误：目录中没有找到Word文档")
+            raise MergeError("文件未找到", "目录中没有有效的Word文档")
+
+        # 设置输出路径
+        output_path = os.path.abspath(output_path or self.default_output_path(directory))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        # 分卷依赖流式写出，每次只有一卷在内存中
+        self.volumes = []
+        if self.splitting and algorithm != "stream":
+            self.log("分卷输出使用流式合并")
+            algorithm = "stream"
+
+        # 找到与当前输入一致的检查点时从中断处继续
+        self.algorithm = algorithm
+        self.converted = {}
+        self.last_checkpoint = time.monotonic()
+        self.resume_state = None
+        if self.resume and algorithm in CHECKPOINT_ALGORITHMS and not (algorithm == "simple" and os.name == 'nt'):
+            self.resume_state = self.load_checkpoint(output_path)
+
+        # 根据选择的合并算法执行合并
+        self.toc_inserted = False
+        success = False
+        try:
+            if algorithm == "simple":
+                if os.name == 'nt':
+                    success = self.algorithm_windows(doc_files, output_path)
+                else:
+                    success = self.merge_simple(output_path, doc_files)
+            elif algorithm == "format":
+                success = self.merge_with_format(output_path, doc_files)
+            elif algorithm == "fast":
+                success = self.merge_fast(output_path, doc_files)
+            elif algorithm == "word_api":
+                success = self.merge_with_word_api(output_path, doc_files)
+            elif algorithm == "docxcompose":
+                success = self.merge_with_docxcompose(output_path, doc_files)
+            elif algorithm == "stream" and self.splitting:
+                success = self.merge_volumes(output_path, doc_files)
+            elif algorithm == "stream":
+                success = self.merge_stream(output_path, doc_files)
+            else:
+                self.log("错误：未知的合并算法")
+                return None
+        finally:
+            self.close_converter_pool()
+            if not success:
+                self.write_report(output_path, algorithm, False)
+
+        if not success:
+            self.log("合并失败，请检查日志")
+            return None
+
+        # docx算法在保存前已经写入目录，Word COM算法保存后再补充
+        if not self.toc_inserted:
+            self.generate_toc(output_path)
+        if self.toc_pages == "update":
+            self.update_fields(self.volumes or [output_path])
+        self.clear_checkpoint(output_path)
+        self.write_report(output_path, algorithm, True)
+        if self.volumes:
+            self.log(f"\n合并完成！共 {len(self.volumes)} 卷：" + "、".join(os.path.basename(v) for v in self.volumes))
+            return self.index_path(output_path) if self.split_index else self.volumes[0]
+        self.log("\n合并完成！文件已保存到：" + output_path)
+        return output_path
+
+    @staticmethod
+    def checkpoint_path(output_path, suffix):
+        """检查点文件路径：输出文件名加 .checkpoint.docx / .checkpoint.json"""
+        return os.path.splitext(output_path)[0] + ".checkpoint" + suffix
+
+    def input_state(self):
+        """输入文件列表及其大小和修改时间，用于判断检查点是否还有效"""
+        state = []
+        for file_path in self.doc_files:
+            stat = self.stat(file_path)
+            state.append([os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns])
+        return state
+
+    def load_checkpoint(self, output_path):
+        """读取检查点，算法或输入文件有变化时返回None"""
+        try:
+            with open(self.checkpoint_path(output_path, ".json"), encoding="utf-8") as f:
+                state = json.load(f)
+            valid = (
+                state.get("version") == CHECKPOINT_VERSION and state["algorithm"] == self.algorithm
+                and state["files"] == self.input_state()
+                and os.path.exists(self.checkpoint_path(output_path, ".docx"))
+            )
+        except (OSError, ValueError, KeyError):
+            return None
+        if not valid:
+            self.log("检查点与当前的输入或算法不一致，从头开始合并")
+            return None
+        self.log(f"从检查点继续：已完成 {len(state['done'])}/{len(self.doc_files)} 个文件")
+        return state
+
+    def save_checkpoint(self, output_path, document, done, current_page):
+        """保存已组装的部分文档、文件页码映射和尚未合并文件的转换结果"""
+        docx_path = self.checkpoint_path(output_path, ".docx")
+        json_path = self.checkpoint_path(output_path, ".json")
+        with self.profiler.span("checkpoint") as record:
+            save_document(document, docx_path + ".tmp", 1)  # 检查点优先保存速度
+            state = {
+                "version": CHECKPOINT_VERSION,
+                "algorithm": self.algorithm,
+                "files": self.input_state(),
+                "done": sorted(done),
+                "current_page": current_page,
+                "file_page_map": self.file_page_map,
+                "converted": dict(self.converted),  # 转换线程可能同时在写入
+            }
+            with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            # 先替换文档再替换状态，中途崩溃时状态不会指向更新的文档
+            os.replace(docx_path + ".tmp", docx_path)
+            os.replace(json_path + ".tmp", json_path)
+            record["files"] = len(done)
+        self.last_checkpoint = time.monotonic()
+        self.log(f"已保存检查点：完成 {len(done)}/{len(self.doc_files)} 个文件")
+
+    def clear_checkpoint(self, output_path):
+        """合并成功后删除检查点"""
+        for suffix in (".json", ".docx"):
+            try:
+                os.remove(self.checkpoint_path(output_path, suffix))
+            except OSError:
+                pass
+
+    def between_files(self, checkpoint=None):
+        """每两个文件之间调用：处理暂停和取消，到时间时写检查点
+
+        checkpoint 为写检查点的函数；取消时先写检查点再抛出 MergeCancelled，下次运行从这里继续。
+        """
+        try:
+            self.job.check()
+        except MergeCancelled:
+            if checkpoint:
+                checkpoint()
+            raise
+        if checkpoint and self.checkpoint_interval and time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            checkpoint()
+
+    def write_report(self, output_path, algorithm, success):
+        """在输出旁写入运行报告（.report.json）和可选的Chrome trace（.trace.json）"""
+        base = os.path.splitext(output_path)[0]
+        outputs = []
+        if self.report:
+            report = self.profiler.report(
+                order=[os.path.abspath(f) for f in self.doc_files], algorithm=algorithm, output=output_path, success=success,
+                output_bytes=sum(os.path.getsize(path) for path in self.volumes or [output_path]) if success else 0,
+                volumes=self.volumes, duplicates=self.duplicate_files,
+                workers=self.workers, page_estimator=self.page_estimator,
+            )
+            outputs.append((base + ".report.json", report))
+        if self.trace:
+            outputs.append((base + ".trace.json", self.profiler.trace_events()))
+        for path, data in outputs:
+            try:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=1)
+                self.log(f"运行报告已保存：{path}")
+            except (OSError, TypeError, ValueError) as e:
+                self.log(f"写入运行报告失败：{str(e)}")
+
+    def extract_display_name(self, filename):
+        """提取带书名号的显示名称，没有书名号则用原文件名（不含扩展名）"""
+        # 去除文件扩展名
+        name_without_ext = os.path.splitext(filename)[0]
+        
+        # 清理文件名中可能的特殊字符
+        name_without_ext = name_without_ext.strip()
+        
+        # 查找书名号内容
+        match = re.search(r"《(.+?)》", name_without_ext)
+        
+        if match:
+            # 如果有书名号则取内容
+            display_name = match.group(1).strip()
+            # 确保提取的内容不为空
+            if not display_name:
+                display_name = name_without_ext
+        else:
+            # 否则保留整个文件名（不含扩展名）
+            display_name = name_without_ext
+        
+        # 限制长度，防止过长的文件名
+        if len(display_name) > 100:
+            display_name = display_name[:97] + "..."
+            
+        # 移除可能导致问题的特殊字符
+        display_name = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', display_name)
+        
+        return display_name
+
+    def toc_entries(self, file_page_map=None):
+        """按合并顺序返回目录项 (显示名称, 页码, 书签名)，默认取self.file_page_map"""
+        entries = []
+        for file_path, info in (self.file_page_map if file_page_map is None else file_page_map).items():
+            # 使用extract_display_name方法提取显示名称
+            display_name = self.extract_display_name(os.path.basename(file_path))
+            page_number = info['page'] + 1  # +1 因为目录页
+            self.log(f"添加目录项: {display_name}, 页码: {page_number}")
+            entries.append((display_name, page_number, info['bookmark']))
+        return entries
+
+    def insert_toc(self, document):
+        """在python-docx文档开头直接插入目录，随文档一起保存"""
+        self.log("正在生成目录...")
+        with self.profiler.span("toc") as record:
+            body = document.element.body
+            entries = self.toc_entries()
+            for index, element in enumerate(parse_block_xml(build_toc_xml(entries, self.toc_pages != "static"))):
+                body.insert(index, element)
+            if self.toc_pages == "field":
+                set_update_fields(document.settings.element)
+            record["entries"] = len(entries)
+        self.toc_inserted = True
+
+    def generate_toc(self, doc_path):
+        """为Word COM保存的文档补充目录（纯Python，不需要启动Word）"""
+        try:
+            # 检查文件路径是否存在
+            if not os.path.exists(doc_path):
+                raise FileNotFoundError(f"文件未找到：{doc_path}")
+            doc = Document(doc_path)
+            self.insert_toc(doc)
+            with self.profiler.span("save"):
+                save_document(doc, doc_path, self.compresslevel)
+            self.log("目录生成完成")
+            return True
+        except Exception as e:
+            self.log(f"生成目录时出错：{str(e)}")
+            import traceback
+            self.log(traceback.format_exc())
+            return False
+
+    def update_fields(self, output_paths):
+        """通过转换池无界面地打开输出文档并更新域，把目录页码固定为准确的数字"""
+        pool = self.get_converter_pool()
+        if pool is None:
+            self.log("没有可用的Word或LibreOffice，目录页码保留为域，在Word中按F9更新")
+            return False
+        success = True
+        try:
+            futures = []
+            for path in output_paths:
+                temp_path = os.path.splitext(path)[0] + ".fields.docx"
+                futures.append((path, temp_path, pool.submit(path, temp_path, "update_fields", self.profiler)))
+            for path, temp_path, future in futures:
+                try:
+                    with self.profiler.span("update_fields", path):
+                        future.result()
+                    os.replace(temp_path, path)
+                    self.log(f"已更新目录页码：{os.path.basename(path)}")
+                except Exception as e:
+                    success = False
+                    self.log(f"更新域失败：{str(e)}")
+                    try:
+                        os.remove(temp_path)
+                    except OSError:
+                        pass
+            return success
+        finally:
+            self.close_converter_pool()
+
+    def get_converter_pool(self):
+        """按需启动.doc转换池，没有可用的转换后端时返回None"""
+        if self.shared_converter_pool is not None:
+            return self.shared_converter_pool
+        if self.converter_pool is None:
+            backend = default_converter() if self.converter == "auto" else self.converter
+            if backend is None:
+                return None
+            cache = ConversionCache(self.cache_dir, self.cache_size) if self.cache_size else None
+            self.converter_pool = ConverterPool(
+                backend, self.converter_workers, self.recycle_after, cache, self.profiler, self.converter_slots
+            )
+        return self.converter_pool
+
+    def close_converter_pool(self):
+        """关闭转换池"""
+        if self.converter_pool is not None:
+            self.converter_pool.close()
+            self.converter_pool = None
+
+    def submit_inputs(self, doc_files, output_path, skip=()):
+        """把.doc文件交给转换池，不等待转换完成，按原顺序返回 [(序号, 原文件路径, Future)] 和临时文件列表
+
+        Future的结果为可用的.docx路径，交给 pipeline 在转换完成后立即解析。skip 中的序号是增量
+        合并可以直接复用的文件，不转换，结果为None；没有转换后端时跳过.doc文件。
+        """
+        pool = None
+        inputs = []
+        temp_files = []
+        converted = (self.resume_state or {}).get("converted", {})
+        for i, file_path in enumerate(doc_files):
+            file_path = os.path.abspath(file_path)  # 确保使用绝对路径
+            if os.path.exists(converted.get(file_path, "")):
+                # 检查点里已有转换结果；已合并的文件只需要清理
+                temp_files.append(converted[file_path])
+                if i not in skip:
+                    self.converted[file_path] = converted[file_path]
+                inputs.append((i, file_path, resolved_future(None if i in skip else converted[file_path])))
+            elif i in skip:
+                inputs.append((i, file_path, resolved_future(None)))
+            elif not file_path.lower().endswith('.doc'):
+                inputs.append((i, file_path, resolved_future(file_path)))
+            elif (pool := pool or self.get_converter_pool()) is None:
+                self.log(f"跳过.doc文件（没有可用的Word或LibreOffice）: {os.path.basename(file_path)}")
+            else:
+                # 创建临时.docx文件路径
+                temp_docx = os.path.join(os.path.dirname(output_path), f"temp_{i}_{os.path.basename(file_path)}x")
+                self.profiler.alias(temp_docx, file_path)
+                self.log(f"转换.doc文件为.docx: {os.path.basename(file_path)}")
+                future = pool.submit(file_path, temp_docx, profiler=self.profiler)
+                # 转换一完成就记入检查点，中途取消时下次不用重新转换
+                future.add_done_callback(partial(self._record_conversion, file_path))
+                inputs.append((i, file_path, future))
+                temp_files.append(temp_docx)
+        return inputs, temp_files
+
+    def _record_conversion(self, file_path, future):
+        if not future.cancelled() and future.exception() is None:
+            self.converted[file_path] = future.result()
+
+    def cleanup_temp_files(self, temp_files):
+        """清理.doc转换产生的临时文件"""
+        for temp_file in temp_files:
+            if not os.path.exists(temp_file):
+                continue  # 转换失败或被取消
+            try:
+                os.remove(temp_file)
+                self.log(f"清理临时文件：{os.path.basename(temp_file)}")
+            except OSError:
+                pass
+
+    def merge_simple(self, output_path, doc_files):
+        """简单追加合并算法，跨平台支持"""
+        temp_files = []
+        try:
+            resume = self.resume_state
+            merged_doc = Document(self.checkpoint_path(output_path, ".docx") if resume else None)
+            merged_body = merged_doc.element.body
+            self.file_page_map = dict(resume["file_page_map"]) if resume else {}  # 重置文件页码映射
+            current_page = resume["current_page"] if resume else 0
+            done = set(resume["done"]) if resume else set()
+
+            def checkpoint():
+                self.save_checkpoint(output_path, merged_doc, done, current_page)
+
+            # 预处理：将.doc文件交给转换池，转换、读取和追加重叠进行
+            inputs, temp_files = self.submit_inputs(doc_files, output_path, skip=done)
+            pending = [item for item in inputs if item[0] not in done]
+            # 流式读取正文文字并估算页数，不解析页眉页脚、图片等用不到的部件
+            work = partial(scan_docx, estimator=self.page_estimator, profiler=self.profiler)
+            for n, (i, source_path, file_path, scanned, error) in enumerate(self.pipeline(pending, work)):
+                self.between_files(checkpoint)
+                done.add(i)
+                # 创建唯一书签名
+                bookmark_name = f"bookmark_{i+1}"
+
+                try:
+                    if error is not None:
+                        raise error
+                    texts, page_count = scanned
+
+                    # 追加内容，并在该文件第一段添加书签
+                    with self.profiler.span("append", source_path):
+                        # 与前一个文件之间添加分页符
+                        if self.file_page_map:
+                            merged_doc.add_page_break()
+                        start_index = len(merged_body) - 1  # 最后一个元素是sectPr
+                        for text in texts:
+                            merged_doc.add_paragraph(text)
+                        add_bookmark(merged_body, bookmark_name, BOOKMARK_ID_BASE + i, start_index)
+
+                    # 记录当前页码和书签
+                    self.file_page_map[source_path] = {
+                        'page': current_page,
+                        'bookmark': bookmark_name
+                    }
+                    current_page += page_count
+                    self.log(f"成功合并：{os.path.basename(source_path)}, 估计页数: {page_count}")
+                except Exception as e:
+                    error_msg = f"处理文件 {os.path.basename(source_path)} 时出错：{str(e)}"
+                    self.log(error_msg)
+                self.progress(n + 1, len(pending), source_path)
+
+            # 插入目录后一次保存
+            self.insert_toc(merged_doc)
+            self.log("保存合并后的文档...")
+            with self.profiler.span("save"):
+                save_document(merged_doc, output_path, self.compresslevel)
+
+            # 清理临时文件
+            self.cleanup_temp_files(temp_files)
+            return True
+
+        except MergeCancelled:
+            raise  # 转换结果记录在检查点中，继续合并时使用
+        except Exception as e:
+            self.log(f"简单追加合并失败：{str(e)}")
+            self.cleanup_temp_files(temp_files)
+            return False
+
+    def dedupe_document(self, document):
+        """保存前合并重复的图片和编号定义"""
+        if not self.dedupe:
+            return
+        with self.profiler.span("dedupe") as record:
+            parts, saved, nums = dedupe_document(document)
+            record.update(parts=parts, bytes=saved, abstract_nums=nums)
+        if parts or nums:
+            self.log(f"去重：合并 {parts} 个重复部件（{saved // 1024} KB），{nums} 个重复编号定义")
+
+    def merge_with_com(self, output_path, doc_files):
+        """Word COM合并的公共流程，页码在合并完成后从书签一次性读取"""
+        word = None
+        try:
+            word = word_application(self.word_app)
+            merger = WordComMerger(word, self.log, self.profiler)
+            files = [os.path.abspath(f) for f in doc_files]
+            # 目录页码写成域时不需要准确的页码，省去重新分页
+            exact_pages = self.word_pages != "fast" and self.toc_pages == "static"
+            pages = merger.merge(files, os.path.abspath(output_path), self.job, self.progress, exact_pages)
+            self.file_page_map = {}
+            for file_path, (bookmark_name, page) in pages.items():
+                self.file_page_map[file_path] = {
+                    'page': page,
+                    'bookmark': bookmark_name
+                }
+            return bool(self.file_page_map)
+        finally:
+            # 确保在任何情况下都关闭Word
+            try:
+                if word:
+                    word.Quit()
+            except Exception:
+                pass
+
+    def algorithm_windows(self, files, final_docx):
+        """Windows平台下的合并算法，增加关闭批注功能和页码记录"""
+        try:
+            return self.merge_with_com(final_docx, files)
+        except MergeCancelled:
+            raise
+        except Exception as e:
+            error_msg = f"算法错误: {str(e)}"
+            self.log(error_msg)
+            return False
+
+    def merge_with_word_api(self, output_path, doc_files):
+        """使用 Word API 合并算法，增加关闭批注功能和页码记录"""
+        try:
+            return self.merge_with_com(output_path, doc_files)
+        except MergeCancelled:
+            raise
+        except Exception as e:
+            self.log(f"Word API 合并失败：{str(e)}")
+            return False
+
+    def merge_with_format(self, output_path, doc_files):
+        """保留格式合并算法，使用python-docx和docxcompose库"""
+        try:
+            return self._merge_composed(output_path, doc_files)
+        except MergeCancelled:
+            raise
+        except Exception as e:
+            self.log(f"保留格式合并失败：{str(e)}")
+            return False
+
+    def merge_fast(self, output_path, doc_files):
+        """快速保留格式合并：保留表格、图片和格式，跳过docxcompose的样式映射"""
+        try:
+            return self._merge_composed(output_path, doc_files, FastComposer)
+        except MergeCancelled:
+            raise
+        except Exception as e:
+            self.log(f"快速保留格式合并失败：{str(e)}")
+            return False
+
+    def merge_with_docxcompose(self, output_path, doc_files):
+        """使用 docxcompose 合并算法，增加页码记录和书签支持"""
+        try:
+            return self._merge_composed(output_path, doc_files)
+        except MergeCancelled:
+            raise
+        except Exception as e:
+            self.log(f"docxcompose 合并失败：{str(e)}")
+            return False
+
+    def _merge_composed(self, output_path, doc_files, composer_class=Composer):
+        """docxcompose合并的公共流程：转换、并行解析、按顺序追加、插入目录后保存"""
+        resume = self.resume_state
+        self.file_page_map = dict(resume["file_page_map"]) if resume else {}  # 重置文件页码映射
+        done = set(resume["done"]) if resume else set()
+
+        # 预处理：将.doc文件交给转换池，转换完成的文件立即开始解析
+        inputs, temp_files = self.submit_inputs(doc_files, output_path, skip=done)
+        pending = [item for item in inputs if item[0] not in done]
+
+        try:
+            # 并行解析、验证并估算页数，按原顺序交给docxcompose合并
+            self.log("开始合并有效的文件...")
+            merged_doc = Document(self.checkpoint_path(output_path, ".docx")) if resume else None
+            composer = self.compose_parsed(composer_class, pending, output_path, merged_doc)
+            if composer is None:
+                self.log("没有有效的文件可以合并")
+                self.cleanup_temp_files(temp_files)
+                return False
+
+            self.dedupe_document(composer.doc)
+
+            # 插入目录后一次保存
+            self.insert_toc(composer.doc)
+            self.log("保存合并后的文档...")
+            with self.profiler.span("save"):
+                save_document(composer.doc, output_path, self.compresslevel)
+        except MergeCancelled:
+            raise  # 转换结果记录在检查点中，继续合并时使用
+        except Exception:
+            self.cleanup_temp_files(temp_files)
+            raise
+
+        # 清理临时文件
+        self.cleanup_temp_files(temp_files)
+        return True
+
+    @staticmethod
+    def manifest_path(output_path):
+        """增量合并清单的路径，与输出文件放在一起"""
+        return os.path.splitext(output_path)[0] + ".manifest.json"
+
+    def load_manifest(self, output_path):
+        """读取上一次的清单，输出文件已被改动或参数不同时视为无效"""
+        try:
+            with open(self.manifest_path(output_path), encoding="utf-8") as f:
+                manifest = json.load(f)
+            stat = os.stat(output_path)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("page_estimator") != self.page_estimator:
+            return None
+        if manifest["output"] != [stat.st_size, stat.st_mtime_ns]:
+            self.log("输出文件在上次合并后被修改过，重新完整合并")
+            return None
+        return manifest
+
+    def file_unchanged(self, file_path, old):
+        """按修改时间和大小判断，不一致时再比较内容哈希"""
+        try:
+            stat = self.stat(file_path)
+        except OSError:
+            return False
+        if [stat.st_size, stat.st_mtime_ns] == [old["size"], old["mtime"]]:
+            return True
+        return stat.st_size == old["size"] and file_sha256(file_path) == old["hash"]
+
+    def write_manifest(self, output_path, merger, files):
+        """记录每个输入的状态和它在document.xml中的字节范围"""
+        stat = os.stat(output_path)
+        manifest = dict(merger.state(), version=MANIFEST_VERSION, page_estimator=self.page_estimator,
+                        output=[stat.st_size, stat.st_mtime_ns])
+        manifest["files"] = [dict(meta, **segment) for meta, segment in zip(files, merger.segments)]
+        temp_path = self.manifest_path(output_path) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(temp_path, self.manifest_path(output_path))
+
+    def merge_stream(self, output_path, doc_files):
+        """流式合并算法：直接在zip部件层面合并，内存占用只取决于最大的单个输入
+
+        每次都会在输出旁写入清单；开启增量合并时，未变化的文件直接从上一次的输出中按字节
+        拷贝，只有新增和变化的文件需要转换和解析，删除的文件自然被丢弃，目录重新生成。
+        """
+        merger = None
+        temp_files = []
+        try:
+            self.file_page_map = {}  # 重置文件页码映射
+            current_page = 0
+
+            # 找出可以直接复用的文件
+            manifest = self.load_manifest(output_path) if self.incremental else None
+            reuse = {}
+            if manifest:
+                old_files = {f["path"]: f for f in manifest["files"]}
+                for n, file_path in enumerate(doc_files):
+                    old = old_files.get(os.path.abspath(file_path))
+                    # 原来排在第一个的段没有强制分页，换到后面时需要重新合并
+                    if old and not (old["first"] and n > 0) and self.file_unchanged(os.path.abspath(file_path), old):
+                        reuse[n] = old
+                self.log(f"增量合并：{len(reuse)} 个文件未变化，{len(doc_files) - len(reuse)} 个文件需要重新合并")
+
+            # 预处理：将.doc文件交给转换池，后面的文件转换时前面的文件已经在写出
+            inputs, temp_files = self.submit_inputs(doc_files, output_path, skip=reuse)
+            merger = StreamMerger(output_path, self.dedupe, self.compresslevel, self.toc_pages == "field")
+            if reuse:
+                merger.reuse(output_path, manifest, list(reuse.values()))
+
+            files = []
+            for n, (i, source_path, file_path, _, _) in enumerate(self.pipeline(inputs)):
+                self.job.check()
+                # 创建唯一书签名
+                bookmark_name = f"bookmark_{i+1}"
+                try:
+                    stat = self.stat(source_path)
+                    with self.profiler.span("append", source_path, reused=i in reuse) as record:
+                        if i in reuse:
+                            file_hash = reuse[i]["hash"]
+                            page_count = merger.append_segment(reuse[i], bookmark_name)
+                        else:
+                            file_hash = file_sha256(source_path)
+                            page_count = merger.append(file_path, bookmark_name, self.page_estimator, key="s" + file_hash[:8])
+                            record["bytes"] = os.path.getsize(file_path)
+                        record["elements"] = merger.segments[-1].get("elements", 0)
+                        record["revisions"] = merger.segments[-1].get("revisions", 0)
+                        record["pages"] = page_count
+                except Exception as e:
+                    self.log(f"处理文件 {os.path.basename(source_path)} 时出错：{str(e)}")
+                    continue
+                files.append({
+                    "path": source_path, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                    "hash": file_hash, "bookmark": bookmark_name,
+                })
+
+                # 记录当前页码和书签
+                self.file_page_map[source_path] = {
+                    'page': current_page,
+                    'bookmark': bookmark_name
+                }
+                current_page += page_count
+                state = "复用" if i in reuse else "成功合并"
+                self.log(f"{state}：{os.path.basename(source_path)}, 估计页数: {page_count}")
+                self.progress(n + 1, len(inputs), source_path)
+
+            if merger.file_count == 0:
+                self.log("没有有效的文件可以合并")
+                merger.abort()
+                return False
+
+            # 目录随document.xml一起写出
+            self.log("正在生成目录...")
+            with self.profiler.span("toc") as record:
+                entries = self.toc_entries()
+                toc_xml = build_toc_xml(entries, self.toc_pages != "static")
+                record["entries"] = len(entries)
+            self.log("保存合并后的文档...")
+            with self.profiler.span("save"):
+                merger.close(toc_xml)
+            self.toc_inserted = True
+            self.write_manifest(output_path, merger, files)
+
+            # 清理临时文件
+            self.cleanup_temp_files(temp_files)
+            return True
+
+        except MergeCancelled:
+            if merger:
+                merger.abort()
+            self.cleanup_temp_files(temp_files)
+            raise
+        except Exception as e:
+            self.log(f"流式合并失败：{str(e)}")
+            if merger:
+                merger.abort()
+            self.cleanup_temp_files(temp_files)
+            return False
+
+    @property
+    def splitting(self):
+        return bool(self.split_bytes or self.split_pages or self.split_files)
+
+    @staticmethod
+    def volume_path(output_path, number):
+        """第number卷的路径：输出文件名加 _第N卷"""
+        base, ext = os.path.splitext(output_path)
+        return f"{base}_第{number}卷{ext}"
+
+    @staticmethod
+    def index_path(output_path):
+        """分卷总目录的路径"""
+        base, ext = os.path.splitext(output_path)
+        return f"{base}_总目录{ext}"
+
+    def volume_full(self, merger, volume_bytes, volume_pages, next_bytes, pages_per_byte):
+        """当前卷再加入下一个文件是否会超过分卷上限；每卷至少一个文件
+
+        字节数按输入文件大小累计；下一个文件的页数还没有解析，按本次已合并文件的页数/字节比例预估。
+        """
+        if merger.file_count == 0:
+            return False
+        if self.split_files and merger.file_count >= self.split_files:
+            return True
+        if self.split_bytes and volume_bytes + next_bytes > self.split_bytes:
+            return True
+        return bool(self.split_pages and volume_pages + max(1, round(next_bytes * pages_per_byte)) > self.split_pages)
+
+    def close_volume(self, merger, volume_map):
+        """写出一卷：目录只包含本卷的文件，页码从本卷开头算起"""
+        with self.profiler.span("toc") as record:
+            entries = self.toc_entries(volume_map)
+            toc_xml = build_toc_xml(entries, self.toc_pages != "static")
+            record["entries"] = len(entries)
+        with self.profiler.span("save"):
+            merger.close(toc_xml)
+        self.volumes.append(merger.output_path)
+        self.log(f"已保存第 {len(self.volumes)} 卷：{os.path.basename(merger.output_path)}（{merger.file_count} 个文件）")
+
+    def merge_volumes(self, output_path, doc_files):
+        """分卷流式合并：按大小、估算页数或文件数把输出拆成多个文件，每卷带自己的目录
+
+        同一时间只有一卷处于打开状态，内存占用与不分卷的流式合并相同。
+        """
+        if self.incremental:
+            self.log("分卷输出不支持增量合并，完整合并所有文件")
+        merger = None
+        temp_files = []
+        try:
+            self.file_page_map = {}  # 重置文件页码映射
+            inputs, temp_files = self.submit_inputs(doc_files, output_path)
+            total_pages = total_bytes = 0
+            # 转换完成的文件在线程池中预先计算哈希，与写出前面的文件重叠
+            for n, (i, source_path, file_path, file_hash, error) in enumerate(self.pipeline(inputs, file_sha256)):
+                self.job.check()
+                try:
+                    if error is not None:
+                        raise error
+                    size = os.path.getsize(file_path)
+                except Exception as e:
+                    self.log(f"处理文件 {os.path.basename(source_path)} 时出错：{str(e)}")
+                    continue
+                pages_per_byte = total_pages / total_bytes if total_bytes else 0
+                if merger is not None and self.volume_full(merger, volume_bytes, volume_pages, size, pages_per_byte):
+                    self.close_volume(merger, volume_map)
+                    merger = None
+                if merger is None:
+                    merger = StreamMerger(
+                        self.volume_path(output_path, len(self.volumes) + 1), self.dedupe, self.compresslevel,
+                        self.toc_pages == "field",
+                    )
+                    volume_map = {}
+                    volume_bytes = volume_pages = 0
+                # 创建唯一书签名
+                bookmark_name = f"bookmark_{i+1}"
+                try:
+                    with self.profiler.span("append", source_path, bytes=size) as record:
+                        page_count = merger.append(file_path, bookmark_name, self.page_estimator, key="s" + file_hash[:8])
+                        record["pages"] = page_count
+                except Exception as e:
+                    self.log(f"处理文件 {os.path.basename(source_path)} 时出错：{str(e)}")
+                    continue
+
+                # 记录本卷内的页码和书签
+                volume_map[source_path] = {
+                    'page': volume_pages,
+                    'bookmark': bookmark_name
+                }
+                self.file_page_map[source_path] = dict(volume_map[source_path], volume=len(self.volumes) + 1)
+                volume_bytes += size
+                volume_pages += page_count
+                total_bytes += size
+                total_pages += page_count
+                self.log(f"成功合并：{os.path.basename(source_path)}, 估计页数: {page_count}")
+                self.progress(n + 1, len(inputs), source_path)
+
+            if merger is not None and merger.file_count:
+                self.close_volume(merger, volume_map)
+            elif merger is not None:
+                merger.abort()
+            merger = None
+            if not self.volumes:
+                self.log("没有有效的文件可以合并")
+                return False
+            if self.split_index:
+                self.write_volume_index(output_path)
+            self.toc_inserted = True
+
+            # 清理临时文件
+            self.cleanup_temp_files(temp_files)
+            return True
+
+        except MergeCancelled:
+            if merger:
+                merger.abort()
+            self.cleanup_temp_files(temp_files)
+            raise
+        except Exception as e:
+            self.log(f"分卷合并失败：{str(e)}")
+            if merger:
+                merger.abort()
+            self.cleanup_temp_files(temp_files)
+            return False
+
+    def write_volume_index(self, output_path):
+        """写出总目录：按卷列出全部文件，每项链接到对应分卷中的书签"""
+        doc = Document()
+        volumes = []
+        for number, volume in enumerate(self.volumes, 1):
+            rid = doc.part.relate_to(os.path.basename(volume), RT.HYPERLINK, is_external=True)
+            volume_map = {f: info for f, info in self.file_page_map.items() if info["volume"] == number}
+            volumes.append((f"第{number}卷", rid, self.toc_entries(volume_map)))
+        body = doc.element.body
+        for index, element in enumerate(parse_block_xml(build_index_xml(volumes))):
+            body.insert(index, element)
+        index_path = self.index_path(output_path)
+        save_document(doc, index_path, self.compresslevel)
+        self.log(f"总目录已保存：{os.path.basename(index_path)}")
+        return index_path
+
+
+# ---- 多目录批量合并 ----
+
+_job_control = {}  # 工作进程中的共享控制对象，由 _init_job_worker 设置
+
+
+def has_documents(directory):
+    """目录中是否直接包含Word文档"""
+    try:
+        with os.scandir(directory) as entries:
+            return any(
+                entry.is_file() and entry.name.lower().endswith(DOC_EXTENSIONS) and not entry.name.startswith("~$")
+                for entry in entries
+            )
+    except OSError:
+        return False
+
+
+def expand_directories(patterns, recursive=False):
+    """把命令行给出的目录或通配符展开为要合并的目录列表
+
+    recursive 为True时遍历每个目录的全部子目录，凡是直接包含Word文档的都作为一个合并任务，
+    跳过输出用的“合并结果”目录。
+    """
+    directories = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if not os.path.isdir(path):
+                continue
+            if not recursive:
+                directories.append(path)
+                continue
+            for root, dirs, _ in os.walk(path):
+                dirs[:] = sorted((d for d in dirs if d != OUTPUT_DIR_NAME), key=natural_key)
+                if has_documents(root):
+                    directories.append(root)
+    seen = set()
+    unique = []
+    for path in directories:
+        key = os.path.normcase(os.path.abspath(path))
+        if key not in seen:
+            seen.add(key)
+            unique.append(os.path.abspath(path))
+    return unique
+
+
+def job_output_paths(directories, output_dir=None):
+    """每个目录的输出路径：默认在各自目录下，指定output_dir时按目录名放在一起（重名时加序号）"""
+    if not output_dir:
+        return [MergeEngine.default_output_path(d) for d in directories]
+    outputs = []
+    used = set()
+    for directory in directories:
+        name = os.path.basename(os.path.normpath(directory)) or "合并完成文档"
+        candidate, n = name, 1
+        while candidate.lower() in used:
+            n += 1
+            candidate = f"{name}_{n}"
+        used.add(candidate.lower())
+        outputs.append(os.path.join(output_dir, candidate + ".docx"))
+    return outputs
+
+
+def _init_job_worker(slots, cancelled, running):
+    _job_control.update(slots=slots, cancelled=cancelled, running=running)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 由父进程统一处理 Ctrl+C
+
+
+def merge_job(directory, algorithm, output_path, options):
+    """在工作进程中运行一个合并任务，日志写在输出旁的 .log 文件，返回(输出路径, 错误信息)"""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    log_path = os.path.splitext(output_path)[0] + ".log"
+    with open(log_path, "a", encoding="utf-8") as log_file:
+        def log(message):
+            log_file.write(message + "\n")
+            log_file.flush()
+
+        job = MergeJob(_job_control.get("cancelled"), _job_control.get("running"))
+        engine = MergeEngine(log=log, converter_slots=_job_control.get("slots"), **options)
+        try:
+            output = engine.run(directory, algorithm, output_path, job)
+        except MergeError as e:
+            log(f"{e.title}：{e.message}")
+            return None, e.message
+        except Exception as e:
+            log(f"合并过程中发生严重错误：{str(e)}")
+            return None, str(e)
+        return output, None if output else "合并失败，详见日志"
+
+
+def run_jobs(directories, algorithm="simple", output_dir=None, options=None, max_jobs=None, max_converters=None,
+             log=None, progress=None, job=None):
+    """用进程池并发合并多个目录，返回 [(目录, 输出路径或None, 错误信息)]
+
+    每个目录是一个独立的任务，各自写输出和日志；max_converters 限制所有任务合起来同时
+    运行的Word或LibreOffice实例数（实例启动前取得名额，关闭后归还）。job 由 make_batch_job() 创建，
+    取消和暂停会传到全部工作进程。
+    """
+    log = log or (lambda message: None)
+    options = dict(options or {})
+    job = job or make_batch_job()
+    outputs = job_output_paths(directories, output_dir)
+    slots = multiprocessing.BoundedSemaphore(max_converters) if max_converters else None
+    results = {}
+    with ProcessPoolExecutor(
+        max_workers=max_jobs or min(4, os.cpu_count() or 1),
+        initializer=_init_job_worker, initargs=(slots, job.cancelled, job.running),
+    ) as pool:
+        futures = {
+            pool.submit(merge_job, directory, algorithm, output_path, options): (directory, output_path)
+            for directory, output_path in zip(directories, outputs)
+        }
+        log(f"共 {len(futures)} 个合并任务")
+        for done, future in enumerate(as_completed(futures), 1):
+            directory, output_path = futures[future]
+            try:
+                output, error = future.result()
+            except CancelledError:
+                output, error = None, "已取消"
+            except Exception as e:
+                output, error = None, str(e)
+            results[directory] = (directory, output, error)
+            if output:
+                log(f"[{done}/{len(futures)}] 完成：{directory} -> {output}")
+            else:
+                log(f"[{done}/{len(futures)}] 失败：{directory}（{error}），日志：{os.path.splitext(output_path)[0]}.log")
+            if progress:
+                progress(done, len(futures), directory)
+            if job.cancelled.is_set():
+                for pending in futures:
+                    pending.cancel()
+    return [results[d] for d in directories if d in results]
+
+
+def make_batch_job():
+    """可以在多个进程间共享的MergeJob"""
+    running = multiprocessing.Event()
+    running.set()
+    return MergeJob(multiprocessing.Event(), running)
+
+
+# ---- 合并服务 ----
+
+# 请求中可以覆盖的MergeEngine参数；转换后端和缓存属于常驻转换池，由启动服务时的参数决定
+SERVER_JOB_OPTIONS = (
+    "workers", "page_estimator", "word_pages", "incremental", "report", "trace", "resume", "checkpoint_interval",
+    "subdirs", "include", "exclude", "sort", "order_file", "dedupe", "compresslevel", "word_app", "toc_pages",
+    "split_bytes", "split_pages", "split_files", "split_index", "duplicates", "similarity",
+)
+SERVER_KEEP_JOBS = 200  # 内存中保留的已结束任务数
+SERVER_HEARTBEAT = 15  # 事件流没有新事件时发送心跳的间隔（秒）
+
+
+def is_loopback_host(host):
+    """主机名是否为本机回环地址（localhost、127.0.0.0/8、::1）"""
+    host = (host or "").strip("[]").lower()
+    if host == "localhost" or host.endswith(".localhost"):
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def is_within(path, root):
+    """path 是否位于 root 目录之内（解析符号链接后比较）"""
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    try:
+        return os.path.commonpath([path, root]) == root
+    except ValueError:
+        return False  # Windows上不同盘符
+
+
+class ServerJob:
+    """合并服务中的一个任务：保存状态和事件（日志、进度），供轮询和事件流读取"""
+
+    def __init__(self, job_id, directory, files, algorithm, output_path, options):
+        self.id = job_id
+        self.directory = directory
+        self.files = files
+        self.algorithm = algorithm
+        self.output_path = output_path
+        self.options = options
+        self.control = MergeJob()
+        self.status = "queued"  # queued、running、done、failed、cancelled
+        self.output = None
+        self.volumes = []
+        self.error = None
+        self.progress = {"done": 0, "total": 0, "file": ""}
+        self.created = time.time()
+        self.started = self.finished = None
+        self.events = []
+        self.changed = threading.Condition()
+
+    @property
+    def report_path(self):
+        return os.path.splitext(self.output_path)[0] + ".report.json"
+
+    @property
+    def ended(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def emit(self, event):
+        with self.changed:
+            event["seq"] = len(self.events)
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def log(self, message):
+        self.emit({"type": "log", "message": message})
+
+    def on_progress(self, done, total, file_path):
+        self.progress = {"done": done, "total": total, "file": file_path}
+        self.emit(dict(self.progress, type="progress"))
+
+    def set_status(self, status):
+        self.status = status
+        if status == "running":
+            self.started = time.time()
+        elif self.ended:
+            self.finished = time.time()
+        self.emit({"type": "status", "status": status})
+
+    def wait_events(self, since, timeout):
+        """等待第since个之后的事件，返回(新事件列表, 任务是否已结束)"""
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.events) > since or self.ended, timeout)
+            return self.events[since:], self.ended
+
+    def state(self):
+        return {
+            "id": self.id, "status": self.status, "algorithm": self.algorithm, "directory": self.directory,
+            "files": len(self.files) if self.files is not None else None, "output": self.output,
+            "volumes": self.volumes, "error": self.error, "progress": self.progress,
+            "created": self.created, "started": self.started, "finished": self.finished,
+            "report": self.report_path if os.path.exists(self.report_path) else None,
+        }
+
+
+class MergeServer:
+    """常驻的合并服务：模块只导入一次，转换器实例常驻，多个合并任务在线程池中并发运行
+
+    请求只是把任务放进线程池，合并本身与命令行完全相同（同一个MergeEngine），单次合并
+    不再有启动解释器、导入python-docx/lxml和启动Word或LibreOffice的开销。
+    """
+
+    def __init__(self, options=None, max_jobs=None, log=None, output_root=None):
+        self.options = dict(options or {})  # 各任务的默认参数，与命令行相同
+        # 允许写入结果的目录；None时结果只能写在任务的源目录之内
+        self.output_root = os.path.abspath(output_root) if output_root else None
+        self.log = log or (lambda message: None)
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs or min(4, os.cpu_count() or 1))
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.converter_pool = None
+        converter = self.options.pop("converter", "auto")
+        backend = default_converter() if converter == "auto" else converter
+        cache_size = self.options.pop("cache_size", 0)
+        cache_dir = self.options.pop("cache_dir", None)
+        workers = self.options.pop("converter_workers", DEFAULT_CONVERTER_WORKERS)
+        recycle_after = self.options.pop("recycle_after", 50)
+        if backend is not None:
+            cache = ConversionCache(cache_dir, cache_size) if cache_size else None
+            self.converter_pool = ConverterPool(backend, workers, recycle_after, cache)
+            self.converter_pool.warm()
+            self.log(f"转换池已启动：{workers} 个 {self.converter_pool.backend.name} 实例")
+
+    def submit(self, request):
+        """按请求创建任务并放入线程池，请求无效时抛出ValueError"""
+        directory = request.get("directory")
+        files = request.get("files")
+        if files is not None:
+            if not isinstance(files, list) or not files or not all(isinstance(f, str) for f in files):
+                raise ValueError("files 应为非空的路径列表")
+            files = [os.path.abspath(f) for f in files]
+            directory = directory or os.path.commonpath([os.path.dirname(f) for f in files])
+        if not isinstance(directory, str) or not os.path.isdir(directory):
+            raise ValueError("需要给出存在的 directory 或 files")
+        algorithm = request.get("algorithm", "simple")
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"未知的合并算法：{algorithm}")
+        options = dict(self.options)
+        for key, value in (request.get("options") or {}).items():
+            if key not in SERVER_JOB_OPTIONS:
+                raise ValueError(f"不支持的参数：{key}")
+            options[key] = value
+        directory = os.path.abspath(directory)
+        output_path = self.output_path(directory, request.get("output"))
+        with self.lock:
+            job = ServerJob(str(self.next_id), directory, files, algorithm, output_path, options)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+        self.executor.submit(self._run, job)
+        self.log(f"任务 {job.id} 已提交：{directory}（{algorithm}）")
+        return job
+
+    def output_path(self, directory, output=None):
+        """任务的输出路径，只能位于输出根目录（未指定时为源目录）之内，否则抛出ValueError"""
+        root = self.output_root or directory
+        if output is None:
+            if self.output_root:
+                return job_output_paths([directory], self.output_root)[0]
+            return MergeEngine.default_output_path(directory)
+        if not isinstance(output, str):
+            raise ValueError("output 应为文件路径")
+        output_path = os.path.abspath(os.path.join(root, output))
+        if not is_within(output_path, root) or not output_path.lower().endswith(".docx"):
+            raise ValueError(f"output 只能是 {root} 之内的.docx文件")
+        return output_path
+
+    def _forget_old_jobs(self):
+        ended = [job for job in self.jobs.values() if job.ended]
+        for job in ended[:max(0, len(ended) - SERVER_KEEP_JOBS)]:
+            del self.jobs[job.id]
+
+    def _run(self, job):
+        if job.control.cancelled.is_set():
+            job.set_status("cancelled")
+            return
+        job.set_status("running")
+        engine = MergeEngine(log=job.log, progress=job.on_progress, converter_pool=self.converter_pool, **job.options)
+        try:
+            job.output = engine.run(job.directory, job.algorithm, job.output_path, job.control, job.files)
+            job.volumes = engine.volumes
+            if not job.output:
+                job.error = "合并失败，详见日志"
+        except MergeCancelled:
+            job.error = "已取消"
+        except MergeError as e:
+            job.error = e.message
+        except Exception as e:
+            job.error = str(e)
+            job.log(f"合并过程中发生严重错误：{str(e)}")
+        try:
+            with open(job.report_path, encoding="utf-8") as f:
+                job.emit({"type": "report", "report": json.load(f)})
+        except (OSError, ValueError):
+            pass
+        job.set_status("done" if job.output else "cancelled" if job.control.cancelled.is_set() else "failed")
+        self.log(f"任务 {job.id} {job.status}：{job.output or job.error}")
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def close(self):
+        """取消全部任务，等正在运行的任务在当前文件完成后退出，再关闭转换池"""
+        for job in self.list():
+            job.control.cancel()
+        self.executor.shutdown(wait=True)
+        if self.converter_pool is not None:
+            self.converter_pool.close()
+
+
+class _MergeRequestHandler(BaseHTTPRequestHandler):
+    """合并服务的HTTP接口，请求和响应都是JSON
+
+        GET  /health                 服务状态
+        POST /jobs                   提交任务：{"directory": ..., "files": [...], "algorithm": ..., "output": ..., "options": {...}}
+        GET  /jobs                   全部任务的状态
+        GET  /jobs/<id>              任务状态和进度
+        GET  /jobs/<id>/events       事件流（NDJSON，日志、进度、状态，最后是运行报告），?since=N 从第N个事件开始
+        GET  /jobs/<id>/report       运行报告
+        GET  /jobs/<id>/output       合并结果文件，?volume=N 取第N卷
+        POST /jobs/<id>/cancel       取消，另有 pause、resume
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "merge_word"
+
+    def log_message(self, format, *args):
+        self.server.merge_server.log("请求：" + format % args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json({"error": message}, status)
+
+    def _check_request(self, post=False):
+        """拒绝非本机Host头（DNS重绑定）和非JSON的POST（网页的跨站表单请求），已拒绝时返回False"""
+        allowed = self.server.allowed_hosts
+        if allowed is not None:
+            host = urlsplit("//" + (self.headers.get("Host") or "")).hostname
+            if not (is_loopback_host(host) or host in allowed):
+                self._send_error(403, "只接受发往本机地址的请求")
+                return False
+        if post:
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if content_type != "application/json":
+                self._send_error(415, "请求的Content-Type应为application/json")
+                return False
+        return True
+
+    def _route(self):
+        """返回 (路径各段, 查询参数, 任务)；路径形如 /jobs/<id>/<动作>"""
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        job = self.server.merge_server.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+        return parts, query, job
+
+    def do_GET(self):
+        if not self._check_request():
+            return
+        try:
+            self._get()
+        except ValueError as e:
+            self._send_error(400, str(e))
+
+    def _get(self):
+        parts, query, job = self._route()
+        server = self.server.merge_server
+        if parts == ["health"]:
+            self._send_json({"status": "ok", "jobs": len(server.list()), "converter": bool(server.converter_pool)})
+        elif parts == ["jobs"]:
+            self._send_json([j.state() for j in server.list()])
+        elif len(parts) >= 2 and parts[0] == "jobs" and job is None:
+            self._send_error(404, "任务不存在")
+        elif len(parts) == 2:
+            self._send_json(job.state())
+        elif parts[2:] == ["events"]:
+            self._stream_events(job, int(query.get("since", 0)))
+        elif parts[2:] == ["report"]:
+            self._send_file(job.report_path, "application/json; charset=utf-8")
+        elif parts[2:] == ["output"]:
+            if job.status != "done":
+                self._send_error(409, f"任务状态为 {job.status}，还没有输出")
+            elif "volume" in query:
+                number = int(query["volume"])
+                if not 1 <= number <= len(job.volumes):
+                    self._send_error(404, "分卷不存在")
+                else:
+                    self._send_file(job.volumes[number - 1])
+            else:
+                self._send_file(job.output)
+        else:
+            self._send_error(404, "路径不存在")
+
+    def do_POST(self):
+        if not self._check_request(post=True):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))  # 读掉请求体，连接可以继续使用
+            return
+        parts, _, job = self._route()
+        if parts == ["jobs"]:
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("请求体应为JSON对象")
+                job = self.server.merge_server.submit(request)
+            except ValueError as e:
+                self._send_error(400, str(e))
+                return
+            self._send_json(job.state(), 202)
+        elif job is not None and parts[2:] in (["cancel"], ["pause"], ["resume"]):
+            getattr(job.control, parts[2])()
+            self._send_json(job.state())
+        elif job is None and len(parts) >= 2 and parts[0] == "jobs":
+            self._send_error(404, "任务不存在")
+        else:
+            self._send_error(404, "路径不存在")
+
+    def _send_file(self, path, content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"):
+        try:
+            f = open(path, "rb")
+        except (OSError, TypeError):
+            self._send_error(404, "文件不存在")
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            if not content_type.startswith("application/json"):
+                self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}")
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_events(self, job, since):
+        """分块传输事件，任务结束且事件发完后结束响应"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while True:
+                events, ended = job.wait_events(since, SERVER_HEARTBEAT)
+                since += len(events)
+                if events:
+                    self._write_chunk(b"".join(json.dumps(e, ensure_ascii=False).encode("utf-8") + b"\n" for e in events))
+                elif ended:
+                    break
+                else:
+                    self._write_chunk(b'{"type": "heartbeat"}\n')
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # 客户端已断开，任务继续运行
+
+
+class _MergeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allowed_hosts = ()  # 除本机地址外允许的Host头，None表示不检查（Unix套接字）
+
+
+def serve(address, options=None, max_jobs=None, log=None, allow_remote=False, output_root=None):
+    """启动合并服务直到Ctrl+C；address 为 主机:端口或 unix:套接字路径
+
+    只接受本机地址，allow_remote 为True时才允许绑定其他地址；output_root 限制结果的写入位置。
+    """
+    log = log or (lambda message: None)
+    if not address.startswith("unix:"):
+        host = address.rpartition(":")[0].strip("[]") or "127.0.0.1"
+        if not is_loopback_host(host) and not allow_remote:
+            raise ValueError(f"合并服务没有身份验证，只能绑定本机地址：{host}")
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)  # 上次没有正常退出留下的套接字文件
+        # Windows上没有UnixStreamServer，用到时才创建
+        server_class = type("_MergeUnixServer", (socketserver.ThreadingMixIn, socketserver.UnixStreamServer),
+                            {"daemon_threads": True})
+        httpd = server_class(path, _MergeRequestHandler)
+        httpd.allowed_hosts = None  # 浏览器无法访问Unix套接字
+    else:
+        host, _, port = address.rpartition(":")
+        host = host.strip("[]") or "127.0.0.1"
+        httpd = _MergeHTTPServer((host, int(port)), _MergeRequestHandler)
+        httpd.allowed_hosts = (host,) if allow_remote else ()
+    httpd.merge_server = MergeServer(options, max_jobs, log, output_root)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)  # 作为后台服务运行时用SIGTERM正常停止
+    log(f"合并服务已启动：{address}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        log("正在停止合并服务，等待运行中的任务在当前文件完成后退出...")
+    finally:
+        httpd.server_close()
+        httpd.merge_server.close()
+        if address.startswith("unix:"):
+            try:
+                os.remove(address[len("unix:"):])
+            except OSError:
+                pass
+    return 0
+
+
+class WordMergerApp:
+    """图形界面，customtkinter在创建窗口时才导入
+
+    后台线程只把日志和进度放进队列，由Tk主循环用after()定时批量取出再更新控件，
+    日志框只保留最近 LOG_HISTORY 行，更早的行写入日志文件。
+    """
+
+    LOG_INTERVAL = 100  # 刷新日志框的间隔（毫秒）
+    LOG_BATCH = 1000  # 每次最多取出的消息数
+    LOG_HISTORY = 5000  # 日志框保留的行数
+
     def __init__(self):
-        super().__init__()
-        self.title("Word文档合并工具")
-        self.geometry("800x600")
-        self.selected_dir = ""
+        import customtkinter as ctk
+        from tkinter import filedialog, messagebox
+        self.ctk = ctk
+        self.filedialog = filedialog
+        self.messagebox = messagebox
+
+        ctk.set_appearance_mode("System")
+        ctk.set_default_color_theme("blue")
+
+        self.root = ctk.CTk()
+        self.root.title("Word文档合并工具")
+        self.root.geometry("800x600")
+        self.selected_dirs = []  # 合并队列中的目录，多个目录时并发合并
         self.merge_algorithm = "simple"  # 默认合并算法
+        self.job = None  # 正在运行的MergeJob
+        self.messages = queue.Queue()  # 后台线程发来的 ("log", 文本) / ("progress", 已完成, 总数) / ("call", 函数, 位置参数, 关键字参数)
+        self.spill_path = os.path.join(tempfile.gettempdir(), f"merge_word_{os.getpid()}.log")
+        self.spilled = False
         self.create_widgets()
-        self.file_page_map = {}  # 添加文件页码映射字典
+        self.root.after(self.LOG_INTERVAL, self.drain_messages)
         # 检查是否是Windows系统，如果是，显示提示消息
         if os.name == 'nt':
             messagebox.showwarning(
                 "Windows系统提示", 
                 "你使用的是Windows系统，请保存和关闭所有打开的Word文档，以免造成文档丢失。关闭后再运行合并程序。"
             )
+
     def create_widgets(self):
+        ctk = self.ctk
         # 目录选择部分
-        self.dir_frame = ctk.CTkFrame(self)
+        self.dir_frame = ctk.CTkFrame(self.root)
         self.dir_frame.pack(pady=10, padx=10, fill="x")
 
-        self.dir_button = ctk.CTkButton(self.dir_frame,text="选择目录",command=self.select_directory)
+        self.dir_button = ctk.CTkButton(self.dir_frame,text="添加目录",command=self.select_directory)
         self.dir_button.pack(side="left", padx=5)
 
+        self.clear_button = ctk.CTkButton(self.dir_frame,text="清空",width=60,command=self.clear_directories)
+        self.clear_button.pack(side="left", padx=5)
+
+        self.recursive_var = ctk.BooleanVar(value=False)
+        self.recursive_check = ctk.CTkCheckBox(self.dir_frame,text="包含子目录",variable=self.recursive_var)
+        self.recursive_check.pack(side="left", padx=5)
+
         self.dir_label = ctk.CTkLabel(self.dir_frame,text="未选择目录",text_color='black',anchor="w")
         self.dir_label.pack(side="left", padx=5)
         # 合并算法选择部分
-        self.algorithm_frame = ctk.CTkFrame(self)
+        self.algorithm_frame = ctk.CTkFrame(self.root)
         self.algorithm_frame.pack(pady=10, padx=10, fill="x")
 
         self.algorithm_label = ctk.CTkLabel(self.algorithm_frame,text="选择合并算法：",anchor="w")
@@ -53,774 +4647,348 @@ class WordMergerApp(ctk.CTk):
         self.algorithm_format = ctk.CTkRadioButton(self.algorithm_frame,text="保留格式",variable=self.algorithm_var,value="format")
         self.algorithm_format.pack(side="left", padx=5)
 
+        self.algorithm_fast = ctk.CTkRadioButton(self.algorithm_frame,text="快速保留格式",variable=self.algorithm_var,value="fast")
+        self.algorithm_fast.pack(side="left", padx=5)
+
         self.algorithm_word_api = ctk.CTkRadioButton(self.algorithm_frame,text="使用 Word API",variable=self.algorithm_var,value="word_api")
         self.algorithm_word_api.pack(side="left", padx=5)
 
         self.algorithm_docxcompose = ctk.CTkRadioButton(self.algorithm_frame,text="使用 docxcompose",variable=self.algorithm_var,value="docxcompose")
         self.algorithm_docxcompose.pack(side="left", padx=5)
 
+        self.algorithm_stream = ctk.CTkRadioButton(self.algorithm_frame,text="流式合并",variable=self.algorithm_var,value="stream")
+        self.algorithm_stream.pack(side="left", padx=5)
+
         # 日志显示部分
-        self.log_text = ctk.CTkTextbox(self, wrap="none")
+        self.log_text = ctk.CTkTextbox(self.root, wrap="none", state="disabled")
         self.log_text.pack(pady=10, padx=10, fill="both", expand=True)
 
-        # 合并按钮
-        self.merge_button = ctk.CTkButton(self,text="开始合并",command=self.start_merge,state="disabled")
-        self.merge_button.pack(pady=10)
+        # 进度条
+        self.progress_frame = ctk.CTkFrame(self.root)
+        self.progress_frame.pack(padx=10, fill="x")
+        self.progress_bar = ctk.CTkProgressBar(self.progress_frame)
+        self.progress_bar.set(0)
+        self.progress_bar.pack(side="left", padx=5, pady=5, fill="x", expand=True)
+        self.progress_label = ctk.CTkLabel(self.progress_frame, text="", width=120, anchor="e")
+        self.progress_label.pack(side="left", padx=5)
+
+        # 合并、暂停和取消按钮
+        self.button_frame = ctk.CTkFrame(self.root, fg_color="transparent")
+        self.button_frame.pack(pady=10)
+        self.merge_button = ctk.CTkButton(self.button_frame,text="开始合并",command=self.start_merge,state="disabled")
+        self.merge_button.pack(side="left", padx=5)
+        self.pause_button = ctk.CTkButton(self.button_frame,text="暂停",command=self.toggle_pause,state="disabled")
+        self.pause_button.pack(side="left", padx=5)
+        self.cancel_button = ctk.CTkButton(self.button_frame,text="取消",command=self.cancel_merge,state="disabled")
+        self.cancel_button.pack(side="left", padx=5)
 
     def select_directory(self):
         """选择目录"""
-        self.selected_dir = filedialog.askdirectory()
-        if self.selected_dir:
-            self.dir_label.configure(text=self.selected_dir)
+        directory = self.filedialog.askdirectory()
+        if directory and directory not in self.selected_dirs:
+            self.selected_dirs.append(directory)
+            if len(self.selected_dirs) == 1:
+                self.dir_label.configure(text=directory)
+            else:
+                self.dir_label.configure(text=f"已选择 {len(self.selected_dirs)} 个目录（最近：{directory}）")
             self.merge_button.configure(state="normal")
-            self.log("已选择目录：" + self.selected_dir)
+            self.log("已选择目录：" + directory)
+
+    def clear_directories(self):
+        """清空合并队列"""
+        self.selected_dirs = []
+        self.dir_label.configure(text="未选择目录")
+        self.merge_button.configure(state="disabled")
 
     def log(self, message):
-        """在日志框中显示消息"""
+        """记录日志消息，可以在任意线程调用"""
+        self.messages.put(("log", message))
+
+    def progress(self, done, total, file_path=""):
+        """报告进度，可以在任意线程调用"""
+        self.messages.put(("progress", done, total))
+
+    def call_in_ui(self, func, *args, **kwargs):
+        """让主线程执行func，用于在后台线程中弹出对话框等"""
+        self.messages.put(("call", func, args, kwargs))
+
+    def drain_messages(self):
+        """主线程定时取出队列中的消息，日志一次性插入，进度只显示最新的"""
+        lines = []
+        latest_progress = None
+        calls = []
+        try:
+            for _ in range(self.LOG_BATCH):
+                item = self.messages.get_nowait()
+                if item[0] == "log":
+                    lines.append(item[1])
+                elif item[0] == "progress":
+                    latest_progress = item[1:]
+                else:
+                    calls.append(item[1:])
+        except queue.Empty:
+            pass
+
+        if lines:
+            self.append_lines(lines)
+        if latest_progress:
+            done, total = latest_progress
+            self.progress_bar.set(done / total if total else 0)
+            self.progress_label.configure(text=f"{done}/{total}")
+        for func, args, kwargs in calls:
+            func(*args, **kwargs)
+        # 队列里还有积压时尽快再取一次
+        delay = 1 if self.messages.qsize() else self.LOG_INTERVAL
+        self.root.after(delay, self.drain_messages)
+
+    def append_lines(self, lines):
+        """把一批日志插入日志框，超出 LOG_HISTORY 的旧行写入日志文件"""
         self.log_text.configure(state="normal")
-        self.log_text.insert("end", message + "\n")
+        self.log_text.insert("end", "\n".join(lines) + "\n")
+        line_count = int(self.log_text.index("end-1c").split(".")[0]) - 1
+        excess = line_count - self.LOG_HISTORY
+        if excess > 0:
+            old_lines = self.log_text.get("1.0", f"{excess + 1}.0")
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+            try:
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    f.write(old_lines)
+                if not self.spilled:
+                    self.spilled = True
+                    self.log(f"较早的日志已写入：{self.spill_path}")
+            except OSError:
+                pass
         self.log_text.see("end")
         self.log_text.configure(state="disabled")
 
     def start_merge(self):
         """启动合并线程"""
         self.merge_algorithm = self.algorithm_var.get()  # 获取选择的合并算法
-        threading.Thread(target=self.merge_documents, daemon=True).start()
+        recursive = self.recursive_var.get()
+        batch = recursive or len(self.selected_dirs) > 1
+        self.job = make_batch_job() if batch else MergeJob()
+        self.merge_button.configure(state="disabled")
+        self.pause_button.configure(state="normal", text="暂停")
+        self.cancel_button.configure(state="normal")
+        self.progress_bar.set(0)
+        self.progress_label.configure(text="")
+        threading.Thread(target=self.merge_documents, args=(self.job, batch, recursive), daemon=True).start()
 
-    def merge_documents(self):
-        """合并文档主逻辑"""
-        try:
-            # 检查目录有效性
-            if not os.path.isdir(self.selected_dir):
-                self.log("错误：目录不存在")
-                messagebox.showerror("目录错误", "选择的目录不存在或已被删除")
-                return
+    def toggle_pause(self):
+        """暂停或继续合并，在当前文件完成后生效"""
+        if self.job.paused:
+            self.job.resume()
+            self.pause_button.configure(text="暂停")
+            self.log("继续合并")
+        else:
+            self.job.pause()
+            self.pause_button.configure(text="继续")
+            self.log("当前文件完成后暂停")
 
-            # 获取所有Word文档（过滤掉以~$开头的缓存文件）
-            doc_files = glob.glob(os.path.join(self.selected_dir, "*.doc*"))
-            doc_files = [
-                f for f in doc_files
-                if f.endswith((".doc", ".docx")) and not os.path.basename(f).startswith("~$")
-            ]
-            doc_files.sort()
-
-            if not doc_files:
-                self.log("错误：目录中没有找到Word文档")
-                messagebox.showerror("文件未找到", "目录中没有有效的Word文档")
-                return
+    def cancel_merge(self):
+        """取消合并，支持的算法会先写检查点，下次合并同一目录时从中断处继续"""
+        self.job.cancel()
+        self.pause_button.configure(state="disabled")
+        self.cancel_button.configure(state="disabled")
+        self.log("正在取消，当前文件完成后停止...")
 
-            # 设置输出路径
-            output_dir = os.path.join(self.selected_dir, "合并结果")
-            os.makedirs(output_dir, exist_ok=True)
-            output_path = os.path.join(output_dir, "合并完成文档.docx")
+    def merge_finished(self):
+        self.merge_button.configure(state="normal")
+        self.pause_button.configure(state="disabled", text="暂停")
+        self.cancel_button.configure(state="disabled")
 
-            # 根据选择的合并算法执行合并
-            if self.merge_algorithm == "simple":
-                if os.name=='nt':
-                    success = self.algorithm_windows(doc_files, output_path)
-                else:
-                    success = self.merge_simple(output_path, doc_files)
-            elif self.merge_algorithm == "format":
-                success = self.merge_with_format(output_path, doc_files)
-            elif self.merge_algorithm == "word_api":
-                success = self.merge_with_word_api(output_path, doc_files)
-            elif self.merge_algorithm == "docxcompose":
-                success = self.merge_with_docxcompose(output_path, doc_files)
-            else:
-                self.log("错误：未知的合并算法")
-                return
+    def merge_documents(self, job, batch=False, recursive=False):
+        """在后台线程中调用合并引擎，界面操作都交给主线程
 
-            if success:
-                # 生成目录
-                self.generate_toc(output_path)
-                self.log("\n合并完成！文件已保存到：" + output_path)
-                messagebox.showinfo("完成", "文档合并完成！")
+        多个目录（或包含子目录）时每个目录在独立进程中合并，日志写在各自输出旁，
+        这里只显示每个任务的结果，进度条按完成的目录数推进。
+        """
+        messagebox = self.messagebox
+        try:
+            if batch:
+                directories = expand_directories(self.selected_dirs, recursive)
+                results = run_jobs(
+                    directories, self.merge_algorithm, log=self.log, progress=self.progress, job=job,
+                    max_converters=DEFAULT_CONVERTER_WORKERS,
+                )
+                failed = sum(1 for _, output, _ in results if not output)
+                self.log(f"完成 {len(results) - failed}/{len(directories)} 个目录")
+                output_path = results and not failed and len(results) == len(directories)
             else:
-                self.log("合并失败，请检查日志")
-                messagebox.showerror("错误", "合并失败，请检查日志")
-
+                engine = MergeEngine(log=self.log, progress=self.progress)
+                output_path = engine.run(self.selected_dirs[0], self.merge_algorithm, job=job)
+            if output_path:
+                self.call_in_ui(messagebox.showinfo, "完成", "文档合并完成！")
+            else:
+                self.call_in_ui(messagebox.showerror, "错误", "合并失败，请检查日志")
+        except MergeError as e:
+            self.call_in_ui(messagebox.showerror, e.title, e.message)
         except Exception as e:
             error_msg = f"合并过程中发生严重错误：{str(e)}"
             self.log(error_msg)
-            messagebox.showerror("严重错误", error_msg)
+            self.call_in_ui(messagebox.showerror, "严重错误", error_msg)
+        finally:
+            self.call_in_ui(self.merge_finished)
 
-    def extract_display_name(self, filename):
-        """提取带书名号的显示名称，没有书名号则用原文件名（不含扩展名）"""
-        # 去除文件扩展名
-        name_without_ext = os.path.splitext(filename)[0]
-        
-        # 清理文件名中可能的特殊字符
-        name_without_ext = name_without_ext.strip()
-        
-        # 查找书名号内容
-        match = re.search(r"《(.+?)》", name_without_ext)
-        
-        if match:
-            # 如果有书名号则取内容
-            display_name = match.group(1).strip()
-            # 确保提取的内容不为空
-            if not display_name:
-                display_name = name_without_ext
-        else:
-            # 否则保留整个文件名（不含扩展名）
-            display_name = name_without_ext
-        
-        # 限制长度，防止过长的文件名
-        if len(display_name) > 100:
-            display_name = display_name[:97] + "..."
-            
-        # 移除可能导致问题的特殊字符
-        display_name = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', display_name)
-        
-        return display_name
+    def mainloop(self):
+        self.root.mainloop()
 
-    def generate_toc(self, doc_path):
-        """生成目录"""
-        word = None
-        try:
-            self.log("正在生成目录...")
-            
-            # 检查文件路径是否存在
-            if not os.path.exists(doc_path):
-                raise FileNotFoundError(f"文件未找到：{doc_path}")
-            
-            # 强制关闭所有Word进程
-            self.log("尝试关闭所有Word进程...")
-            try:
-                import subprocess
-                subprocess.call("taskkill /f /im WINWORD.EXE", shell=True)
-                self.log("已强制关闭所有Word进程")
-                # 等待进程完全关闭
-                sleep(3)
-            except Exception as e:
-                self.log(f"关闭Word进程时出错: {str(e)}")
-            
-            # 使用直接修改原文档的方法
-            self.log("在原文档中生成目录...")
-            word = win32.Dispatch("Word.Application")
-            word.Visible = False
-            
-            # 打开原文档
-            self.log(f"打开文档: {doc_path}")
-            doc = word.Documents.Open(doc_path)
-            
-            # 在文档开头插入目录
-            # 不使用分页符，直接在开头插入
-            doc.Range(0, 0).InsertParagraphBefore()
-            
-            # 插入目录标题
-            title_range = doc.Range(0, 0)
-            title_range.InsertBefore("目录\r\n\r\n")
-            title_range = doc.Range(0, len("目录\r\n"))
-            title_range.Font.Name = "宋体"
-            title_range.Font.Size = 16  # 三号字体约为16磅
-            title_range.Font.Bold = True
-            title_range.ParagraphFormat.Alignment = 1  # 居中
-            
-            # 设置单倍行距
-            title_range.ParagraphFormat.LineSpacing = 12  # 单倍行距
-            title_range.ParagraphFormat.LineSpacingRule = 0  # 0 = wdLineSpaceSingle
-            
-            # 添加空行
-            doc.Range(len("目录\r\n\r\n"), len("目录\r\n\r\n")).InsertParagraphAfter()
-            
-            # 获取文件列表并按顺序排序
-            file_list = list(self.file_page_map.keys())
-            file_list.sort()
-            
-            # 当前插入位置 - 在目录标题之后
-            current_pos = title_range.End + 1
-            
-            # 添加目录项
-            for i, file_path in enumerate(file_list):
-                try:
-                    # 使用extract_display_name方法提取显示名称
-                    display_name = self.extract_display_name(os.path.basename(file_path))
-                    
-                    # 限制显示名称长度，防止过长
-                    if len(display_name) > 100:
-                        display_name = display_name[:97] + "..."
-                    
-                    # 使用文件页码映射中的实际页码
-                    page_number = self.file_page_map[file_path]['page'] + 1  # +1 因为目录页
-                    bookmark = self.file_page_map[file_path]['bookmark']
-                    
-                    self.log(f"添加目录项: {display_name}, 页码: {page_number}")
-                    
-                    # 创建完整的目录行
-                    complete_line = f"{display_name}\t{page_number}"
-                    
-                    # 插入目录项
-                    current_range = doc.Range(current_pos, current_pos)
-                    current_range.Text = complete_line
-                    
-                    # 设置段落格式
-                    current_para = current_range.Paragraphs(1)
-                    current_para.Range.Font.Name = "宋体"
-                    current_para.Range.Font.Size = 16  # 三号字体约为16磅
-                    
-                    # 设置单倍行距
-                    current_para.Format.LineSpacing = 12  # 单倍行距
-                    current_para.Format.LineSpacingRule = 0  # 0 = wdLineSpaceSingle
-                    
-                    # 添加制表符和点线
-                    current_para.Format.TabStops.ClearAll()
-                    current_para.Format.TabStops.Add(Position=450, Alignment=2, Leader=1)  # 点线制表符
-                    
-                    # 创建超链接
-                    try:
-                        # 计算链接范围
-                        link_start = current_para.Range.Start
-                        link_end = current_para.Range.End - 1  # -1 避免包含段落标记
-                        link_range = doc.Range(link_start, link_end)
-                        
-                        # 创建超链接
-                        doc.Hyperlinks.Add(
-                            Anchor=link_range,
-                            SubAddress=bookmark
-                        )
-                        self.log(f"超链接创建成功: {display_name}")
-                    except Exception as e:
-                        self.log(f"创建超链接时出错: {str(e)}")
-                    
-                    # 添加换行符（除了最后一个条目）
-                    if i < len(file_list) - 1:
-                        current_para.Range.InsertParagraphAfter()
-                    
-                    # 更新当前位置
-                    current_pos = doc.Range(0, current_para.Range.End).End
-                    
-                except Exception as e:
-                    self.log(f"处理目录项时出错: {str(e)}")
-                    continue
-            
-            # 添加单个分页符，将目录与正文分开
-            self.log("在目录后添加分页符...")
-            doc.Range(current_pos, current_pos).InsertBreak(7)  # 7 = wdPageBreak
-            
-            # 保存文档
-            self.log("保存文档...")
-            doc.Save()
-            doc.Close(SaveChanges=True)
-            
-            # 关闭Word
-            word.Quit()
-            self.log("目录生成完成")
-            return True
-            
-        except Exception as e:
-            self.log(f"生成目录时出错：{str(e)}")
-            import traceback
-            self.log(traceback.format_exc())
-            return False
-        finally:
-            # 确保在任何情况下都关闭Word
-            try:
-                if word:
-                    word.Quit()
-            except:
-                pass
-            
-            # 最后一次尝试强制关闭所有Word进程
-            try:
-                import subprocess
-                subprocess.call("taskkill /f /im WINWORD.EXE", shell=True)
-            except:
-                pass
 
-    def merge_simple(self, output_path, doc_files):
-        """简单追加合并算法，跨平台支持"""
-        try:
-            merged_doc = Document()
-            self.file_page_map = {}  # 重置文件页码映射
-            current_page = 0
-            
-            # 预处理：在Windows系统上将.doc文件转换为.docx
-            temp_files = []
-            is_windows = os.name == 'nt'
-            
-            for i, file_path in enumerate(doc_files):
-                try:
-                    self.log(f"正在处理文件：{os.path.basename(file_path)}")
-                    file_path = os.path.abspath(file_path)  # 确保使用绝对路径
-                    
-                    # 如果是Windows系统且是.doc文件，先转换为.docx
-                    if is_windows and file_path.lower().endswith('.doc'):
-                        self.log(f"转换.doc文件为.docx: {os.path.basename(file_path)}")
-                        # 使用Word COM接口转换
-                        word = None
-                        try:
-                            word = win32.Dispatch("Word.Application")
-                            word.Visible = False
-                            
-                            # 打开.doc文件
-                            doc = word.Documents.Open(file_path)
-                            # 创建临时.docx文件路径
-                            temp_docx = os.path.join(os.path.dirname(output_path), f"temp_{i}_{os.path.basename(file_path)}x")
-                            # 保存为.docx
-                            doc.SaveAs(temp_docx, 16)  # 16 = wdFormatDocumentDefault (.docx)
-                            doc.Close(SaveChanges=False)
-                            
-                            # 添加到临时文件列表
-                            temp_files.append(temp_docx)
-                            # 使用转换后的文件
-                            file_path = temp_docx
-                            self.log(f"成功转换文件：{os.path.basename(file_path)}")
-                        except Exception as e:
-                            self.log(f"转换文件失败: {str(e)}")
-                            continue
-                        finally:
-                            if word:
-                                try:
-                                    word.Quit()
-                                except:
-                                    pass
-                    # 非Windows系统下，跳过.doc文件
-                    elif not is_windows and file_path.lower().endswith('.doc'):
-                        self.log(f"跳过.doc文件（非Windows系统不支持）: {os.path.basename(file_path)}")
-                        continue
-                    
-                    # 创建唯一书签名
-                    bookmark_name = f"bookmark_{i+1}"
-                    
-                    try:
-                        # 尝试打开文件
-                        doc = Document(file_path)
-                        
-                        # 估算页数 (粗略计算，每页约2000个字符)
-                        text_length = 0
-                        for para in doc.paragraphs:
-                            text_length += len(para.text)
-                        # 更新当前页码 (粗略估计)
-                        page_count = max(1, text_length // 2000)
-                        
-                        # 记录当前页码和书签
-                        self.file_page_map[file_path] = {
-                            'page': current_page,
-                            'bookmark': bookmark_name
-                        }
-                        
-                        # 追加内容
-                        for paragraph in doc.paragraphs:
-                            merged_doc.add_paragraph(paragraph.text)
-                        
-                        # 添加分页符（除了最后一个文档）
-                        if i < len(doc_files) - 1:
-                            merged_doc.add_page_break()
-                        
-                        current_page += page_count
-                        self.log(f"成功合并：{os.path.basename(file_path)}, 估计页数: {page_count}")
-                    except Exception as e:
-                        error_msg = f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}"
-                        self.log(error_msg)
-                        continue
+def build_parser():
+    """命令行参数"""
+    parser = argparse.ArgumentParser(
+        prog="merge_word",
+        description="Word文档合并工具。不带目录参数时启动图形界面，带目录参数时以无界面的批处理方式运行。"
+                    "给出多个目录、通配符或 --recursive 时，每个目录作为独立任务并发合并。",
+    )
+    parser.add_argument("directories", nargs="*", metavar="directory", help="要合并的文档所在目录，可以是多个或通配符")
+    parser.add_argument("-a", "--algorithm", choices=ALGORITHMS, default="simple", help="合并算法（默认：simple）")
+    parser.add_argument("-o", "--output", help="输出文件路径（默认：目录/合并结果/合并完成文档.docx），只用于单个目录")
+    parser.add_argument("-r", "--recursive", action="store_true", help="遍历子目录，每个包含Word文档的目录合并为一个文件")
+    parser.add_argument("--subdirs", action="store_true", help="把子目录中的文档也合并进同一个文件（按相对路径排序）")
+    parser.add_argument("--include", action="append", default=[], help="只合并匹配的文件（通配符，匹配文件名或相对路径），可重复")
+    parser.add_argument("--exclude", action="append", default=[], help="跳过匹配的文件（通配符），可重复")
+    parser.add_argument("--sort", choices=SORT_ORDERS, default="natural", help="文件顺序：natural数字和中文序号按数值（默认），name按字符，mtime按修改时间")
+    parser.add_argument("--order-file", help=f"顺序文件，每行一个文件名；默认使用目录中的 {ORDER_FILE_NAME}")
+    parser.add_argument("--output-dir", help="把结果放到这个目录，按源目录名命名（单个目录和批量合并都适用）")
+    parser.add_argument("--jobs", type=int, default=None, help="同时进行的合并任务数（默认：min(4, CPU核数)）")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="以常驻服务方式运行，通过HTTP接口提交合并任务；ADDRESS 为 127.0.0.1:端口 或 unix:套接字路径")
+    parser.add_argument("--allow-remote", action="store_true", help="允许 --serve 绑定非本机地址（服务没有身份验证）")
+    parser.add_argument("--output-root", help="--serve 时只允许把结果写到这个目录之内（默认：各任务的源目录之内）")
+    parser.add_argument("--max-converters", type=int, default=None, help="所有任务合计同时运行的Word/LibreOffice实例数（默认：同 --converter-workers）")
+    parser.add_argument("--log", default="-", help="日志输出文件，'-' 表示标准错误（默认）")
+    parser.add_argument("--workers", type=int, default=None, help="并行解析文档的线程数（默认：CPU核数）")
+    parser.add_argument("--page-estimator", choices=sorted(PAGE_ESTIMATORS), default="layout", help="页数估算模型（默认：layout）")
+    parser.add_argument("--word-pages", choices=("exact", "fast"), default="exact", help="Word API路径的页码：合并完成后从书签统一读取，exact读取前先完整重新分页")
+    parser.add_argument("--split-size", type=float, metavar="MB", help="分卷输出：每卷输入文件合计不超过这么多MB")
+    parser.add_argument("--split-pages", type=int, help="分卷输出：每卷估算页数上限")
+    parser.add_argument("--split-files", type=int, help="分卷输出：每卷文件数上限")
+    parser.add_argument("--split-index", action="store_true", help="分卷时另写一份链接到各卷的总目录")
+    parser.add_argument("--duplicates", choices=("off", "report", "skip"), default="off",
+                        help="合并前检测重复输入（同一文档的多个副本、正文相同或高度相似的文件）：report只列出，skip跳过后来的副本")
+    parser.add_argument("--similarity", type=float, default=0.9, help="近似重复的相似度阈值，0-1（默认0.9，1表示只检测正文完全相同）")
+    parser.add_argument("--toc-pages", choices=("static", "field", "update"), default="static",
+                        help="目录页码：static写入估算或Word读取的数字（默认），field写成PAGEREF域、打开文档时更新，"
+                             "update写成域后用Word/LibreOffice无界面更新一次")
+    parser.add_argument("--word-app", choices=("word", "fake"), default="word", help="Word API路径使用的Word应用，fake为不需要Word的测试替身")
+    parser.add_argument("--converter", choices=("auto",) + tuple(CONVERTERS), default="auto", help=".doc转换后端（默认：Windows用Word，其他系统用LibreOffice）")
+    parser.add_argument("--converter-workers", type=int, default=DEFAULT_CONVERTER_WORKERS,
+                        help=f"并行转换.doc的Word/LibreOffice实例数（默认：{DEFAULT_CONVERTER_WORKERS}）")
+    parser.add_argument("--recycle-after", type=int, default=50, help="每个转换实例处理多少个文档后重启（默认：50）")
+    parser.add_argument("--cache-dir", help="转换缓存目录（默认：用户缓存目录下的merge_word/conversions）")
+    parser.add_argument("--cache-size", type=int, default=2048, help="转换缓存上限，单位MB，0表示不使用缓存（默认：2048）")
+    parser.add_argument("--incremental", action="store_true", help="流式合并时根据上次的清单只重新合并变化的文件")
+    parser.add_argument("--no-report", dest="report", action="store_false", help="不在输出旁写入 .report.json 运行报告")
+    parser.add_argument("--trace", action="store_true", help="同时写入 .trace.json（Chrome trace-event格式）")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", help="忽略检查点，从头开始合并")
+    parser.add_argument("--checkpoint-interval", type=int, default=60, help="写检查点的最短间隔（秒），0表示不写")
+    parser.add_argument("--no-dedupe", dest="dedupe", action="store_false", help="不合并重复的图片和编号定义")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9", help="XML部件的压缩级别，0不压缩，9最小（默认：6）；图片等已压缩的部件总是直接存储")
+    parser.add_argument("--progress", action="store_true", help="在标准错误输出处理进度")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不输出日志")
+    return parser
 
-                except Exception as e:
-                    error_msg = f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}"
-                    self.log(error_msg)
-                    continue
 
-            # 保存合并后的文档
-            self.log("保存合并后的文档...")
-            merged_doc.save(output_path)
-            
-            # 清理临时文件
-            for temp_file in temp_files:
-                try:
-                    os.remove(temp_file)
-                    self.log(f"清理临时文件：{os.path.basename(temp_file)}")
-                except:
-                    pass
-                    
-            return True
+def engine_options(args):
+    """从命令行参数得到MergeEngine的参数（不含日志和进度回调）"""
+    return dict(
+        workers=args.workers, page_estimator=args.page_estimator, word_pages=args.word_pages,
+        converter=args.converter, converter_workers=args.converter_workers, recycle_after=args.recycle_after,
+        cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 * 1024, incremental=args.incremental,
+        report=args.report, trace=args.trace, resume=args.resume, checkpoint_interval=args.checkpoint_interval,
+        subdirs=args.subdirs, include=args.include, exclude=args.exclude, sort=args.sort, order_file=args.order_file,
+        dedupe=args.dedupe, compresslevel=args.compress_level, word_app=args.word_app,
+        toc_pages=args.toc_pages, split_bytes=int(args.split_size * 1024 * 1024) if args.split_size else None,
+        split_pages=args.split_pages, split_files=args.split_files, split_index=args.split_index,
+        duplicates=args.duplicates, similarity=args.similarity,
+    )
 
-        except Exception as e:
-            self.log(f"简单追加合并失败：{str(e)}")
-            return False
 
-    def algorithm_windows(self, files, final_docx):
-        """Windows平台下的合并算法，增加关闭批注功能和页码记录"""
-        from win32com import client
-        word = None
+def main(argv=None):
+    """命令行入口"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.serve and args.directories:
+        parser.error("--serve 模式下目录通过接口提交，不在命令行给出")
+    if args.serve and not args.serve.startswith("unix:") and not args.allow_remote \
+            and not is_loopback_host(args.serve.rpartition(":")[0].strip("[]") or "127.0.0.1"):
+        parser.error("合并服务没有身份验证，绑定非本机地址需要 --allow-remote")
+    if not args.directories and not args.serve:
+        app = WordMergerApp()
+        app.mainloop()
+        return 0
+    batch = args.recursive or len(args.directories) > 1 or any(glob.has_magic(d) for d in args.directories)
+    if batch and args.output:
+        parser.error("批量合并多个目录时请用 --output-dir 指定输出目录")
+    if args.output and args.output_dir:
+        parser.error("--output 和 --output-dir 只能指定一个")
+
+    log_file = None
+    if args.quiet:
+        log = None
+    elif args.log == "-":
+        def log(message):
+            print(message, file=sys.stderr, flush=True)
+    else:
+        log_file = open(args.log, "a", encoding="utf-8")
+
+        def log(message):
+            log_file.write(message + "\n")
+            log_file.flush()
+
+    if args.serve:
         try:
-            word = client.gencache.EnsureDispatch('Word.Application')
-            word.Visible = False
-            new_document = word.Documents.Add()
-            current_page = 1
-            self.file_page_map = {}  # 重置文件页码映射
-            
-            # 添加一个空白页用于目录
-            new_document.Content.InsertAfter("\n")
-            
-            for i, fn in enumerate(files):
-                self.log(f"正在合并文件：{os.path.basename(fn)}")
-                fn = os.path.abspath(fn)
-                
-                # 获取当前页码
-                current_page = new_document.ComputeStatistics(2)  # 2 = wdStatisticPages
-                
-                # 创建唯一书签名
-                bookmark_name = f"bookmark_{i+1}"
-                
-                # 在当前位置添加书签
-                end_position = new_document.Content.End - 1
-                new_document.Bookmarks.Add(bookmark_name, new_document.Range(end_position, end_position))
-                
-                # 记录当前页码和书签
-                self.file_page_map[fn] = {
-                    'page': current_page,
-                    'bookmark': bookmark_name
-                }
-                
-                # 打开文档
-                temp_document = word.Documents.Open(fn)
-                
-                # 关闭批注功能
-                if temp_document.TrackRevisions:
-                    temp_document.TrackRevisions = False
-                
-                # 接受所有修订
-                temp_document.Revisions.AcceptAll()
-                
-                # 复制内容
-                temp_document.Content.Copy()
-                
-                # 移动到文档末尾并粘贴
-                end_range = new_document.Range(new_document.Content.End - 1, new_document.Content.End - 1)
-                end_range.Paste()
-                
-                # 添加分页符（除了最后一个文档）
-                if i < len(files) - 1:
-                    end_range = new_document.Range(new_document.Content.End - 1, new_document.Content.End - 1)
-                    end_range.InsertBreak(7)  # 7 = wdPageBreak
-                
-                # 关闭临时文档
-                temp_document.Close(SaveChanges=False)
-                self.log(f"成功合并：{os.path.basename(fn)}")
-            
-            # 保存合并后的文档
-            self.log("保存合并后的文档...")
-            new_document.SaveAs(final_docx)
-            new_document.Close(SaveChanges=False)
-            return True
-        except Exception as e:
-            error_msg = f"算法错误: {str(e)}"
-            self.log(error_msg)
-            messagebox.showerror("错误", error_msg)
-            return False
+            return serve(args.serve, engine_options(args), args.jobs, log, args.allow_remote, args.output_root)
         finally:
-            # 确保在任何情况下都关闭Word
-            if word:
-                word.Quit()
+            if log_file:
+                log_file.close()
 
-    # 修改其他合并方法，添加关闭批注功能和页码记录
-    def merge_with_word_api(self, output_path, doc_files):
-        """使用 Word API 合并算法，增加关闭批注功能和页码记录"""
-        word = None
-        try:
-            word = win32.gencache.EnsureDispatch("Word.Application")
-            word.Visible = False
-            merged_doc = word.Documents.Add()
-            self.file_page_map = {}  # 重置文件页码映射
-            
-            # 添加一个空白页用于目录
-            merged_doc.Content.InsertAfter("\n")
-            
-            for i, file_path in enumerate(doc_files):
-                try:
-                    self.log(f"正在合并文件：{os.path.basename(file_path)}")
-                    
-                    # 获取当前页码
-                    current_page = merged_doc.ComputeStatistics(2)  # 2 = wdStatisticPages
-                    
-                    # 创建唯一书签名
-                    bookmark_name = f"bookmark_{i+1}"
-                    
-                    # 在当前位置添加书签
-                    end_position = merged_doc.Content.End - 1
-                    merged_doc.Bookmarks.Add(bookmark_name, merged_doc.Range(end_position, end_position))
-                    
-                    # 记录当前页码和书签
-                    self.file_page_map[file_path] = {
-                        'page': current_page,
-                        'bookmark': bookmark_name
-                    }
-                    
-                    self.log(f"添加书签: {bookmark_name}, 页码: {current_page}, 文件: {os.path.basename(file_path)}")
-                    
-                    # 打开文档
-                    try:
-                        doc = word.Documents.Open(file_path)
-                        
-                        # 关闭批注功能
-                        if doc.TrackRevisions:
-                            doc.TrackRevisions = False
-                        
-                        # 接受所有修订
-                        doc.Revisions.AcceptAll()
-                        
-                        # 复制内容
-                        doc.Content.Copy()
-                        
-                        # 移动到文档末尾并粘贴
-                        end_range = merged_doc.Range(merged_doc.Content.End - 1, merged_doc.Content.End - 1)
-                        end_range.Paste()
-                        
-                        # 添加分页符（除了最后一个文档）
-                        if i < len(doc_files) - 1:
-                            end_range = merged_doc.Range(merged_doc.Content.End - 1, merged_doc.Content.End - 1)
-                            end_range.InsertBreak(7)  # 7 = wdPageBreak
-                        
-                        # 关闭临时文档
-                        doc.Close(SaveChanges=False)
-                        self.log(f"成功合并：{os.path.basename(file_path)}")
-                    except Exception as e:
-                        error_msg = f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}"
-                        self.log(error_msg)
-                        continue
-                        
-                except Exception as e:
-                    error_msg = f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}"
-                    self.log(error_msg)
-                    continue
+    progress = None
+    if args.progress:
+        def progress(done, total, file_path):
+            print(f"[{done}/{total}] {os.path.basename(file_path)}", file=sys.stderr, flush=True)
 
-            # 保存合并后的文档
-            self.log("保存合并后的文档...")
-            merged_doc.SaveAs(output_path)
-            merged_doc.Close(SaveChanges=False)
-            return True
+    # Ctrl+C 在当前文件完成后取消（支持的算法会先写检查点），再按一次立即退出
+    job = make_batch_job() if batch else MergeJob()
 
-        except Exception as e:
-            self.log(f"Word API 合并失败：{str(e)}")
-            return False
-        finally:
-            # 确保在任何情况下都关闭Word
-            try:
-                if word:
-                    word.Quit()
-            except:
-                pass
+    def interrupt(signum, frame):
+        if job.cancelled.is_set():
+            raise KeyboardInterrupt
+        print("正在取消，当前文件完成后停止（再按一次 Ctrl+C 立即退出）", file=sys.stderr, flush=True)
+        job.cancel()
 
-    def merge_with_format(self, output_path, doc_files):
-        """保留格式合并算法，使用python-docx和docxcompose库"""
-        try:
-            # 筛选出可以处理的.docx文件
-            valid_files = []
-            self.file_page_map = {}  # 重置文件页码映射
-            current_page = 0
-            
-            # 预处理：将.doc文件转换为.docx
-            temp_files = []
-            for i, file_path in enumerate(doc_files):
-                try:
-                    self.log(f"正在处理文件：{os.path.basename(file_path)}")
-                    
-                    # 如果是.doc文件，先转换为.docx
-                    if file_path.lower().endswith('.doc'):
-                        self.log(f"转换.doc文件为.docx: {os.path.basename(file_path)}")
-                        # 使用Word COM接口转换
-                        word = win32.Dispatch("Word.Application")
-                        word.Visible = False
-                        try:
-                            # 打开.doc文件
-                            doc = word.Documents.Open(file_path)
-                            # 创建临时.docx文件路径
-                            temp_docx = os.path.join(os.path.dirname(output_path), f"temp_{i}_{os.path.basename(file_path)}x")
-                            # 保存为.docx
-                            doc.SaveAs(temp_docx, 16)  # 16 = wdFormatDocumentDefault (.docx)
-                            doc.Close()
-                            word.Quit()
-                            # 添加到临时文件列表
-                            temp_files.append(temp_docx)
-                            # 使用转换后的文件
-                            file_path = temp_docx
-                        except Exception as e:
-                            self.log(f"转换文件失败: {str(e)}")
-                            word.Quit()
-                            continue
-                    
-                    # 创建唯一书签名
-                    bookmark_name = f"bookmark_{i+1}"
-                    
-                    # 记录当前页码和书签
-                    self.file_page_map[file_path] = {
-                        'page': current_page,
-                        'bookmark': bookmark_name
-                    }
-                    
-                    # 尝试打开文件验证其有效性
-                    try:
-                        doc = Document(file_path)
-                        # 估算页数 (粗略计算，每页约2000个字符)
-                        text_length = 0
-                        for para in doc.paragraphs:
-                            text_length += len(para.text)
-                        # 更新当前页码 (粗略估计)
-                        page_count = max(1, text_length // 2000)
-                        current_page += page_count
-                        
-                        valid_files.append(file_path)
-                        self.log(f"成功验证文件：{os.path.basename(file_path)}, 估计页数: {page_count}")
-                    except Exception as e:
-                        self.log(f"无法打开文件 {os.path.basename(file_path)}: {str(e)}")
-                        continue
-                    
-                except Exception as e:
-                    error_msg = f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}"
-                    self.log(error_msg)
-                    continue
-            
-            if not valid_files:
-                self.log("没有有效的文件可以合并")
-                return False
-                
-            # 使用docxcompose合并有效的文件
-            self.log("开始合并有效的文件...")
-            merged_doc = Document()
-            composer = Composer(merged_doc)
-            
-            for file_path in valid_files:
-                try:
-                    self.log(f"合并文件：{os.path.basename(file_path)}")
-                    doc = Document(file_path)
-                    composer.append(doc)
-                    self.log(f"成功合并：{os.path.basename(file_path)}")
-                except Exception as e:
-                    self.log(f"合并文件 {os.path.basename(file_path)} 时出错：{str(e)}")
-            
-            # 保存合并后的文档
-            self.log("保存合并后的文档...")
-            composer.save(output_path)
-            
-            # 清理临时文件
-            for temp_file in temp_files:
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
-                    
-            return True
-            
-        except Exception as e:
-            self.log(f"保留格式合并失败：{str(e)}")
-            return False
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, interrupt)
+
+    try:
+        if batch:
+            directories = expand_directories(args.directories, args.recursive)
+            if not directories:
+                print("没有找到要合并的目录", file=sys.stderr)
+                return 2
+            results = run_jobs(
+                directories, args.algorithm, args.output_dir, engine_options(args), args.jobs,
+                args.max_converters or args.converter_workers, log=log, progress=progress, job=job,
+            )
+            failed = [r for r in results if not r[1]]
+            print(f"完成 {len(results) - len(failed)}/{len(directories)} 个目录", file=sys.stderr)
+            return 1 if failed or len(results) < len(directories) else 0
+        engine = MergeEngine(log=log, progress=progress, **engine_options(args))
+        output = args.output
+        if args.output_dir:
+            # 与批量合并相同，按源目录名放到输出目录中
+            output = job_output_paths([os.path.abspath(args.directories[0])], args.output_dir)[0]
+        output_path = engine.run(args.directories[0], args.algorithm, output, job)
+    except MergeError as e:
+        print(f"{e.title}：{e.message}", file=sys.stderr)
+        return 2
+    finally:
+        if log_file:
+            log_file.close()
+    return 0 if output_path else 1
 
-    def merge_with_docxcompose(self, output_path, doc_files):
-        """使用 docxcompose 合并算法，增加页码记录和书签支持"""
-        try:
-            # 筛选出可以处理的.docx文件
-            valid_files = []
-            self.file_page_map = {}  # 重置文件页码映射
-            current_page = 0
-            
-            # 预处理：将.doc文件转换为.docx
-            temp_files = []
-            for i, file_path in enumerate(doc_files):
-                try:
-                    self.log(f"正在处理文件：{os.path.basename(file_path)}")
-                    file_path = os.path.abspath(file_path)  # 确保使用绝对路径
-                    
-                    # 如果是.doc文件，先转换为.docx
-                    if file_path.lower().endswith('.doc'):
-                        self.log(f"转换.doc文件为.docx: {os.path.basename(file_path)}")
-                        # 使用Word COM接口转换
-                        word = None
-                        try:
-                            word = win32.Dispatch("Word.Application")
-                            word.Visible = False
-                            
-                            # 打开.doc文件
-                            doc = word.Documents.Open(file_path)
-                            # 创建临时.docx文件路径
-                            temp_docx = os.path.join(os.path.dirname(output_path), f"temp_{i}_{os.path.basename(file_path)}x")
-                            # 保存为.docx
-                            doc.SaveAs(temp_docx, 16)  # 16 = wdFormatDocumentDefault (.docx)
-                            doc.Close(SaveChanges=False)
-                            
-                            # 添加到临时文件列表
-                            temp_files.append(temp_docx)
-                            # 使用转换后的文件
-                            file_path = temp_docx
-                            self.log(f"成功转换文件：{os.path.basename(file_path)}")
-                        except Exception as e:
-                            self.log(f"转换文件失败: {str(e)}")
-                            continue
-                        finally:
-                            if word:
-                                try:
-                                    word.Quit()
-                                except:
-                                    pass
-                    
-                    # 创建唯一书签名
-                    bookmark_name = f"bookmark_{i+1}"
-                    
-                    # 尝试打开文件验证其有效性
-                    try:
-                        doc = Document(file_path)
-                        
-                        # 估算页数 (粗略计算，每页约2000个字符)
-                        text_length = 0
-                        for para in doc.paragraphs:
-                            text_length += len(para.text)
-                        # 更新当前页码 (粗略估计)
-                        page_count = max(1, text_length // 2000)
-                        
-                        # 记录当前页码和书签
-                        self.file_page_map[file_path] = {
-                            'page': current_page,
-                            'bookmark': bookmark_name
-                        }
-                        
-                        current_page += page_count
-                        valid_files.append(file_path)
-                        self.log(f"成功验证文件：{os.path.basename(file_path)}, 估计页数: {page_count}")
-                    except Exception as e:
-                        self.log(f"无法打开文件 {os.path.basename(file_path)}: {str(e)}")
-                        continue
-                    
-                except Exception as e:
-                    error_msg = f"处理文件 {os.path.basename(file_path)} 时出错：{str(e)}"
-                    self.log(error_msg)
-                    continue
-            
-            if not valid_files:
-                self.log("没有有效的文件可以合并")
-                return False
-                
-            # 使用docxcompose合并有效的文件
-            self.log("开始合并有效的文件...")
-            merged_doc = Document()
-            composer = Composer(merged_doc)
-            
-            for file_path in valid_files:
-                try:
-                    self.log(f"合并文件：{os.path.basename(file_path)}")
-                    doc = Document(file_path)
-                    composer.append(doc)
-                    self.log(f"成功合并：{os.path.basename(file_path)}")
-                except Exception as e:
-                    self.log(f"合并文件 {os.path.basename(file_path)} 时出错：{str(e)}")
-                    continue
-            
-            # 保存合并后的文档
-            self.log("保存合并后的文档...")
-            composer.save(output_path)
-            
-            # 清理临时文件
-            for temp_file in temp_files:
-                try:
-                    os.remove(temp_file)
-                    self.log(f"清理临时文件：{os.path.basename(temp_file)}")
-                except:
-                    pass
-                    
-            return True
-            
-        except Exception as e:
-            self.log(f"docxcompose 合并失败：{str(e)}")
-            return False
 
 if __name__ == "__main__":
-    app = WordMergerApp()
-    app.mainloop()
\ No newline at end of file
+    multiprocessing.freeze_support()  # 打包成exe后批量合并的工作进程需要
+    sys.exit(main())
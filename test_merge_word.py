@@ -0,0 +1,811 @@
+"""merge_word 的单元测试，用 FakeConverter / FakeWordApplication 代替Word和LibreOffice
+
+    python -m pytest -q
+"""
+import http.client
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+
+import pytest
+from docx import Document
+from docx.shared import Pt
+from lxml import etree
+
+import merge_word
+from benchmark_merge import make_png
+from merge_word import ConverterPool, LibreOfficeConverter, MergeEngine
+
+
+def make_docx(path, *paragraphs):
+    """生成只含若干段落的.docx"""
+    doc = Document()
+    for text in paragraphs:
+        doc.add_paragraph(text)
+    doc.save(str(path))
+    return str(path)
+
+
+def body_texts(path):
+    return [p.text for p in Document(str(path)).paragraphs if p.text]
+
+
+# ---- 转换池 ----
+
+class BrokenConverter:
+    """start()总是失败的转换器"""
+
+    name = "broken"
+    version = "broken-1"
+    closed = 0
+
+    def start(self):
+        raise RuntimeError("无法启动")
+
+    def close(self):
+        BrokenConverter.closed += 1
+
+
+def test_converter_start_failure_fails_futures(tmp_path, monkeypatch):
+    monkeypatch.setattr(BrokenConverter, "closed", 0)
+    src = tmp_path / "a.doc"
+    src.write_bytes(b"x")
+    pool = ConverterPool(BrokenConverter, size=2)
+    futures = [pool.submit(str(src), str(tmp_path / f"{i}.docx")) for i in range(5)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="无法启动"):
+            future.result(timeout=5)
+    pool.close()
+    assert all(not t.is_alive() for t in pool.threads)
+    assert BrokenConverter.closed >= 5  # 启动失败的实例也被清理
+
+
+def test_submit_after_close_fails_immediately(tmp_path):
+    pool = ConverterPool("fake", size=1)
+    pool.close()
+    with pytest.raises(RuntimeError):
+        pool.submit(str(tmp_path / "a.doc"), str(tmp_path / "a.docx")).result(timeout=5)
+
+
+def test_libreoffice_close_without_start():
+    converter = LibreOfficeConverter()
+    converter.close()
+
+
+def test_missing_libreoffice_skips_doc_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda name: None)
+    for i in range(4):
+        (tmp_path / f"{i}.doc").write_bytes(b"not a word file")
+    make_docx(tmp_path / "5.docx", "正文")
+    engine = MergeEngine(converter="libreoffice", cache_size=0, resume=False)
+    output = engine.run(str(tmp_path), "simple", str(tmp_path / "out" / "o.docx"))
+    assert output is not None
+    assert "正文" in body_texts(output)
+    assert list(engine.file_page_map) == [str(tmp_path / "5.docx")]
+
+
+class CountingConverter(merge_word.FakeConverter):
+    """记录同时存在的实例数"""
+
+    lock = threading.Lock()
+    live = 0
+    peak = 0
+
+    @classmethod
+    def reset(cls):
+        cls.live = cls.peak = 0
+
+    def start(self):
+        with CountingConverter.lock:
+            CountingConverter.live += 1
+            CountingConverter.peak = max(CountingConverter.peak, CountingConverter.live)
+
+    def convert(self, src, dst):
+        time.sleep(0.02)
+        super().convert(src, dst)
+
+    def close(self):
+        with CountingConverter.lock:
+            CountingConverter.live -= 1
+
+
+@pytest.fixture
+def counting_converter():
+    CountingConverter.reset()
+    yield CountingConverter
+    CountingConverter.reset()
+
+
+def test_slots_limit_live_instances_across_pools(tmp_path, counting_converter):
+    slots = threading.BoundedSemaphore(2)
+    src = make_docx(tmp_path / "a.doc", "x")
+    pools = [ConverterPool(counting_converter, size=3, slots=slots) for _ in range(3)]
+    futures = [pool.submit(src, str(tmp_path / f"{n}_{i}.docx")) for n, pool in enumerate(pools) for i in range(6)]
+    for future in futures:
+        future.result(timeout=30)
+    for pool in pools:
+        pool.close()
+    assert 1 <= counting_converter.peak <= 2
+    assert counting_converter.live == 0
+
+
+def test_output_dir_honored_for_single_directory(tmp_path):
+    source = tmp_path / "章节"
+    source.mkdir()
+    make_docx(source / "1.docx", "正文")
+    assert merge_word.main([str(source), "--output-dir", str(tmp_path / "out"), "-q", "--cache-size", "0"]) == 0
+    assert os.path.exists(tmp_path / "out" / "章节.docx")
+
+
+def test_output_and_output_dir_rejected(tmp_path):
+    with pytest.raises(SystemExit):
+        merge_word.main([str(tmp_path), "-o", str(tmp_path / "a.docx"), "--output-dir", str(tmp_path / "out")])
+
+
+# ---- 文件发现 ----
+
+def test_natural_sort_compares_stem_before_extension(tmp_path):
+    for name in ("报告(1).docx", "报告.docx", "第十章.docx", "第九章.docx", "2.docx", "10.docx"):
+        make_docx(tmp_path / name, name)
+    names = [entry.rel for entry in merge_word.discover_files(str(tmp_path))]
+    assert names.index("报告.docx") < names.index("报告(1).docx")
+    assert names.index("第九章.docx") < names.index("第十章.docx")
+    assert names.index("2.docx") < names.index("10.docx")
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="需要符号链接")
+def test_recursive_discovery_skips_directory_symlinks(tmp_path):
+    make_docx(tmp_path / "1.docx", "一")
+    (tmp_path / "a").mkdir()
+    make_docx(tmp_path / "a" / "2.docx", "二")
+    os.symlink("..", tmp_path / "a" / "loop")  # 指回上级目录，形成环
+    os.symlink("a", tmp_path / "b")  # 同一目录的第二个名字
+    rels = [entry.rel for entry in merge_word.discover_files(str(tmp_path), recursive=True)]
+    assert rels == ["1.docx", "a/2.docx"]
+
+
+def make_tree(root, *rels):
+    """创建空的输入文件，发现文件时不读取内容"""
+    for rel in rels:
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_bytes(b"")
+
+
+def test_discovery_filters_relative_paths_and_names(tmp_path):
+    make_tree(tmp_path, "1.docx", "2.doc", "草稿1.docx", "~$1.docx", "说明.txt",
+              "a/3.docx", "a/b/4.docx", "合并结果/合并.docx")
+    discover = merge_word.discover_files
+    assert [e.rel for e in discover(str(tmp_path), recursive=True)] == ["1.docx", "2.doc", "a/3.docx", "a/b/4.docx", "草稿1.docx"]
+    assert [e.rel for e in discover(str(tmp_path), recursive=True, include=["*.docx"], exclude=["草稿*", "a/b/*"])] == ["1.docx", "a/3.docx"]
+    assert [e.rel for e in discover(str(tmp_path), include=["a/*"], recursive=True)] == ["a/3.docx", "a/b/4.docx"]
+
+
+def test_order_file_lists_files_first(tmp_path):
+    make_tree(tmp_path, "1.docx", "2.docx", "3.docx", "a/4.docx")
+    (tmp_path / merge_word.ORDER_FILE_NAME).write_text("# 先放附录\n\nA/4.docx\n3.docx\n不存在.docx\n3.docx\n", encoding="utf-8")
+    rels = [e.rel for e in merge_word.discover_files(str(tmp_path), recursive=True)]
+    assert rels == ["a/4.docx", "3.docx", "1.docx", "2.docx"]  # 未列出的按自然顺序排在后面
+    explicit = tmp_path / "order.txt"
+    explicit.write_text("2.docx\n", encoding="utf-8")
+    rels = [e.rel for e in merge_word.discover_files(str(tmp_path), order_file=str(explicit))]
+    assert rels == ["2.docx", "1.docx", "3.docx"]  # 明确指定的顺序文件优先于目录中的
+
+
+# ---- 重复输入检测 ----
+
+LONG_TEXT = "第一章 总则。本办法适用于所有部门的年度预算编制、审核和执行情况的汇总与报告工作。"
+
+
+def test_duplicate_keeps_shortest_name(tmp_path):
+    make_docx(tmp_path / "报告.docx", LONG_TEXT)
+    shutil.copy(tmp_path / "报告.docx", tmp_path / "报告(1).docx")
+    copy, original = str(tmp_path / "报告(1).docx"), str(tmp_path / "报告.docx")
+    # 副本排在前面时也保留原件
+    found = merge_word.find_duplicates([copy, original])
+    assert [(path, dup_of) for path, dup_of, _, _ in found] == [(copy, original)]
+
+
+def test_duplicate_keeper_uses_cached_mtime(tmp_path):
+    make_docx(tmp_path / "a.docx", LONG_TEXT)
+    shutil.copy(tmp_path / "a.docx", tmp_path / "b.docx")
+    os.utime(tmp_path / "a.docx", ns=(1, 1))  # 磁盘上a更早
+    engine = MergeEngine(duplicates="skip")
+    files = engine.collect_files(str(tmp_path))
+    # 发现阶段缓存的修改时间中b更早，去重时不再重新stat
+    engine.file_stats = {path: entry._replace(st_mtime_ns=2 if path.endswith("a.docx") else 1)
+                         for path, entry in engine.file_stats.items()}
+    assert [os.path.basename(f) for f in engine.check_duplicates(files)] == ["b.docx"]
+
+
+def test_near_duplicate_detected(tmp_path):
+    make_docx(tmp_path / "a.docx", LONG_TEXT * 4)
+    make_docx(tmp_path / "b.docx", LONG_TEXT * 4 + "补充说明")
+    make_docx(tmp_path / "c.docx", "完全不同的内容，关于会议纪要的整理和归档要求，以及后续跟进事项。" * 4)
+    found = merge_word.find_duplicates([str(tmp_path / name) for name in ("a.docx", "b.docx", "c.docx")], 0.8)
+    assert [(os.path.basename(p), os.path.basename(o), kind) for p, o, kind, _ in found] == [("b.docx", "a.docx", "near")]
+
+
+def test_missing_main_part_is_not_comparable(tmp_path):
+    broken = tmp_path / "broken.docx"
+    with zipfile.ZipFile(broken, "w") as z:
+        z.writestr("[Content_Types].xml", "<Types/>")
+    assert merge_word.normalized_text(str(broken)) is None
+    make_docx(tmp_path / "ok.docx", LONG_TEXT)
+    assert merge_word.find_duplicates([str(broken), str(tmp_path / "ok.docx")]) == []
+
+
+# ---- 页数估算 ----
+
+def test_layout_nested_table_counted_once(tmp_path):
+    document = Document()
+    outer = document.add_table(rows=1, cols=2)
+    outer.cell(0, 0).paragraphs[0].text = "外层"
+    outer.cell(0, 1).add_table(rows=3, cols=1)
+    estimator = merge_word.LayoutEstimator()
+    estimator.feed(outer._tbl)
+    assert len(estimator.blocks) == 1
+    width, height, fixed = estimator.blocks[0]
+    # 嵌套表格的三行计入外层单元格的高度
+    assert height > 3 * merge_word.DEFAULT_FONT_SIZE * 20 * 1.2
+
+
+# ---- 目录 ----
+
+def toc_links(path):
+    """返回 (目录项的书签锚点列表, 正文中的书签名集合, document.xml根元素)"""
+    with zipfile.ZipFile(path) as z:
+        root = etree.fromstring(z.read("word/document.xml"))
+    anchors = [link.get(merge_word.w("anchor")) for link in root.iter(merge_word.w("hyperlink"))]
+    bookmarks = {mark.get(merge_word.w("name")) for mark in root.iter(merge_word.w("bookmarkStart"))}
+    return anchors, bookmarks, root
+
+
+@pytest.mark.parametrize("algorithm", ["fast", "stream"])
+def test_toc_entries_link_to_file_bookmarks(tmp_path, algorithm):
+    source = make_inputs(tmp_path / "src", 3)
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, report=False, resume=False).run(str(source), algorithm, output)
+    anchors, bookmarks, _ = toc_links(output)
+    assert anchors == ["bookmark_1", "bookmark_2", "bookmark_3"]
+    assert set(anchors) <= bookmarks
+    assert body_texts(output)[:5] == ["目录", "1\t1", "2\t2", "3\t3", "第1个文件"]  # 每个文件一页
+
+
+@pytest.mark.parametrize("algorithm", ["fast", "stream"])
+def test_field_toc_pages_use_pageref(tmp_path, algorithm):
+    source = make_inputs(tmp_path / "src", 3)
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, report=False, resume=False, toc_pages="field").run(str(source), algorithm, output)
+    anchors, bookmarks, root = toc_links(output)
+    fields = [text.text.split() for text in root.iter(merge_word.w("instrText"))]
+    assert fields == [["PAGEREF", anchor, "\\h"] for anchor in anchors]
+    assert set(anchors) <= bookmarks
+    with zipfile.ZipFile(output) as z:
+        settings = etree.fromstring(z.read("word/settings.xml"))
+    flag = settings.find(merge_word.w("updateFields"))
+    assert flag.get(merge_word.w("val")) == "true"
+    assert not any(child.tag in merge_word._SETTINGS_AFTER_UPDATE_FIELDS for child in flag.itersiblings(preceding=True))
+
+
+# ---- 运行报告 ----
+
+def test_run_writes_report_and_trace(tmp_path):
+    source = make_inputs(tmp_path / "src", 3)
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, resume=False, trace=True).run(str(source), "stream", output)
+    with open(tmp_path / "合并.report.json", encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["success"] and report["algorithm"] == "stream"
+    assert report["output_bytes"] == os.path.getsize(output)
+    assert report["stages"]["append"]["count"] == 3
+    assert report["wall_seconds"] >= report["stages"]["append"]["seconds"]
+    assert [os.path.basename(stats["path"]) for stats in report["files"]] == ["1.docx", "2.docx", "3.docx"]
+    assert all(stats["stages"]["append"] >= 0 for stats in report["files"])
+    with open(tmp_path / "合并.trace.json", encoding="utf-8") as f:
+        events = json.load(f)["traceEvents"]
+    assert sum(event["cat"] == "append" for event in events) == 3
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+
+# ---- 分卷输出 ----
+
+def make_inputs(directory, count):
+    directory.mkdir(exist_ok=True)
+    for n in range(1, count + 1):
+        make_docx(directory / f"{n}.docx", f"第{n}个文件")
+    return directory
+
+
+def volume_engine(**options):
+    return MergeEngine(cache_size=0, report=False, resume=False, workers=2, **options)
+
+
+def test_split_by_file_count(tmp_path):
+    source = make_inputs(tmp_path / "src", 5)
+    engine = volume_engine(split_files=2)
+    engine.run(str(source), "stream", str(tmp_path / "合并.docx"))
+    assert [os.path.basename(v) for v in engine.volumes] == ["合并_第1卷.docx", "合并_第2卷.docx", "合并_第3卷.docx"]
+    assert "第5个文件" in body_texts(engine.volumes[2])
+
+
+def test_split_skips_input_that_vanishes(tmp_path, monkeypatch):
+    source = make_inputs(tmp_path / "src", 4)
+    vanishing = os.path.abspath(source / "2.docx")
+    original_sha256 = merge_word.file_sha256
+
+    def hash_then_delete(file_path):
+        # 计算完哈希、写入之前文件被删除
+        digest = original_sha256(file_path)
+        if os.path.abspath(file_path) == vanishing:
+            os.remove(file_path)
+        return digest
+
+    monkeypatch.setattr(merge_word, "file_sha256", hash_then_delete)
+    logs = []
+    engine = volume_engine(split_files=2, log=logs.append)
+    engine.run(str(source), "stream", str(tmp_path / "合并.docx"))
+    assert any("2.docx" in line and "出错" in line for line in logs)
+    texts = [text for volume in engine.volumes for text in body_texts(volume)]
+    assert all(f"第{n}个文件" in texts for n in (1, 3, 4))
+    assert "第2个文件" not in texts
+
+
+# ---- 输出写入 ----
+
+def mixed_inputs(directory):
+    """两个.docx和一个需要转换的.doc"""
+    make_inputs(directory, 2)
+    make_docx(directory / "3.doc", "第3个文件")
+    return directory
+
+
+def leftovers(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("temp_") or name.endswith(".partial"))
+
+
+def test_failed_stream_merge_keeps_previous_output(tmp_path, monkeypatch):
+    source = mixed_inputs(tmp_path / "src")
+    output = tmp_path / "out" / "合并.docx"
+    engine_options = dict(converter="fake", cache_size=0, report=False)
+    assert MergeEngine(**engine_options).run(str(source), "stream", str(output))
+    previous = output.read_bytes()
+
+    def broken_toc(*args, **kwargs):
+        raise RuntimeError("写目录失败")
+
+    monkeypatch.setattr(merge_word, "build_toc_xml", broken_toc)
+    assert MergeEngine(**engine_options).run(str(source), "stream", str(output)) is None
+    assert output.read_bytes() == previous
+    assert leftovers(output.parent) == []
+
+
+def test_failed_save_keeps_previous_output_and_cleans_temp_files(tmp_path, monkeypatch):
+    source = mixed_inputs(tmp_path / "src")
+    output = tmp_path / "out" / "合并.docx"
+    engine_options = dict(converter="fake", cache_size=0, report=False, resume=False)
+    assert MergeEngine(**engine_options).run(str(source), "simple", str(output))
+    previous = output.read_bytes()
+
+    def broken_write(self, pack_uri, blob):
+        raise OSError("磁盘已满")
+
+    monkeypatch.setattr(merge_word._PartWriter, "write", broken_write)
+    assert MergeEngine(**engine_options).run(str(source), "simple", str(output)) is None
+    assert output.read_bytes() == previous
+    assert leftovers(output.parent) == []
+
+
+# ---- 保留格式合并 ----
+
+@pytest.mark.parametrize("algorithm", ["fast", "format", "docxcompose"])
+def test_composed_merge_keeps_input_style_definitions(tmp_path, algorithm):
+    source = tmp_path / "src"
+    source.mkdir()
+    for n in range(1, 3):
+        document = Document()
+        document.styles["Normal"].font.size = Pt(14)
+        document.styles["Normal"].font.name = "宋体"
+        document.add_heading(f"第{n}章", level=1)
+        document.add_paragraph(f"第{n}个文件")
+        document.save(source / f"{n}.docx")
+    output = str(tmp_path / "合并.docx")
+    assert MergeEngine(cache_size=0, report=False, resume=False).run(str(source), algorithm, output)
+    merged = Document(output)
+    assert merged.styles["Normal"].font.size == Pt(14)
+    assert merged.styles["Normal"].font.name == "宋体"
+    assert merged_texts(output) == ["第1个文件", "第2个文件"]
+
+
+# ---- 样式、编号和图片去重 ----
+
+def numbering_xml(*abstracts):
+    """abstracts 为 (abstractNumId, [引用它的numId...])，各定义内容相同"""
+    parts = []
+    for abstract_id, _ in abstracts:
+        parts.append(
+            f'<w:abstractNum w:abstractNumId="{abstract_id}"><w:nsid w:val="{abstract_id:08X}"/>'
+            '<w:lvl w:ilvl="0"><w:start w:val="1"/><w:numFmt w:val="decimal"/></w:lvl></w:abstractNum>'
+        )
+    for abstract_id, num_ids in abstracts:
+        parts += [f'<w:num w:numId="{n}"><w:abstractNumId w:val="{abstract_id}"/></w:num>' for n in num_ids]
+    return etree.fromstring(f'<w:numbering xmlns:w="{merge_word.W_NS}">{"".join(parts)}</w:numbering>')
+
+
+def test_dedupe_abstract_nums_restarts_redirected_lists():
+    root = numbering_xml((1, [1]), (2, [2]), (3, [3, 4]))
+    assert merge_word.dedupe_numbering_part(root) == 1
+    nums = {n.get(merge_word.w("numId")): n for n in root.findall(merge_word.w("num"))}
+
+    def target(num_id):
+        return nums[num_id].find(merge_word.w("abstractNumId")).get(merge_word.w("val"))
+
+    # 第二个输入的列表改指向第一个定义，并从头编号
+    assert target("2") == "1"
+    assert nums["2"].find(f"{merge_word.w('lvlOverride')}/{merge_word.w('startOverride')}").get(merge_word.w("val")) == "1"
+    # 被两个num引用、原本互相接续的定义不合并，也不加startOverride
+    assert target("3") == target("4") == "3"
+    assert nums["3"].find(merge_word.w("lvlOverride")) is None and nums["4"].find(merge_word.w("lvlOverride")) is None
+
+
+def make_picture_docx(path, image, text):
+    document = Document()
+    document.add_paragraph(text, style="List Number")
+    document.add_picture(str(image))
+    document.save(path)
+
+
+@pytest.mark.parametrize("algorithm", ["fast", "stream"])
+def test_merge_stores_identical_images_and_lists_once(tmp_path, algorithm):
+    image = tmp_path / "logo.png"
+    image.write_bytes(make_png(40, 20, (200, 0, 0)))
+    source = tmp_path / "src"
+    source.mkdir()
+    for n in range(1, 4):
+        make_picture_docx(source / f"{n}.docx", image, f"第{n}项")
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, report=False, resume=False).run(str(source), algorithm, output)
+    with zipfile.ZipFile(output) as z:
+        media = [name for name in z.namelist() if name.startswith("word/media/")]
+        numbering = etree.fromstring(z.read("word/numbering.xml"))
+    assert len(media) == 1
+    with zipfile.ZipFile(source / "1.docx") as z:
+        per_input = len(etree.fromstring(z.read("word/numbering.xml")).findall(merge_word.w("abstractNum")))
+    assert len(numbering.findall(merge_word.w("abstractNum"))) == per_input
+
+
+def repack_media(path, compress_type):
+    """按指定方式重新打包输入中的图片，其余成员不变"""
+    with zipfile.ZipFile(path) as z:
+        members = [(info, z.read(info)) for info in z.infolist()]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for info, data in members:
+            media = info.filename.startswith("word/media/")
+            z.writestr(info.filename, data, compress_type=compress_type if media else zipfile.ZIP_DEFLATED, compresslevel=1)
+
+
+def test_stream_merge_copies_media_members_unchanged(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    for n, compress_type in ((1, zipfile.ZIP_STORED), (2, zipfile.ZIP_DEFLATED)):
+        image = tmp_path / f"{n}.png"
+        image.write_bytes(make_png(40 * n, 20, (200, 0, 0)))
+        make_picture_docx(source / f"{n}.docx", image, f"第{n}项")
+        repack_media(source / f"{n}.docx", compress_type)
+    inputs = {}
+    for n in (1, 2):
+        with zipfile.ZipFile(source / f"{n}.docx") as z:
+            for info in z.infolist():
+                if info.filename.startswith("word/media/"):
+                    inputs[info.CRC] = (info.compress_type, info.compress_size)
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, report=False, resume=False).run(str(source), "stream", output)
+    with zipfile.ZipFile(output) as z:
+        assert z.testzip() is None
+        copied = {info.CRC: (info.compress_type, info.compress_size)
+                  for info in z.infolist() if info.filename.startswith("word/media/")}
+    assert copied == inputs  # 存储方式和压缩数据都原样保留
+
+
+def test_saved_document_stores_images_without_recompressing(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    image = tmp_path / "logo.png"
+    image.write_bytes(make_png(40, 20, (200, 0, 0)))
+    make_picture_docx(source / "1.docx", image, "第1项")
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, report=False, resume=False, compresslevel=1).run(str(source), "fast", output)
+    with zipfile.ZipFile(output) as z:
+        types = {info.filename: info.compress_type for info in z.infolist()}
+    assert [types[name] for name in types if name.startswith("word/media/")] == [zipfile.ZIP_STORED]
+    assert types["word/document.xml"] == zipfile.ZIP_DEFLATED
+
+
+# ---- 修订 ----
+
+def make_deleted_mark_docx(path):
+    """第一段的段落标记被修订删除：接受修订后“甲”并入下一段"""
+    document = Document()
+    first = document.add_paragraph("甲")
+    document.add_paragraph("乙")
+    document.add_paragraph("丙")
+    rpr = first._p.get_or_add_pPr().makeelement(merge_word.w("rPr"), {})
+    rpr.append(rpr.makeelement(merge_word.w("del"), {merge_word.w("id"): "1", merge_word.w("author"): "审阅"}))
+    first._p.get_or_add_pPr().append(rpr)
+    document.save(path)
+
+
+def test_accept_revisions_joins_paragraph_with_deleted_mark(tmp_path):
+    make_deleted_mark_docx(tmp_path / "rev.docx")
+    texts, _ = merge_word.scan_docx(str(tmp_path / "rev.docx"))
+    assert texts == ["甲乙", "丙"]
+
+
+@pytest.mark.parametrize("algorithm", ["simple", "fast", "stream"])
+def test_merge_joins_paragraph_with_deleted_mark(tmp_path, algorithm):
+    source = tmp_path / "src"
+    source.mkdir()
+    make_deleted_mark_docx(source / "rev.docx")
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(cache_size=0, report=False, resume=False).run(str(source), algorithm, output)
+    texts = body_texts(output)
+    assert "甲乙" in texts and "甲" not in texts and "乙" not in texts
+
+
+# ---- 转换缓存 ----
+
+class RecordingConverter(merge_word.FakeConverter):
+    """记录实际转换了哪些文件"""
+
+    converted = []
+
+    def convert(self, src, dst):
+        RecordingConverter.converted.append(src)
+        super().convert(src, dst)
+
+
+def test_cache_hit_skips_converter(tmp_path):
+    RecordingConverter.converted = []
+    src = tmp_path / "a.doc"
+    src.write_bytes(b"old word file")
+    cache = merge_word.ConversionCache(str(tmp_path / "cache"), 10 * 1024 ** 2)
+    pool = ConverterPool(RecordingConverter, size=1, cache=cache)
+    pool.submit(str(src), str(tmp_path / "1.docx")).result(timeout=10)
+    pool.submit(str(src), str(tmp_path / "2.docx")).result(timeout=10)
+    pool.close()
+    assert RecordingConverter.converted == [str(src)]
+    assert body_texts(tmp_path / "2.docx") == ["a.doc"]
+
+
+def test_cache_key_follows_content_not_name(tmp_path):
+    RecordingConverter.converted = []
+    first = tmp_path / "a.doc"
+    first.write_bytes(b"old word file")
+    renamed = tmp_path / "b.doc"
+    renamed.write_bytes(b"old word file")
+    changed = tmp_path / "c.doc"
+    changed.write_bytes(b"edited word file")
+    cache = merge_word.ConversionCache(str(tmp_path / "cache"), 10 * 1024 ** 2)
+    pool = ConverterPool(RecordingConverter, size=1, cache=cache)
+    for n, src in enumerate((first, renamed, changed)):
+        pool.submit(str(src), str(tmp_path / f"{n}.docx")).result(timeout=10)
+    pool.close()
+    assert RecordingConverter.converted == [str(first), str(changed)]
+    assert cache.key(str(first), "v1") != cache.key(str(first), "v2")  # 转换器升级后不再命中
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = merge_word.ConversionCache(str(tmp_path / "cache"), max_bytes=2500)
+    blob = tmp_path / "blob.docx"
+    blob.write_bytes(b"x" * 1000)
+    for n, key in enumerate(("aa1", "bb2", "cc3")):
+        cache.put(key, str(blob))
+        os.utime(cache._path(key), (n, n))
+    assert not cache.get("aa1", str(tmp_path / "1.docx"))
+    assert cache.get("cc3", str(tmp_path / "3.docx"))
+
+
+# ---- 流水线 ----
+
+def test_pipeline_yields_in_input_order():
+    def work(path):
+        if path == "f0":
+            time.sleep(0.05)  # 第一个文件最后完成
+        if path == "f3":
+            raise ValueError("坏文件")
+        return path.upper()
+
+    failed = Future()
+    failed.set_exception(RuntimeError("转换失败"))
+    inputs = [(i, f"f{i}", merge_word.resolved_future(f"f{i}")) for i in range(6)]
+    inputs[4] = (4, "f4", failed)
+    results = list(MergeEngine(workers=4).pipeline(inputs, work))
+    assert [i for i, *_ in results] == [0, 1, 2, 3, 5]  # 转换失败的文件跳过
+    assert results[0][3] == "F0"
+    assert isinstance(results[3][4], ValueError)
+
+
+def test_pipeline_limits_parsing_ahead_and_stops_on_close():
+    started = []
+
+    def work(path):
+        started.append(path)
+        return path
+
+    inputs = [(i, f"f{i}", merge_word.resolved_future(f"f{i}")) for i in range(10)]
+    results = MergeEngine(workers=1).pipeline(inputs, work)
+    assert next(results)[0] == 0
+    assert len(started) <= 2  # 最多领先调用方 workers*2 个文件
+    results.close()
+    assert len(started) <= 2  # 关闭后不再解析排队的文件
+
+
+# ---- 检查点和增量合并 ----
+
+def merged_texts(path):
+    return [text for text in body_texts(path) if text.endswith("个文件") or "（修改）" in text]
+
+
+def test_cancelled_merge_resumes_from_checkpoint(tmp_path):
+    source = make_inputs(tmp_path / "src", 5)
+    output = str(tmp_path / "合并.docx")
+    job = merge_word.MergeJob()
+
+    def progress(done, total, file_path):
+        if done == 2:
+            job.cancel()
+
+    engine = MergeEngine(progress=progress, cache_size=0, report=False, workers=1)
+    with pytest.raises(merge_word.MergeCancelled):
+        engine.run(str(source), "fast", output, job)
+    assert os.path.exists(engine.checkpoint_path(output, ".json"))
+    logs = []
+    assert MergeEngine(log=logs.append, cache_size=0, report=False).run(str(source), "fast", output)
+    assert any("从检查点继续" in line for line in logs)
+    assert merged_texts(output) == [f"第{n}个文件" for n in range(1, 6)]
+    assert not os.path.exists(engine.checkpoint_path(output, ".json"))
+
+
+def test_checkpoint_discarded_when_inputs_change(tmp_path):
+    source = make_inputs(tmp_path / "src", 4)
+    output = str(tmp_path / "合并.docx")
+    job = merge_word.MergeJob()
+
+    def progress(done, total, file_path):
+        if done == 2:
+            job.cancel()
+
+    engine = MergeEngine(progress=progress, cache_size=0, report=False, workers=1)
+    with pytest.raises(merge_word.MergeCancelled):
+        engine.run(str(source), "fast", output, job)
+    make_docx(source / "1.docx", "第1个文件（修改）")
+    logs = []
+    assert MergeEngine(log=logs.append, cache_size=0, report=False).run(str(source), "fast", output)
+    assert any("从头开始合并" in line for line in logs)
+    assert merged_texts(output) == ["第1个文件（修改）", "第2个文件", "第3个文件", "第4个文件"]
+
+
+def test_incremental_stream_reuses_unchanged_files(tmp_path):
+    source = make_inputs(tmp_path / "src", 4)
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(incremental=True, cache_size=0, report=False).run(str(source), "stream", output)
+    make_docx(source / "3.docx", "第3个文件（修改）")
+    logs = []
+    MergeEngine(incremental=True, log=logs.append, cache_size=0, report=False).run(str(source), "stream", output)
+    assert any("3 个文件未变化" in line for line in logs)
+    assert merged_texts(output) == ["第1个文件", "第2个文件", "第3个文件（修改）", "第4个文件"]
+
+
+def test_failed_reused_segment_is_not_a_dedupe_target(tmp_path, monkeypatch):
+    image = tmp_path / "logo.png"
+    image.write_bytes(make_png(40, 20, (200, 0, 0)))
+    source = tmp_path / "src"
+    source.mkdir()
+    make_picture_docx(source / "1.docx", image, "第1项")
+    make_picture_docx(source / "2.docx", image, "第2项")
+    output = str(tmp_path / "合并.docx")
+    MergeEngine(incremental=True, cache_size=0, report=False).run(str(source), "stream", output)
+    make_picture_docx(source / "2.docx", image, "第2项（修改）")
+
+    def broken_segment(self, segment, bookmark_name):
+        raise ValueError("上一次的输出不完整")
+
+    monkeypatch.setattr(merge_word.StreamMerger, "append_segment", broken_segment)
+    MergeEngine(incremental=True, cache_size=0, report=False).run(str(source), "stream", output)
+    with zipfile.ZipFile(output) as z:
+        names = set(z.namelist())
+        rels = etree.fromstring(z.read("word/_rels/document.xml.rels"))
+    images = [rel.get("Target") for rel in rels if rel.get("Type").endswith("/image")]
+    assert images and all("word/" + target in names for target in images)
+
+
+# ---- Word API ----
+
+def test_word_api_with_fake_word_application(tmp_path):
+    source = make_inputs(tmp_path / "src", 3)
+    engine = MergeEngine(word_app="fake", cache_size=0, report=False, resume=False)
+    output = engine.run(str(source), "word_api", str(tmp_path / "合并.docx"))
+    assert output is not None
+    assert merged_texts(output) == [f"第{n}个文件" for n in range(1, 4)]
+
+
+def test_word_com_merger_accepts_revisions_in_temp_copy(tmp_path):
+    source = make_inputs(tmp_path / "src", 2)
+    make_deleted_mark_docx(source / "rev.docx")
+    original = (source / "rev.docx").read_bytes()
+    files = [str(source / "1.docx"), str(source / "rev.docx"), str(source / "2.docx")]
+    merger = merge_word.WordComMerger(merge_word.FakeWordApplication(), lambda message: None)
+    output = str(tmp_path / "合并.docx")
+    pages = merger.merge(files, output, merge_word.MergeJob(), lambda *args: None)
+    assert [pages[f][0] for f in files] == ["bookmark_1", "bookmark_2", "bookmark_3"]
+    assert "甲乙" in body_texts(output)
+    assert (source / "rev.docx").read_bytes() == original  # 源文件不被改写
+    assert merger.temp_dir is None
+
+
+# ---- 合并服务 ----
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+@pytest.fixture
+def server(tmp_path):
+    """在本机随机端口上运行的合并服务，结果只能写在tmp_path之内"""
+    httpd = merge_word._MergeHTTPServer(("127.0.0.1", 0), merge_word._MergeRequestHandler)
+    httpd.merge_server = merge_word.MergeServer({"converter": "fake", "report": False}, output_root=str(tmp_path))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield http.client.HTTPConnection(*httpd.server_address, timeout=30)
+    httpd.shutdown()
+    httpd.server_close()
+    httpd.merge_server.close()
+
+
+def request(conn, method, path, body=None, headers=JSON_HEADERS):
+    conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def test_server_runs_job_over_http(tmp_path, server):
+    source = make_inputs(tmp_path / "src", 3)
+    output = str(tmp_path / "合并.docx")
+    status, body = request(server, "POST", "/jobs", {"directory": str(source), "algorithm": "stream", "output": output})
+    assert status == 202
+    job_id = json.loads(body)["id"]
+
+    status, body = request(server, "GET", f"/jobs/{job_id}/events")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert [e["status"] for e in events if e["type"] == "status"][-1] == "done"
+    assert any(e["type"] == "progress" and e["done"] == 3 for e in events)
+
+    status, body = request(server, "GET", f"/jobs/{job_id}/output")
+    assert status == 200 and body[:2] == b"PK"
+    assert merged_texts(output) == [f"第{n}个文件" for n in range(1, 4)]
+
+    status, _ = request(server, "POST", "/jobs", {"directory": str(tmp_path / "不存在")})
+    assert status == 400
+
+
+def test_server_rejects_cross_site_requests(tmp_path, server):
+    source = make_inputs(tmp_path / "src", 1)
+    job = {"directory": str(source), "output": "合并.docx"}
+    # 网页表单只能发出text/plain等简单请求
+    assert request(server, "POST", "/jobs", job, {"Content-Type": "text/plain"})[0] == 415
+    # DNS重绑定时Host头是攻击者的域名
+    assert request(server, "GET", "/jobs", headers={"Host": "evil.example:8765"})[0] == 403
+    assert request(server, "POST", "/jobs", job, dict(JSON_HEADERS, Host="evil.example"))[0] == 403
+    # 结果不能写到输出根目录之外
+    status, body = request(server, "POST", "/jobs", dict(job, output=str(tmp_path.parent / "x.docx")))
+    assert status == 400 and "output" in json.loads(body)["error"]
+    assert request(server, "POST", "/jobs", dict(job, output="../x.docx"))[0] == 400
+    assert request(server, "POST", "/jobs", job)[0] == 202
+
+
+def test_serve_refuses_remote_address_without_flag():
+    with pytest.raises(ValueError):
+        merge_word.serve("0.0.0.0:0")
+    with pytest.raises(SystemExit):
+        merge_word.main(["--serve", "0.0.0.0:8765"])